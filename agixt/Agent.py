@@ -18,16 +18,19 @@ from DB import (
     UserOAuth,
     OAuthProvider,
     TaskItem,
+    bump_agent_config_version,
 )
+from AgentCache import agent_cache, AgentCacheEntry
 from Providers import Providers
 from Extensions import Extensions
 from Globals import getenv, get_tokens, DEFAULT_SETTINGS, DEFAULT_USER
-from MagicalAuth import MagicalAuth, get_user_id
+from MagicalAuth import MagicalAuth, get_user_id, auth_cache
 from agixtsdk import AGiXTSDK
 from fastapi import HTTPException
 from datetime import datetime, timezone, timedelta
 import logging
 import json
+import copy
 import numpy as np
 import jwt
 import os
@@ -41,6 +44,9 @@ logging.basicConfig(
 
 def impersonate_user(user_id: str):
     AGIXT_API_KEY = getenv("AGIXT_API_KEY")
+    token = auth_cache.get_impersonation_token(user_id)
+    if token:
+        return token
     # Get users email
     session = get_session()
     user = session.query(User).filter(User.id == user_id).first()
@@ -59,6 +65,7 @@ def impersonate_user(user_id: str):
         AGIXT_API_KEY,
         algorithm="HS256",
     )
+    auth_cache.set_impersonation_token(user_id, token)
     return token
 
 
@@ -170,6 +177,7 @@ def delete_agent(agent_name, user=DEFAULT_USER):
     session.delete(agent)
     session.commit()
     session.close()
+    agent_cache.invalidate(user_id=user_id, agent_name=agent_name)
     return {"message": f"Agent {agent_name} deleted."}, 200
 
 
@@ -186,8 +194,11 @@ def rename_agent(agent_name, new_name, user=DEFAULT_USER):
         session.close()
         return {"message": f"Agent {agent_name} not found."}, 404
     agent.name = new_name
+    bump_agent_config_version(session, agent.id)
     session.commit()
     session.close()
+    agent_cache.invalidate(user_id=user_id, agent_name=agent_name)
+    agent_cache.invalidate(user_id=user_id, agent_name=new_name)
     return {"message": f"Agent {agent_name} renamed to {new_name}."}, 200
 
 
@@ -260,30 +271,101 @@ def get_agents(user=DEFAULT_USER, company=None):
     return output
 
 
+# Attributes resolved by Agent.__init__ that are shared by every cached instance.
+# Providers, extensions and auth hold the request's ApiClient or token and are
+# built for every instance.
+CACHED_AGENT_ATTRIBUTES = [
+    "agent_id",
+    "AI_PROVIDER",
+    "max_input_tokens",
+    "chunk_size",
+    "working_directory",
+    "company_id",
+]
+
+
 class Agent:
     def __init__(self, agent_name=None, user=DEFAULT_USER, ApiClient: AGiXTSDK = None):
         self.agent_name = agent_name if agent_name is not None else "AGiXT"
         user = user if user is not None else DEFAULT_USER
         self.user = user.lower()
-        self.user_id = get_user_id(user=self.user)
+        self.config_version = None
+        cache_user_id = None
+        try:
+            cache_user_id, self.config_version, entry = self.get_cache_entry()
+        except Exception as e:
+            logging.warning(f"Unable to check agent cache: {e}")
+            entry = None
+        self.user_id = (
+            cache_user_id if cache_user_id is not None else get_user_id(user=self.user)
+        )
         token = impersonate_user(user_id=str(self.user_id))
         self.auth = MagicalAuth(token=token)
-        self.company_id = None
-        self.agent_id = str(self.get_agent_id())
-        self.AGENT_CONFIG = self.get_agent_config()
-        self.load_config_keys()
-        if "settings" not in self.AGENT_CONFIG:
-            self.AGENT_CONFIG["settings"] = {}
-        self.PROVIDER_SETTINGS = (
-            self.AGENT_CONFIG["settings"] if "settings" in self.AGENT_CONFIG else {}
-        )
-        for setting in DEFAULT_SETTINGS:
-            if setting not in self.PROVIDER_SETTINGS:
-                self.PROVIDER_SETTINGS[setting] = DEFAULT_SETTINGS[setting]
-        self.AI_PROVIDER = self.AGENT_CONFIG["settings"]["provider"]
-        for key in ["name", "ApiClient", "agent_name", "user", "user_id", "api_key"]:
-            if key in self.PROVIDER_SETTINGS:
-                del self.PROVIDER_SETTINGS[key]
+        if entry is not None:
+            self.load_cache_entry(entry)
+        else:
+            self.company_id = None
+            self.agent_id = str(self.get_agent_id())
+            self.AGENT_CONFIG = self.get_agent_config()
+            self.load_config_keys()
+            if "settings" not in self.AGENT_CONFIG:
+                self.AGENT_CONFIG["settings"] = {}
+            self.PROVIDER_SETTINGS = (
+                self.AGENT_CONFIG["settings"] if "settings" in self.AGENT_CONFIG else {}
+            )
+            for setting in DEFAULT_SETTINGS:
+                if setting not in self.PROVIDER_SETTINGS:
+                    self.PROVIDER_SETTINGS[setting] = DEFAULT_SETTINGS[setting]
+            self.AI_PROVIDER = self.AGENT_CONFIG["settings"]["provider"]
+            for key in [
+                "name",
+                "ApiClient",
+                "agent_name",
+                "user",
+                "user_id",
+                "api_key",
+            ]:
+                if key in self.PROVIDER_SETTINGS:
+                    del self.PROVIDER_SETTINGS[key]
+            try:
+                self.max_input_tokens = int(self.AGENT_CONFIG["settings"]["MAX_TOKENS"])
+            except Exception as e:
+                self.max_input_tokens = 32000
+            self.chunk_size = 256
+            self.working_directory = os.path.join(
+                os.getcwd(), "WORKSPACE", self.agent_id
+            )
+            os.makedirs(self.working_directory, exist_ok=True)
+            if "company_id" in self.AGENT_CONFIG["settings"]:
+                self.company_id = str(self.AGENT_CONFIG["settings"]["company_id"])
+                if str(self.company_id).lower() == "none":
+                    self.company_id = None
+            self.PROVIDER_SETTINGS["company_id"] = self.company_id
+        self.load_providers(ApiClient=ApiClient, token=token)
+        if entry is not None:
+            self.extensions = entry.state["extensions"].with_client(
+                ApiClient=ApiClient,
+                api_key=ApiClient.headers.get("Authorization"),
+                agent_config=self.AGENT_CONFIG,
+            )
+        else:
+            self.extensions = Extensions(
+                agent_name=self.agent_name,
+                agent_id=self.agent_id,
+                agent_config=self.AGENT_CONFIG,
+                ApiClient=ApiClient,
+                api_key=ApiClient.headers.get("Authorization"),
+                user=self.user,
+            )
+            self.available_commands = self.extensions.get_available_commands()
+        self.company_agent = None
+        if self.company_id and str(self.company_id).lower() != "none":
+            self.company_agent = self.get_company_agent()
+        if entry is None and cache_user_id is not None:
+            self.save_cache_entry(cache_user_id)
+
+    def load_providers(self, ApiClient, token):
+        """Provider instances for this request, they hold its ApiClient and token"""
         self.PROVIDER = Providers(
             name=self.AI_PROVIDER,
             ApiClient=ApiClient,
@@ -351,35 +433,79 @@ class Agent:
         self.IMAGE_PROVIDER = Providers(
             name=image_provider, ApiClient=ApiClient, **self.PROVIDER_SETTINGS
         )
-        embeddings_provider = (
-            self.AGENT_CONFIG["settings"]["embeddings_provider"]
-            if "embeddings_provider" in self.AGENT_CONFIG["settings"]
-            else "default"
-        )
+
+    def get_cache_entry(self):
+        """
+        Looks up this agent's config version and the matching cache entry.
+
+        Returns (user_id, config_version, entry), user_id is None when the agent
+        does not exist yet and the result must not be cached.
+        """
+        if not agent_cache.enabled:
+            return None, None, None
+        session = get_session()
         try:
-            self.max_input_tokens = int(self.AGENT_CONFIG["settings"]["MAX_TOKENS"])
-        except Exception as e:
-            self.max_input_tokens = 32000
-        self.chunk_size = 256
-        self.extensions = Extensions(
-            agent_name=self.agent_name,
-            agent_id=self.agent_id,
-            agent_config=self.AGENT_CONFIG,
-            ApiClient=ApiClient,
-            api_key=ApiClient.headers.get("Authorization"),
-            user=self.user,
+            row = (
+                session.query(User.id, AgentModel.config_version)
+                .join(AgentModel, AgentModel.user_id == User.id)
+                .filter(User.email == self.user, AgentModel.name == self.agent_name)
+                .first()
+            )
+            if not row:
+                return None, None, None
+            user_id, version = str(row[0]), int(row[1] or 0)
+            entry = agent_cache.get(user_id, self.agent_name, version)
+            if entry is not None and entry.dependencies:
+                current = {
+                    str(agent_id): int(agent_version or 0)
+                    for agent_id, agent_version in session.query(
+                        AgentModel.id, AgentModel.config_version
+                    )
+                    .filter(AgentModel.id.in_(list(entry.dependencies.keys())))
+                    .all()
+                }
+                if any(
+                    current.get(agent_id) != agent_version
+                    for agent_id, agent_version in entry.dependencies.items()
+                ):
+                    agent_cache.invalidate(user_id=user_id, agent_name=self.agent_name)
+                    entry = None
+            return user_id, version, entry
+        finally:
+            session.close()
+
+    def load_cache_entry(self, entry: AgentCacheEntry):
+        for attribute in CACHED_AGENT_ATTRIBUTES:
+            setattr(self, attribute, entry.state[attribute])
+        # Callers mutate their agent's config, each instance gets its own copy
+        self.AGENT_CONFIG = copy.deepcopy(entry.state["AGENT_CONFIG"])
+        self.PROVIDER_SETTINGS = self.AGENT_CONFIG["settings"]
+        self.available_commands = copy.deepcopy(entry.state["available_commands"])
+        self.load_config_keys()
+
+    def save_cache_entry(self, user_id):
+        state = {
+            attribute: getattr(self, attribute) for attribute in CACHED_AGENT_ATTRIBUTES
+        }
+        state["AGENT_CONFIG"] = copy.deepcopy(self.AGENT_CONFIG)
+        state["available_commands"] = copy.deepcopy(self.available_commands)
+        # Chains and command tables only, without this request's client
+        state["extensions"] = self.extensions.with_client()
+        dependencies = {}
+        if (
+            self.company_agent is not None
+            and self.company_agent.config_version is not None
+        ):
+            dependencies[str(self.company_agent.agent_id)] = int(
+                self.company_agent.config_version
+            )
+        agent_cache.set(
+            user_id,
+            self.agent_name,
+            AgentCacheEntry(
+                version=self.config_version, state=state, dependencies=dependencies
+            ),
         )
-        self.available_commands = self.extensions.get_available_commands()
-        self.working_directory = os.path.join(os.getcwd(), "WORKSPACE", self.agent_id)
-        os.makedirs(self.working_directory, exist_ok=True)
-        if "company_id" in self.AGENT_CONFIG["settings"]:
-            self.company_id = str(self.AGENT_CONFIG["settings"]["company_id"])
-            if str(self.company_id).lower() == "none":
-                self.company_id = None
-        self.PROVIDER_SETTINGS["company_id"] = self.company_id
-        self.company_agent = None
-        if self.company_id and str(self.company_id).lower() != "none":
-            self.company_agent = self.get_company_agent()
 
     def get_company_agent(self):
         if self.company_id:
@@ -539,29 +665,94 @@ class Agent:
         return config
 
     async def inference(
-        self, prompt: str, images: list = [], use_smartest: bool = False
+        self,
+        prompt: str,
+        images: list = [],
+        use_smartest: bool = False,
+        tokens: int = 0,
+        hedge: bool = False,
     ):
         if not prompt:
             return ""
-        input_tokens = get_tokens(prompt)
+        # Callers that assembled the prompt from counted fragments pass the count
+        input_tokens = int(tokens) if tokens else get_tokens(prompt)
         provider_name = self.AGENT_CONFIG["settings"]["provider"]
+        kwargs = {}
         if provider_name == "rotation" and use_smartest == True:
-            answer = await self.PROVIDER.inference(
-                prompt=prompt, tokens=input_tokens, images=images, use_smartest=True
-            )
-        else:
-            answer = await self.PROVIDER.inference(
-                prompt=prompt, tokens=input_tokens, images=images
-            )
+            kwargs["use_smartest"] = True
+        if provider_name == "rotation" and hedge == True:
+            # Races slow requests on a second provider, only the answer used
+            # is charged below
+            kwargs["hedge"] = True
+        answer = await self.PROVIDER.inference(
+            prompt=prompt, tokens=input_tokens, images=images, **kwargs
+        )
         output_tokens = get_tokens(answer)
         self.auth.increase_token_counts(
-            input_tokens=input_tokens, output_tokens=output_tokens
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            agent_id=self.agent_id,
         )
         answer = str(answer).replace("\_", "_")
         if answer.endswith("\n\n"):
             answer = answer[:-2]
         return answer
 
+    async def inference_stream(
+        self,
+        prompt: str,
+        images: list = [],
+        use_smartest: bool = False,
+        tokens: int = 0,
+    ):
+        """
+        Yield the answer as the provider generates it, cleaned up and counted the
+        same way as inference. Providers without inference_stream yield their
+        whole answer at once.
+        """
+        if not prompt:
+            return
+        input_tokens = int(tokens) if tokens else get_tokens(prompt)
+        provider_name = self.AGENT_CONFIG["settings"]["provider"]
+        kwargs = {}
+        if provider_name == "rotation" and use_smartest == True:
+            kwargs["use_smartest"] = True
+        if hasattr(self.PROVIDER.instance, "inference_stream"):
+            stream = self.PROVIDER.inference_stream(
+                prompt=prompt, tokens=input_tokens, images=images, **kwargs
+            )
+        else:
+
+            async def whole_answer():
+                yield await self.PROVIDER.inference(
+                    prompt=prompt, tokens=input_tokens, images=images, **kwargs
+                )
+
+            stream = whole_answer()
+        answer = ""
+        held = ""
+        try:
+            async for token in stream:
+                token = str(token)
+                answer += token
+                text = held + token
+                # Hold back what could change with the next token: a backslash
+                # escaping an underscore, or trailing newlines at the very end
+                held = re.search(r"(\\|\n*)$", text).group(0)
+                text = text[: len(text) - len(held)].replace("\_", "_")
+                if text:
+                    yield text
+            if held.endswith("\n\n"):
+                held = held[:-2]
+            if held:
+                yield held.replace("\_", "_")
+        finally:
+            self.auth.increase_token_counts(
+                input_tokens=input_tokens,
+                output_tokens=get_tokens(answer),
+                agent_id=self.agent_id,
+            )
+
     async def vision_inference(
         self, prompt: str, images: list = [], use_smartest: bool = False
     ):
@@ -581,7 +772,9 @@ class Agent:
             )
         output_tokens = get_tokens(answer)
         self.auth.increase_token_counts(
-            input_tokens=input_tokens, output_tokens=output_tokens
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            agent_id=self.agent_id,
         )
         answer = str(answer).replace("\_", "_")
         if answer.endswith("\n\n"):
@@ -589,7 +782,7 @@ class Agent:
         return answer
 
     def embeddings(self, input) -> np.ndarray:
-        from Memories import embed
+        from Embeddings import embed
 
         return embed(input=input)
 
@@ -799,8 +992,11 @@ class Agent:
                     )
                     session.add(agent_setting)
 
+        if agent:
+            bump_agent_config_version(session, agent.id)
         try:
             session.commit()
+            agent_cache.invalidate(user_id=self.user_id, agent_name=self.agent_name)
             logging.info(f"Agent {self.agent_name} configuration updated successfully.")
         except Exception as e:
             session.rollback()
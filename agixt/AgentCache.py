@@ -0,0 +1,112 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class AgentCacheEntry:
+    """Everything Agent.__init__ resolves for one agent at one config version"""
+
+    def __init__(
+        self,
+        version: int,
+        state: dict,
+        dependencies: dict = None,
+    ):
+        self.version = version
+        self.state = state
+        # Other agents' config versions baked into this entry (the company agent)
+        self.dependencies = dependencies if dependencies else {}
+        self.created = time.monotonic()
+
+
+class AgentCache:
+    """
+    Per-worker cache of constructed agents keyed by (user_id, agent_name).
+
+    Entries hold the resolved config and command tables of an agent, provider
+    instances and anything else bound to a request's ApiClient or token are
+    built per request. Entries are only served while the agent's
+    config_version in the database matches the one they were built at. Writers bump that version, so
+    edits made through another worker are noticed on the next lookup. Entries
+    also expire after AGENT_CACHE_TTL seconds to pick up changes that do not go
+    through the agent (user preferences, chains edited elsewhere).
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = (
+            int(max_entries)
+            if max_entries is not None
+            else int(getenv("AGENT_CACHE_SIZE"))
+        )
+        self.ttl = float(ttl) if ttl is not None else float(getenv("AGENT_CACHE_TTL"))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    @staticmethod
+    def key(user_id, agent_name) -> Tuple[str, str]:
+        return (str(user_id), str(agent_name))
+
+    def get(self, user_id, agent_name, version) -> Optional[AgentCacheEntry]:
+        if not self.enabled:
+            return None
+        key = self.key(user_id, agent_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.version != version or time.monotonic() - entry.created > self.ttl:
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, user_id, agent_name, entry: AgentCacheEntry):
+        if not self.enabled:
+            return
+        key = self.key(user_id, agent_name)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id=None, agent_name=None):
+        """Drop entries for one agent, all agents of a user, or everything"""
+        with self.lock:
+            if user_id is None and agent_name is None:
+                self.entries.clear()
+                return
+            for key in list(self.entries.keys()):
+                if user_id is not None and key[0] != str(user_id):
+                    continue
+                if agent_name is not None and key[1] != str(agent_name):
+                    continue
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+agent_cache = AgentCache()
@@ -17,6 +17,7 @@ from Agent import Agent, add_agent, delete_agent, rename_agent, get_agents
 from Chain import Chain
 from Prompts import Prompts
 from Conversations import Conversations
+from MagicalAuth import auth_cache
 
 
 def verify_api_key(authorization: str = Header(None)):
@@ -26,6 +27,10 @@ def verify_api_key(authorization: str = Header(None)):
     authorization = str(authorization).replace("Bearer ", "").replace("bearer ", "")
     if DEFAULT_USER == "" or DEFAULT_USER is None or DEFAULT_USER == "None":
         DEFAULT_USER = "user"
+    # Only tokens verified in this exact (normalized) form are cached
+    entry = auth_cache.get(authorization, field="email")
+    if entry is not None:
+        return entry["email"]
     try:
         token = jwt.decode(
             jwt=authorization,
@@ -1,5 +1,6 @@
 from DB import (
     get_session,
+    get_async_session,
     Chain as ChainDB,
     ChainStep,
     ChainStepResponse,
@@ -17,6 +18,8 @@ from Globals import getenv, DEFAULT_USER
 from Prompts import Prompts
 from Extensions import Extensions
 from MagicalAuth import get_user_id
+from AgentCache import agent_cache
+from sqlalchemy import select
 import logging
 import asyncio
 
@@ -168,6 +171,8 @@ class Chain:
         session.add(chain)
         session.commit()
         session.close()
+        # Chains are listed as commands of every agent the user has
+        agent_cache.invalidate(user_id=self.user_id)
 
     def rename_chain(self, chain_name, new_name):
         session = get_session()
@@ -180,6 +185,7 @@ class Chain:
             chain.name = new_name
             session.commit()
         session.close()
+        agent_cache.invalidate(user_id=self.user_id)
 
     def add_chain_step(
         self,
@@ -494,6 +500,7 @@ class Chain:
         session.delete(chain)
         session.commit()
         session.close()
+        agent_cache.invalidate(user_id=self.user_id)
 
     def get_steps(self, chain_name):
         session = get_session()
@@ -817,14 +824,14 @@ class Chain:
         async def check_dependencies_met(dependencies):
             for dependency in dependencies:
                 try:
-                    step_responses = self.get_step_response(
-                        chain_name=chain_name,
+                    has_response = await self.has_step_response_async(
                         chain_run_id=chain_run_id,
+                        chain_name=chain_name,
                         step_number=int(dependency),
                     )
                 except:
                     return False
-                if not step_responses:
+                if not has_response:
                     return False
             return True
 
@@ -899,72 +906,118 @@ class Chain:
         else:
             return prompt_content
 
+    async def get_chain_id_async(self, session, chain_name):
+        chain_name = chain_name.replace("%20", " ")
+        default_user_id = select(User.id).where(User.email == DEFAULT_USER)
+        chain_id = await session.scalar(
+            select(ChainDB.id)
+            .where(
+                ChainDB.user_id == default_user_id.scalar_subquery(),
+                ChainDB.name == chain_name,
+            )
+            .limit(1)
+        )
+        if chain_id is None:
+            chain_id = await session.scalar(
+                select(ChainDB.id)
+                .where(ChainDB.name == chain_name, ChainDB.user_id == self.user_id)
+                .limit(1)
+            )
+        return chain_id
+
+    async def get_step_id_async(self, session, chain_name, step_number):
+        chain_id = await self.get_chain_id_async(session, chain_name)
+        if chain_id is None:
+            return None
+        return await session.scalar(
+            select(ChainStep.id)
+            .where(
+                ChainStep.chain_id == chain_id,
+                ChainStep.step_number == int(step_number),
+            )
+            .limit(1)
+        )
+
+    async def has_step_response_async(self, chain_run_id, chain_name, step_number):
+        async with get_async_session() as session:
+            chain_step_id = await self.get_step_id_async(
+                session, chain_name, step_number
+            )
+            if chain_step_id is None:
+                return False
+            response_id = await session.scalar(
+                select(ChainStepResponse.id)
+                .where(
+                    ChainStepResponse.chain_step_id == chain_step_id,
+                    ChainStepResponse.chain_run_id == chain_run_id,
+                )
+                .limit(1)
+            )
+        return response_id is not None
+
     async def update_step_response(
         self, chain_run_id, chain_name, step_number, response
     ):
-        chain_step = self.get_step(chain_name=chain_name, step_number=step_number)
-        if chain_step and response:
-            session = get_session()
-            existing_response = (
-                session.query(ChainStepResponse)
-                .filter(
-                    ChainStepResponse.chain_step_id == chain_step.id,
+        if not response:
+            return
+        async with get_async_session() as session:
+            chain_step_id = await self.get_step_id_async(
+                session, chain_name, step_number
+            )
+            if chain_step_id is None:
+                return
+            existing_response = await session.scalar(
+                select(ChainStepResponse)
+                .where(
+                    ChainStepResponse.chain_step_id == chain_step_id,
                     ChainStepResponse.chain_run_id == chain_run_id,
                 )
                 .order_by(ChainStepResponse.timestamp.desc())
-                .first()
+                .limit(1)
             )
             if existing_response:
                 if isinstance(existing_response.content, dict) and isinstance(
                     response, dict
                 ):
                     existing_response.content.update(response)
-                    session.commit()
                 elif isinstance(existing_response.content, list) and isinstance(
                     response, list
                 ):
                     existing_response.content.extend(response)
-                    session.commit()
                 else:
                     existing_response.content = response
-                    session.commit()
             else:
-                chain_step_response = ChainStepResponse(
-                    chain_step_id=chain_step.id,
-                    chain_run_id=chain_run_id,
-                    content=response,
+                session.add(
+                    ChainStepResponse(
+                        chain_step_id=chain_step_id,
+                        chain_run_id=chain_run_id,
+                        content=response,
+                    )
                 )
-                session.add(chain_step_response)
-                session.commit()
-            session.close()
+            await session.commit()
 
     async def get_chain_run_id(self, chain_name):
-        session = get_session()
-        chain_run = ChainRun(
-            chain_id=self.get_chain(chain_name=chain_name)["id"],
-            user_id=self.user_id,
-        )
-        session.add(chain_run)
-        session.commit()
-        chain_id = chain_run.id
-        session.close()
-        return chain_id
+        async with get_async_session() as session:
+            chain_run = ChainRun(
+                chain_id=await self.get_chain_id_async(session, chain_name),
+                user_id=self.user_id,
+            )
+            session.add(chain_run)
+            await session.commit()
+            return chain_run.id
 
     async def get_last_chain_run_id(self, chain_name):
-        chain_data = self.get_chain(chain_name=chain_name)
-        session = get_session()
-        chain_run = (
-            session.query(ChainRun)
-            .filter(ChainRun.chain_id == chain_data["id"])
-            .order_by(ChainRun.timestamp.desc())
-            .first()
-        )
-        if chain_run:
-            chain_run_id = chain_run.id
-            session.close()
+        async with get_async_session() as session:
+            chain_id = await self.get_chain_id_async(session, chain_name)
+            chain_run_id = await session.scalar(
+                select(ChainRun.id)
+                .where(ChainRun.chain_id == chain_id)
+                .order_by(ChainRun.timestamp.desc())
+                .limit(1)
+            )
+        if chain_run_id:
             return chain_run_id
-        else:
-            return await self.get_chain_run_id(chain_name=chain_name)
+        return await self.get_chain_run_id(chain_name=chain_name)
 
     def get_chain_args(self, chain_name):
         skip_args = [
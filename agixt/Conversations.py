@@ -1,17 +1,37 @@
 from datetime import datetime
+from collections import OrderedDict, deque
+import threading
 import logging
+import base64
+import time
+import uuid
+import re
 from DB import (
     Conversation,
     Agent,
     Message,
     User,
     UserPreferences,
+    SessionLocal,
+    DATABASE_TYPE,
     get_session,
+    get_async_session,
+    get_message_kind,
+    get_parent_activity_id,
+    ACTIVITY_KINDS,
+    THINKING_ACTIVITY,
 )
 from Globals import getenv, DEFAULT_USER
+from sqlalchemy import select, update, tuple_
 from sqlalchemy.sql import func
 import pytz
-from MagicalAuth import convert_time
+from MagicalAuth import (
+    convert_time,
+    convert_times,
+    get_user_timezone,
+    get_user_timezone_async,
+)
+from InteractionLog import interaction_log
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -19,6 +39,260 @@ logging.basicConfig(
 )
 
 
+def newest_activity_query(conversation_id):
+    return (
+        select(Message.id, Message.kind, Message.timestamp)
+        .where(
+            Message.conversation_id == conversation_id,
+            Message.kind.in_(ACTIVITY_KINDS),
+        )
+        .order_by(Message.timestamp.desc())
+        .limit(1)
+    )
+
+
+def pick_newest_activity(conversation_id, row):
+    """
+    (id, kind) of the newer of the database's newest activity row and the
+    newest activity this worker logged. Another worker may have written a
+    newer activity, the buffer only wins with a row the database has not seen.
+    """
+    buffered = interaction_log.last_activity(conversation_id)
+    if buffered and (
+        row is None or row.timestamp is None or buffered[2] > row.timestamp
+    ):
+        return buffered[0], buffered[1]
+    if row is not None:
+        return str(row.id), row.kind
+    return None
+
+
+def get_newest_activity(session, conversation_id):
+    row = session.execute(newest_activity_query(conversation_id)).first()
+    return pick_newest_activity(conversation_id, row)
+
+
+class ConversationCache:
+    """
+    Per-worker TTL cache of user ids by email and conversation ids by
+    (email, conversation_name), so Conversations methods do not look up the
+    User and Conversation rows on every call. Renaming, deleting and forking a
+    conversation invalidate its key, and so does a message flush that finds the
+    conversation deleted. Other workers see the change after at most
+    CONVERSATION_CACHE_TTL seconds.
+    """
+
+    def __init__(self, ttl: float = None):
+        self.ttl = (
+            float(ttl) if ttl is not None else float(getenv("CONVERSATION_CACHE_TTL"))
+        )
+        self.user_ids = {}
+        self.conversation_ids = {}
+        self.lock = threading.Lock()
+
+    def _get(self, entries, key):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            value, created = entry
+            if time.monotonic() - created > self.ttl:
+                del entries[key]
+                return None
+            return value
+
+    def _set(self, entries, key, value):
+        if self.ttl <= 0 or value is None:
+            return
+        with self.lock:
+            entries[key] = (value, time.monotonic())
+
+    def get_user_id(self, email):
+        return self._get(self.user_ids, email)
+
+    def set_user_id(self, email, user_id):
+        self._set(self.user_ids, email, str(user_id))
+
+    def get_conversation_id(self, email, conversation_name):
+        return self._get(self.conversation_ids, (email, conversation_name))
+
+    def set_conversation_id(self, email, conversation_name, conversation_id):
+        self._set(
+            self.conversation_ids, (email, conversation_name), str(conversation_id)
+        )
+
+    def forget_conversation(self, conversation_id):
+        """Drop every key resolving to a conversation found to be deleted"""
+        conversation_id = str(conversation_id)
+        with self.lock:
+            for key, (value, _) in list(self.conversation_ids.items()):
+                if value == conversation_id:
+                    del self.conversation_ids[key]
+
+    def invalidate(self, email, conversation_name=None):
+        """Drop one conversation of a user, or all of the user's conversations"""
+        with self.lock:
+            if conversation_name is not None:
+                self.conversation_ids.pop((email, conversation_name), None)
+                return
+            self.user_ids.pop(email, None)
+            for key in list(self.conversation_ids.keys()):
+                if key[0] == email:
+                    del self.conversation_ids[key]
+
+
+conversation_cache = ConversationCache()
+
+
+def render_chat_line(timestamp, role, content):
+    # Code blocks are left out of the history to keep prompts short
+    content = re.sub(r"(```.*?```)", "", content)
+    return f"{timestamp} {role}: {content} \n "
+
+
+def render_subactivity(timestamp, content):
+    return f"#### Subactivity at {timestamp}\n{content}"
+
+
+class ConversationHistoryWindow:
+    """The rendered tail of one conversation, see ConversationHistoryCache"""
+
+    def __init__(self, chat_limit, activity_limit, timezone, user_id, updated_at):
+        self.chat_limit = chat_limit
+        self.activity_limit = activity_limit
+        self.timezone = timezone
+        self.user_id = user_id
+        self.updated_at = updated_at
+        self.chat = deque(maxlen=chat_limit)
+        # activity id -> [activity heading, subactivity lines]
+        self.activities = OrderedDict()
+        self.created = time.monotonic()
+
+    def add_activity(self, activity_id, timestamp, content):
+        self.activities[str(activity_id)] = [
+            f"### Activity at {timestamp}\n{content}\n",
+            [],
+        ]
+        while len(self.activities) > self.activity_limit:
+            self.activities.popitem(last=False)
+
+    def add_message(self, row):
+        kind = row["kind"]
+        content = row["content"]
+        if kind == "chat":
+            if not content.startswith("<audio controls>"):
+                timestamp = convert_time(
+                    row["timestamp"], user_id=self.user_id, timezone=self.timezone
+                )
+                self.chat.append(render_chat_line(timestamp, row["role"], content))
+        elif kind in ACTIVITY_KINDS:
+            self.add_activity(row["id"], row["timestamp"], content)
+        elif kind == "subactivity" and row["parent_activity_id"]:
+            activity = self.activities.get(str(row["parent_activity_id"]))
+            if activity is not None:
+                activity[1].append(render_subactivity(row["timestamp"], content))
+        self.updated_at = row["timestamp"]
+
+    def render(self):
+        if not self.chat and not self.activities:
+            return ""
+        activities = "\n".join(
+            heading + "\n".join(subactivities)
+            for heading, subactivities in self.activities.values()
+        )
+        return (
+            "\n".join(self.chat)
+            + "\n## The assistant's recent activities:\n"
+            + f"### Detailed Activities:\n{activities}"
+        )
+
+
+class ConversationHistoryCache:
+    """
+    Per-worker cache of rendered conversation histories for prompt building.
+
+    A window holds the last chat messages and activities of a conversation and
+    is extended in place as this worker logs messages, so the next turn does
+    not re-read the conversation. A window is only served while the
+    conversation's updated_at still matches the newest message it has seen
+    (any write from another worker moves it) and for at most
+    CONVERSATION_CACHE_TTL seconds.
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = (
+            int(max_entries)
+            if max_entries is not None
+            else int(getenv("CONVERSATION_HISTORY_CACHE_SIZE"))
+        )
+        self.ttl = (
+            float(ttl) if ttl is not None else float(getenv("CONVERSATION_CACHE_TTL"))
+        )
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def get(self, conversation_id, updated_at, chat_limit, activity_limit):
+        if not self.enabled:
+            return None
+        conversation_id = str(conversation_id)
+        with self.lock:
+            window = self.entries.get(conversation_id)
+            if (
+                window is None
+                or window.updated_at != updated_at
+                or window.chat_limit != chat_limit
+                or window.activity_limit != activity_limit
+                or time.monotonic() - window.created > self.ttl
+            ):
+                self.entries.pop(conversation_id, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(conversation_id)
+            self.hits += 1
+            return window.render()
+
+    def set(self, conversation_id, window: ConversationHistoryWindow):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[str(conversation_id)] = window
+            self.entries.move_to_end(str(conversation_id))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def add_message(self, row):
+        """Interaction log listener, extends the window of the row's conversation"""
+        with self.lock:
+            window = self.entries.get(str(row["conversation_id"]))
+            if window is not None:
+                window.add_message(row)
+
+    def invalidate(self, conversation_id):
+        with self.lock:
+            self.entries.pop(str(conversation_id), None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+history_cache = ConversationHistoryCache()
+interaction_log.listeners.append(history_cache.add_message)
+interaction_log.deleted_listeners.append(conversation_cache.forget_conversation)
+
+
 def get_conversation_id_by_name(conversation_name, user_id):
     user_id = str(user_id)
     session = get_session()
@@ -61,47 +335,224 @@ def get_conversation_name_by_id(conversation_id, user_id):
     return conversation_name
 
 
+async def get_conversation_id_by_name_async(conversation_name, user_id):
+    user_id = str(user_id)
+    async with get_async_session() as session:
+        conversation_id = await session.scalar(
+            select(Conversation.id)
+            .where(
+                Conversation.name == conversation_name,
+                Conversation.user_id == user_id,
+            )
+            .limit(1)
+        )
+        if not conversation_id:
+            conversation = Conversation(name=conversation_name, user_id=user_id)
+            session.add(conversation)
+            await session.commit()
+            conversation_id = conversation.id
+    return str(conversation_id)
+
+
+async def get_conversation_name_by_id_async(conversation_id, user_id):
+    if conversation_id == "-":
+        await get_conversation_id_by_name_async("-", user_id)
+        return "-"
+    async with get_async_session() as session:
+        conversation_name = await session.scalar(
+            select(Conversation.name)
+            .where(
+                Conversation.id == conversation_id,
+                Conversation.user_id == user_id,
+            )
+            .limit(1)
+        )
+    if not conversation_name:
+        return "-"
+    return conversation_name
+
+
+def encode_message_cursor(message) -> str:
+    """Opaque cursor pointing just past a message in (timestamp, id) order"""
+    value = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_message_cursor(cursor: str):
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, message_id = value.split("|", 1)
+        timestamp = datetime.fromisoformat(timestamp)
+        message_id = uuid.UUID(message_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return timestamp, str(message_id) if DATABASE_TYPE == "sqlite" else message_id
+
+
+def get_messages_query(conversation_id, limit=100, page=1, cursor=None, kinds=None):
+    """
+    SELECT for one page of a conversation's messages in (timestamp, id) order.
+
+    With a cursor the page starts right after the message it points to, which
+    is a range scan on ix_message_conversation_timestamp however deep the page
+    is. Without one it falls back to LIMIT/OFFSET on page.
+    """
+    query = select(Message).where(Message.conversation_id == conversation_id)
+    if kinds:
+        query = query.where(Message.kind.in_(kinds))
+    if cursor:
+        timestamp, message_id = decode_message_cursor(cursor)
+        query = query.where(
+            tuple_(Message.timestamp, Message.id)
+            > tuple_(
+                timestamp,
+                message_id,
+                types=[Message.timestamp.type, Message.id.type],
+            )
+        )
+    elif page and page > 1:
+        query = query.offset((page - 1) * limit)
+    return query.order_by(Message.timestamp.asc(), Message.id.asc()).limit(limit)
+
+
+def get_next_cursor(messages, limit):
+    """Cursor for the page after messages, None once the last page was read"""
+    if not messages or len(messages) < limit:
+        return None
+    return encode_message_cursor(messages[-1])
+
+
 class Conversations:
     def __init__(self, conversation_name=None, user=DEFAULT_USER):
         self.conversation_name = conversation_name
         self.user = user
+        self.user_id = None
+        # (conversation_name, conversation_id) last resolved by this instance
+        self.resolved_conversation = (None, None)
+
+    def get_user_id(self, session=None):
+        if self.user_id is None:
+            self.user_id = conversation_cache.get_user_id(self.user)
+        if self.user_id is None:
+            own_session = session is None
+            if own_session:
+                session = get_session()
+            try:
+                user_id = (
+                    session.query(User.id).filter(User.email == self.user).scalar()
+                )
+            finally:
+                if own_session:
+                    session.close()
+            if user_id is None:
+                raise AttributeError(f"User {self.user} not found")
+            self.user_id = str(user_id)
+            conversation_cache.set_user_id(self.user, self.user_id)
+        return self.user_id
+
+    def remember_conversation_id(self, conversation_id):
+        self.resolved_conversation = (self.conversation_name, str(conversation_id))
+        conversation_cache.set_conversation_id(
+            self.user, self.conversation_name, conversation_id
+        )
 
-    def export_conversation(self):
-        session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        if not self.conversation_name:
-            self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
+    def forget_conversation_id(self, conversation_name=None):
+        if conversation_name is None:
+            conversation_name = self.conversation_name
+        if self.resolved_conversation[0] == conversation_name:
+            self.resolved_conversation = (None, None)
+        conversation_cache.invalidate(self.user, conversation_name)
+
+    def get_conversation_row(self, session, create=False):
+        """
+        The Conversation row named self.conversation_name, fetched by its cached
+        id when possible. Creates it when missing and create is True.
+        """
+        user_id = self.get_user_id(session)
+        conversation = None
+        conversation_id = self.get_cached_conversation_id()
+        if conversation_id:
+            conversation = session.get(Conversation, conversation_id)
+            if (
+                conversation is None
+                or conversation.name != self.conversation_name
+                or str(conversation.user_id) != user_id
+            ):
+                # Renamed or deleted through another worker
+                self.forget_conversation_id()
+                conversation = None
+        if conversation is None:
+            conversation = (
+                session.query(Conversation)
+                .filter(
+                    Conversation.name == self.conversation_name,
+                    Conversation.user_id == user_id,
+                )
+                .first()
             )
-            .first()
-        )
-        history = {"interactions": []}
-        if not conversation:
-            return history
-        messages = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .all()
-        )
-        for message in messages:
-            interaction = {
-                "role": message.role,
-                "message": message.content,
-                "timestamp": message.timestamp,
-            }
-            history["interactions"].append(interaction)
-        session.close()
-        return history
+            if not conversation and create:
+                conversation = Conversation(
+                    name=self.conversation_name, user_id=user_id
+                )
+                session.add(conversation)
+                session.commit()
+            if conversation:
+                self.remember_conversation_id(conversation.id)
+        if conversation is not None and interaction_log.has_pending(conversation.id):
+            # Make buffered messages visible to the caller's queries
+            interaction_log.flush()
+        return conversation
+
+    def iter_conversation_export(self, batch_size=1000):
+        """
+        Yield every message of the conversation oldest first without loading the
+        whole history. Rows come from a server-side cursor batch_size at a time,
+        on a session of its own so the generator can outlive the request scope.
+        """
+        session = SessionLocal()
+        try:
+            if not self.conversation_name:
+                self.conversation_name = "-"
+            conversation = self.get_conversation_row(session)
+            if not conversation:
+                return
+            messages = session.scalars(
+                select(Message)
+                .where(Message.conversation_id == conversation.id)
+                .order_by(Message.timestamp.asc(), Message.id.asc())
+                .execution_options(yield_per=batch_size)
+            )
+            for message in messages:
+                yield {
+                    "id": str(message.id),
+                    "role": message.role,
+                    "message": message.content,
+                    "timestamp": message.timestamp,
+                    "updated_at": message.updated_at,
+                    "updated_by": (
+                        str(message.updated_by) if message.updated_by else None
+                    ),
+                    "feedback_received": message.feedback_received,
+                }
+        finally:
+            session.close()
+
+    def export_conversation(self):
+        return {
+            "interactions": [
+                {
+                    "role": interaction["role"],
+                    "message": interaction["message"],
+                    "timestamp": interaction["timestamp"],
+                }
+                for interaction in self.iter_conversation_export()
+            ]
+        }
 
     def get_conversations(self):
+        interaction_log.flush()
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
 
         # Use a LEFT OUTER JOIN to get conversations and their messages
         conversations = (
@@ -119,9 +570,9 @@ class Conversations:
         return conversation_list
 
     def get_conversations_with_ids(self):
+        interaction_log.flush()
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
 
         # Use a LEFT OUTER JOIN to get conversations and their messages
         conversations = (
@@ -158,9 +609,9 @@ class Conversations:
         return agent_id
 
     def get_conversations_with_detail(self):
+        interaction_log.flush()
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
 
         # Add notification check to the query
         conversations = (
@@ -177,28 +628,38 @@ class Conversations:
             .order_by(Conversation.updated_at.desc())
             .all()
         )
+        created = convert_times(
+            [conversation.created_at for conversation, _ in conversations],
+            user_id=user_id,
+        )
+        updated = convert_times(
+            [conversation.updated_at for conversation, _ in conversations],
+            user_id=user_id,
+        )
         # If the agent's company_id does not match
         result = {
             str(conversation.id): {
                 "name": conversation.name,
                 "agent_id": self.get_agent_id(user_id),
-                "created_at": convert_time(conversation.created_at, user_id=user_id),
-                "updated_at": convert_time(conversation.updated_at, user_id=user_id),
+                "created_at": created_at,
+                "updated_at": updated_at,
                 "has_notifications": notification_count > 0,
                 "summary": (
                     conversation.summary if Conversation.summary else "None available"
                 ),
                 "attachment_count": conversation.attachment_count,
             }
-            for conversation, notification_count in conversations
+            for (conversation, notification_count), created_at, updated_at in zip(
+                conversations, created, updated
+            )
         }
         session.close()
         return result
 
     def get_notifications(self):
+        interaction_log.flush()
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
 
         # Get all messages with notify=True for this user's conversations
         notifications = (
@@ -209,8 +670,11 @@ class Conversations:
             .all()
         )
 
+        timestamps = convert_times(
+            [message.timestamp for message, _ in notifications], user_id=user_id
+        )
         result = []
-        for message, conversation in notifications:
+        for (message, conversation), timestamp in zip(notifications, timestamps):
             result.append(
                 {
                     "conversation_id": str(conversation.id),
@@ -218,27 +682,19 @@ class Conversations:
                     "message_id": str(message.id),
                     "message": message.content,
                     "role": message.role,
-                    "timestamp": convert_time(message.timestamp, user_id=user_id),
+                    "timestamp": timestamp,
                 }
             )
 
         session.close()
         return result
 
-    def get_conversation(self, limit=100, page=1):
+    def get_conversation(self, limit=100, page=1, cursor=None):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             # Create the conversation
             conversation = Conversation(name=self.conversation_name, user_id=user_id)
@@ -254,47 +710,50 @@ class Conversations:
                 .update({"notify": False})
             )
         session.commit()
-        offset = (page - 1) * limit
-        messages = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .order_by(Message.timestamp.asc())
-            .limit(limit)
-            .offset(offset)
-            .all()
-        )
-        if not messages:
+        try:
+            messages = session.scalars(
+                get_messages_query(
+                    conversation.id, limit=limit, page=page, cursor=cursor
+                )
+            ).all()
+        finally:
             session.close()
-            return {"interactions": []}
+        if not messages:
+            return {"interactions": [], "next_cursor": None}
+        timezone = get_user_timezone(user_id)
+        timestamps = convert_times(
+            [message.timestamp for message in messages],
+            user_id=user_id,
+            timezone=timezone,
+        )
+        updated = convert_times(
+            [message.updated_at for message in messages],
+            user_id=user_id,
+            timezone=timezone,
+        )
         return_messages = []
-        for message in messages:
+        for message, timestamp, updated_at in zip(messages, timestamps, updated):
             msg = {
                 "id": message.id,
                 "role": message.role,
                 "message": message.content,
-                "timestamp": convert_time(message.timestamp, user_id=user_id),
-                "updated_at": convert_time(message.updated_at, user_id=user_id),
+                "timestamp": timestamp,
+                "updated_at": updated_at,
                 "updated_by": message.updated_by,
                 "feedback_received": message.feedback_received,
             }
             return_messages.append(msg)
-        session.close()
-        return {"interactions": return_messages}
+        return {
+            "interactions": return_messages,
+            "next_cursor": get_next_cursor(messages, limit),
+        }
 
     def fork_conversation(self, message_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
 
         # Get the original conversation
-        original_conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        original_conversation = self.get_conversation_row(session)
 
         if not original_conversation:
             logging.info(f"No conversation found to fork.")
@@ -336,102 +795,88 @@ class Conversations:
                 updated_by=message.updated_by,
                 feedback_received=message.feedback_received,
                 notify=False,
+                kind=message.kind,
+                parent_activity_id=message.parent_activity_id,
             )
             session.add(new_message)
         new_message.notify = True  # Notify on the last message
         session.commit()
         forked_conversation_id = str(new_conversation.id)
         session.close()
+        self.forget_conversation_id(new_conversation_name)
 
         logging.info(
             f"Conversation forked successfully. New conversation ID: {forked_conversation_id}"
         )
         return new_conversation_name
 
-    def get_activities(self, limit=100, page=1):
+    def get_activities(self, limit=100, page=1, cursor=None):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
-            return {"activities": []}
-        offset = (page - 1) * limit
-        messages = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .order_by(Message.timestamp.asc())
-            .limit(limit)
-            .offset(offset)
-            .all()
-        )
+            return {"activities": [], "next_cursor": None}
+        messages = session.scalars(
+            get_messages_query(
+                conversation.id,
+                limit=limit,
+                page=page,
+                cursor=cursor,
+                kinds=ACTIVITY_KINDS,
+            )
+        ).all()
         if not messages:
             session.close()
-            return {"activities": []}
-        return_activities = []
-        for message in messages:
-            if message.content.startswith("[ACTIVITY]"):
-                msg = {
-                    "id": message.id,
-                    "role": message.role,
-                    "message": message.content,
-                    "timestamp": message.timestamp,
-                }
-                return_activities.append(msg)
-        # Order messages by timestamp oldest to newest
-        return_activities = sorted(return_activities, key=lambda x: x["timestamp"])
+            return {"activities": [], "next_cursor": None}
+        # Ordered by timestamp oldest to newest
+        return_activities = [
+            {
+                "id": message.id,
+                "role": message.role,
+                "message": message.content,
+                "timestamp": message.timestamp,
+            }
+            for message in messages
+        ]
         session.close()
-        return {"activities": return_activities}
+        return {
+            "activities": return_activities,
+            "next_cursor": get_next_cursor(messages, limit),
+        }
 
     def get_subactivities(self, activity_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return ""
+        parent_activity_id = get_parent_activity_id(f"[SUBACTIVITY][{activity_id}]")
+        if not parent_activity_id:
+            session.close()
+            return ""
         messages = (
             session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
+            .filter(
+                Message.parent_activity_id == parent_activity_id,
+                Message.conversation_id == conversation.id,
+            )
             .order_by(Message.timestamp.asc())
             .all()
         )
-        if not messages:
-            session.close()
-            return ""
-        return_subactivities = []
-        for message in messages:
-            if message.content.startswith(f"[SUBACTIVITY][{activity_id}]"):
-                msg = {
-                    "id": message.id,
-                    "role": message.role,
-                    "message": message.content,
-                    "timestamp": message.timestamp,
-                }
-                return_subactivities.append(msg)
-        # Order messages by timestamp oldest to newest
-        return_subactivities = sorted(
-            return_subactivities, key=lambda x: x["timestamp"]
-        )
+        # Ordered by timestamp oldest to newest
+        return_subactivities = [
+            {
+                "id": message.id,
+                "role": message.role,
+                "message": message.content,
+                "timestamp": message.timestamp,
+            }
+            for message in messages
+        ]
         session.close()
         # Return it as a string with timestamps per subactivity in markdown format
         subactivities = "\n".join(
@@ -444,24 +889,18 @@ class Conversations:
 
     def get_activities_with_subactivities(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return ""
         messages = (
             session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.kind != "chat",
+            )
             .order_by(Message.timestamp.asc())
             .all()
         )
@@ -511,24 +950,102 @@ class Conversations:
         )
         return f"### Detailed Activities:\n{activities}"
 
-    def new_conversation(self, conversation_content=[]):
+    def get_recent_history(self, chat_limit=5, activity_limit=5):
+        """
+        The last chat_limit chat messages and the last activity_limit activities
+        with their subactivities, rendered for the prompt. Served from the
+        history cache while nobody else has written to the conversation.
+        """
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        # Check if the conversation already exists for the agent
-        existing_conversation = (
-            session.query(Conversation)
+        if not self.conversation_name:
+            self.conversation_name = "-"
+        conversation = self.get_conversation_row(session)
+        if not conversation:
+            session.close()
+            return ""
+        # Read past the session's identity map, another worker may have written
+        updated_at = (
+            session.query(Conversation.updated_at)
+            .filter(Conversation.id == conversation.id)
+            .scalar()
+        )
+        history = history_cache.get(
+            conversation.id, updated_at, chat_limit, activity_limit
+        )
+        if history is not None:
+            session.close()
+            return history
+        user_id = self.get_user_id(session)
+        window = ConversationHistoryWindow(
+            chat_limit=chat_limit,
+            activity_limit=activity_limit,
+            timezone=get_user_timezone(user_id),
+            user_id=user_id,
+            updated_at=updated_at,
+        )
+        chat_messages = (
+            session.query(
+                Message.role,
+                Message.content,
+                Message.timestamp,
+            )
             .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
+                Message.conversation_id == conversation.id,
+                Message.kind == "chat",
+                ~Message.content.startswith("<audio controls>"),
             )
-            .first()
+            .order_by(Message.timestamp.desc())
+            .limit(chat_limit)
+            .all()
+        )
+        for message in reversed(chat_messages):
+            timestamp = convert_time(
+                message.timestamp, user_id=user_id, timezone=window.timezone
+            )
+            window.chat.append(
+                render_chat_line(timestamp, message.role, message.content)
+            )
+        activities = (
+            session.query(Message.id, Message.content, Message.timestamp)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.kind.in_(ACTIVITY_KINDS),
+            )
+            .order_by(Message.timestamp.desc())
+            .limit(activity_limit)
+            .all()
         )
+        for activity in reversed(activities):
+            window.add_activity(activity.id, activity.timestamp, activity.content)
+        if activities:
+            subactivities = (
+                session.query(
+                    Message.parent_activity_id, Message.content, Message.timestamp
+                )
+                .filter(
+                    Message.parent_activity_id.in_(
+                        [activity.id for activity in activities]
+                    ),
+                    Message.conversation_id == conversation.id,
+                )
+                .order_by(Message.timestamp.asc())
+                .all()
+            )
+            for subactivity in subactivities:
+                window.activities[str(subactivity.parent_activity_id)][1].append(
+                    render_subactivity(subactivity.timestamp, subactivity.content)
+                )
+        session.close()
+        history_cache.set(conversation.id, window)
+        return window.render()
+
+    def new_conversation(self, conversation_content=[]):
+        session = get_session()
+        # Check if the conversation already exists for the agent
+        existing_conversation = self.get_conversation_row(session)
         if not existing_conversation:
             # Create a new conversation
-            conversation = Conversation(name=self.conversation_name, user_id=user_id)
-            session.add(conversation)
-            session.commit()
+            conversation = self.get_conversation_row(session, create=True)
             if conversation_content != []:
                 for interaction in conversation_content:
                     self.log_interaction(
@@ -541,102 +1058,42 @@ class Conversations:
         return conversation
 
     def get_thinking_id(self, agent_name):
-        session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
-        if not conversation:
+        # The newest activity decides: a thinking activity is reused, any other
+        # activity gets a new thinking activity as its child
+        conversation_id = self.get_conversation_id()
+        session = get_session()
+        try:
+            last_activity = get_newest_activity(session, conversation_id)
+        finally:
             session.close()
-            return None
-
-        # Get the most recent non-thinking activity message
-        current_parent_activity = (
-            session.query(Message)
-            .filter(
-                Message.conversation_id == conversation.id,
-                Message.content.like("[ACTIVITY]%"),
-                Message.content != "[ACTIVITY] Thinking.",
-            )
-            .order_by(Message.timestamp.desc())
-            .first()
-        )
-
-        # Get the most recent thinking activity
-        current_thinking = (
-            session.query(Message)
-            .filter(
-                Message.conversation_id == conversation.id,
-                Message.content == "[ACTIVITY] Thinking.",
-            )
-            .order_by(Message.timestamp.desc())
-            .first()
-        )
-
-        # If there's a parent activity and it's more recent than the last thinking activity
-        if current_parent_activity:
-            if (
-                not current_thinking
-                or current_parent_activity.timestamp > current_thinking.timestamp
-            ):
-                # Create new thinking activity as we have a new parent
-                thinking_id = self.log_interaction(
-                    role=agent_name,
-                    message="[ACTIVITY] Thinking.",
-                )
-                session.close()
-                return str(thinking_id)
-
-        # If we have a current thinking activity and it's the most recent,
-        # or if there's no parent activity at all, reuse the existing thinking ID
-        if current_thinking:
-            if (
-                not current_parent_activity
-                or current_thinking.timestamp > current_parent_activity.timestamp
-            ):
-                session.close()
-                return str(current_thinking.id)
-
-        # If we have no thinking activity at all, create one
+        if last_activity and last_activity[1] == "thinking":
+            return last_activity[0]
         thinking_id = self.log_interaction(
             role=agent_name,
-            message="[ACTIVITY] Thinking.",
+            message=THINKING_ACTIVITY,
         )
-        session.close()
         return str(thinking_id)
 
     def log_interaction(self, role, message):
         message = str(message)
+        conversation_id = self.get_conversation_id()
         if str(message).startswith("[SUBACTIVITY] "):
+            session = get_session()
             try:
-                last_activity_id = self.get_last_activity_id()
+                last_activity = get_newest_activity(session, conversation_id)
+                last_activity_id = last_activity[0] if last_activity else None
             except:
                 last_activity_id = None
+            finally:
+                session.close()
             if last_activity_id:
                 message = message.replace(
                     "[SUBACTIVITY] ", f"[SUBACTIVITY][{last_activity_id}] "
                 )
             else:
                 message = message.replace("[SUBACTIVITY] ", "[ACTIVITY] ")
-        session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
         notify = False
         if role.lower() == "user":
             role = "USER"
@@ -645,38 +1102,17 @@ class Conversations:
                 "[SUBACTIVITY]"
             ):
                 notify = True
-        if not conversation:
-            conversation = self.new_conversation()
-            session.close()
-            session = get_session()
         if message.endswith("\n"):
             message = message[:-1]
         if message.endswith("\n"):
             message = message[:-1]
-        try:
-            new_message = Message(
-                role=role,
-                content=message,
-                conversation_id=conversation.id,
-                notify=notify,
-            )
-            # Update the conversation's updated_at timestamp
-            conversation.updated_at = func.now()
-        except Exception as e:
-            conversation = self.new_conversation()
-            session.close()
-            session = get_session()
-            new_message = Message(
-                role=role,
-                content=message,
-                conversation_id=conversation.id,
-                notify=notify,
-            )
-            # Update the conversation's updated_at timestamp
-            conversation.updated_at = func.now()
-
-        session.add(new_message)
-        session.commit()
+        # Written by the interaction log buffer, the id is valid right away
+        message_id = interaction_log.append(
+            conversation_id=conversation_id,
+            role=role,
+            content=message,
+            notify=notify,
+        )
 
         if role.lower() == "user":
             logging.info(f"{self.user}: {message}")
@@ -687,24 +1123,14 @@ class Conversations:
                 logging.error(f"{role}: {message}")
             else:
                 logging.info(f"{role}: {message}")
-        message_id = str(new_message.id)
-        session.close()
         return message_id
 
     def delete_conversation(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
+        user_id = self.get_user_id(session)
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             logging.info(f"No conversation found.")
             session.close()
@@ -718,20 +1144,13 @@ class Conversations:
         ).delete()
         session.commit()
         session.close()
+        interaction_log.forget(conversation.id)
+        history_cache.invalidate(conversation.id)
+        self.forget_conversation_id()
 
     def delete_message(self, message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
 
         if not conversation:
             logging.info(f"No conversation found.")
@@ -762,21 +1181,13 @@ class Conversations:
             return
         session.delete(message)
         session.commit()
+        interaction_log.forget(conversation.id)
+        history_cache.invalidate(conversation.id)
         session.close()
 
     def get_message_by_id(self, message_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
 
         if not conversation:
             logging.info(f"No conversation found.")
@@ -803,18 +1214,9 @@ class Conversations:
     def get_last_agent_name(self):
         # Get the last role in the conversation that isn't "user"
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return "AGiXT"
@@ -834,17 +1236,7 @@ class Conversations:
 
     def delete_message_by_id(self, message_id):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
 
         if not conversation:
             logging.info(f"No conversation found.")
@@ -867,20 +1259,13 @@ class Conversations:
             return
         session.delete(message)
         session.commit()
+        interaction_log.forget(conversation.id)
+        history_cache.invalidate(conversation.id)
         session.close()
 
     def toggle_feedback_received(self, message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             logging.info(f"No conversation found.")
             session.close()
@@ -913,16 +1298,7 @@ class Conversations:
 
     def has_received_feedback(self, message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             logging.info(f"No conversation found.")
             session.close()
@@ -955,16 +1331,7 @@ class Conversations:
 
     def update_message(self, message, new_message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             logging.info(f"No conversation found.")
             session.close()
@@ -992,21 +1359,15 @@ class Conversations:
             session.close()
             return
         message.content = new_message
+        message.kind = get_message_kind(new_message)
+        message.parent_activity_id = get_parent_activity_id(new_message)
+        history_cache.invalidate(conversation.id)
         session.commit()
         session.close()
 
     def update_message_by_id(self, message_id, new_message):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             logging.info(f"No conversation found.")
             session.close()
@@ -1026,75 +1387,57 @@ class Conversations:
             session.close()
             return
         message.content = new_message
+        message.kind = get_message_kind(new_message)
+        message.parent_activity_id = get_parent_activity_id(new_message)
+        history_cache.invalidate(conversation.id)
         session.commit()
         session.close()
 
+    def get_cached_conversation_id(self):
+        if self.resolved_conversation[0] == self.conversation_name:
+            return self.resolved_conversation[1]
+        return conversation_cache.get_conversation_id(self.user, self.conversation_name)
+
     def get_conversation_id(self):
         if not self.conversation_name:
-            conversation_name = "-"
-        else:
-            conversation_name = self.conversation_name
+            self.conversation_name = "-"
+        # Cached ids are not re-checked here: renames and deletes invalidate them,
+        # changes made by other workers expire with CONVERSATION_CACHE_TTL and
+        # writes that hit a deleted conversation forget its id
+        conversation_id = self.get_cached_conversation_id()
+        if conversation_id:
+            self.resolved_conversation = (self.conversation_name, conversation_id)
+            return conversation_id
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
-        if not conversation:
-            conversation = Conversation(name=conversation_name, user_id=user_id)
-            session.add(conversation)
-            session.commit()
+        conversation = self.get_conversation_row(session, create=True)
         conversation_id = str(conversation.id)
         session.close()
         return conversation_id
 
     def rename_conversation(self, new_name: str):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
-        if not conversation:
-            conversation = Conversation(name=self.conversation_name, user_id=user_id)
-            session.add(conversation)
-            session.commit()
+        conversation = self.get_conversation_row(session, create=True)
         conversation.name = new_name
         session.commit()
         session.close()
+        self.forget_conversation_id()
+        self.forget_conversation_id(new_name)
         return new_name
 
     def get_last_activity_id(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
         if not self.conversation_name:
             self.conversation_name = "-"
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return None
         last_activity = (
-            session.query(Message)
-            .filter(Message.conversation_id == conversation.id)
-            .filter(Message.content.like("[ACTIVITY]%"))
+            session.query(Message.id)
+            .filter(
+                Message.conversation_id == conversation.id,
+                Message.kind.in_(ACTIVITY_KINDS),
+            )
             .order_by(Message.timestamp.desc())
             .first()
         )
@@ -1105,26 +1448,189 @@ class Conversations:
         session.close()
         return last_id
 
-    def set_conversation_summary(self, summary: str):
-        session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
+    async def get_user_id_async(self, session):
+        if self.user_id is None:
+            self.user_id = conversation_cache.get_user_id(self.user)
+        if self.user_id is None:
+            user_id = await session.scalar(
+                select(User.id).where(User.email == self.user).limit(1)
             )
-            .first()
+            if user_id is None:
+                raise AttributeError(f"User {self.user} not found")
+            self.user_id = str(user_id)
+            conversation_cache.set_user_id(self.user, self.user_id)
+        return self.user_id
+
+    async def get_conversation_row_async(self, session, create=False):
+        if not self.conversation_name:
+            self.conversation_name = "-"
+        user_id = await self.get_user_id_async(session)
+        conversation = None
+        conversation_id = self.get_cached_conversation_id()
+        if conversation_id:
+            conversation = await session.get(Conversation, conversation_id)
+            if (
+                conversation is None
+                or conversation.name != self.conversation_name
+                or str(conversation.user_id) != user_id
+            ):
+                self.forget_conversation_id()
+                conversation = None
+        if conversation is None:
+            conversation = await session.scalar(
+                select(Conversation)
+                .where(
+                    Conversation.name == self.conversation_name,
+                    Conversation.user_id == user_id,
+                )
+                .limit(1)
+            )
+            if not conversation and create:
+                conversation = Conversation(
+                    name=self.conversation_name, user_id=user_id
+                )
+                session.add(conversation)
+                await session.commit()
+            if conversation:
+                self.remember_conversation_id(conversation.id)
+        if conversation is not None and interaction_log.has_pending(conversation.id):
+            await interaction_log.flush_async()
+        return user_id, conversation
+
+    async def get_conversation_id_async(self):
+        if not self.conversation_name:
+            self.conversation_name = "-"
+        conversation_id = self.get_cached_conversation_id()
+        if conversation_id:
+            self.resolved_conversation = (self.conversation_name, conversation_id)
+            return conversation_id
+        async with get_async_session() as session:
+            _, conversation = await self.get_conversation_row_async(
+                session, create=True
+            )
+            return str(conversation.id)
+
+    async def get_conversation_async(self, limit=100, page=1, cursor=None):
+        async with get_async_session() as session:
+            user_id, conversation = await self.get_conversation_row_async(
+                session, create=True
+            )
+            # Mark all notifications as read for this conversation
+            await session.execute(
+                update(Message)
+                .where(
+                    Message.conversation_id == conversation.id, Message.notify == True
+                )
+                .values(notify=False)
+            )
+            await session.commit()
+            messages = (
+                await session.scalars(
+                    get_messages_query(
+                        conversation.id, limit=limit, page=page, cursor=cursor
+                    )
+                )
+            ).all()
+        if not messages:
+            return {"interactions": [], "next_cursor": None}
+        timezone = await get_user_timezone_async(user_id)
+        timestamps = convert_times(
+            [message.timestamp for message in messages],
+            user_id=user_id,
+            timezone=timezone,
+        )
+        updated = convert_times(
+            [message.updated_at for message in messages],
+            user_id=user_id,
+            timezone=timezone,
+        )
+        return_messages = []
+        for message, timestamp, updated_at in zip(messages, timestamps, updated):
+            msg = {
+                "id": message.id,
+                "role": message.role,
+                "message": message.content,
+                "timestamp": timestamp,
+                "updated_at": updated_at,
+                "updated_by": message.updated_by,
+                "feedback_received": message.feedback_received,
+            }
+            return_messages.append(msg)
+        return {
+            "interactions": return_messages,
+            "next_cursor": get_next_cursor(messages, limit),
+        }
+
+    async def get_last_activity_id_async(self):
+        async with get_async_session() as session:
+            _, conversation = await self.get_conversation_row_async(session)
+            if not conversation:
+                return None
+            last_id = await session.scalar(
+                select(Message.id)
+                .where(
+                    Message.conversation_id == conversation.id,
+                    Message.kind.in_(ACTIVITY_KINDS),
+                )
+                .order_by(Message.timestamp.desc())
+                .limit(1)
+            )
+        return last_id
+
+    async def log_interaction_async(self, role, message):
+        message = str(message)
+        conversation_id = await self.get_conversation_id_async()
+        if message.startswith("[SUBACTIVITY] "):
+            try:
+                async with get_async_session() as session:
+                    row = (
+                        await session.execute(newest_activity_query(conversation_id))
+                    ).first()
+                last_activity = pick_newest_activity(conversation_id, row)
+                last_activity_id = last_activity[0] if last_activity else None
+            except:
+                last_activity_id = None
+            if last_activity_id:
+                message = message.replace(
+                    "[SUBACTIVITY] ", f"[SUBACTIVITY][{last_activity_id}] "
+                )
+            else:
+                message = message.replace("[SUBACTIVITY] ", "[ACTIVITY] ")
+        notify = False
+        if role.lower() == "user":
+            role = "USER"
+        else:
+            if not message.startswith("[ACTIVITY]") and not message.startswith(
+                "[SUBACTIVITY]"
+            ):
+                notify = True
+        if message.endswith("\n"):
+            message = message[:-1]
+        if message.endswith("\n"):
+            message = message[:-1]
+        message_id = interaction_log.append(
+            conversation_id=conversation_id,
+            role=role,
+            content=message,
+            notify=notify,
         )
+        if role.lower() == "user":
+            logging.info(f"{self.user}: {message}")
+        else:
+            if "[WARN]" in message:
+                logging.warning(f"{role}: {message}")
+            elif "[ERROR]" in message:
+                logging.error(f"{role}: {message}")
+            else:
+                logging.info(f"{role}: {message}")
+        return message_id
+
+    def set_conversation_summary(self, summary: str):
+        session = get_session()
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return ""
-        conversation = (
-            session.query(Conversation)
-            .filter(Conversation.id == conversation.id)
-            .first()
-        )
         conversation.summary = summary
         session.commit()
         session.close()
@@ -1132,16 +1638,7 @@ class Conversations:
 
     def get_conversation_summary(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return ""
@@ -1151,16 +1648,7 @@ class Conversations:
 
     def get_attachment_count(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return 0
@@ -1170,24 +1658,10 @@ class Conversations:
 
     def update_attachment_count(self, count: int):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return 0
-        conversation = (
-            session.query(Conversation)
-            .filter(Conversation.id == conversation.id)
-            .first()
-        )
         conversation.attachment_count = count
         session.commit()
         session.close()
@@ -1195,24 +1669,10 @@ class Conversations:
 
     def increment_attachment_count(self):
         session = get_session()
-        user_data = session.query(User).filter(User.email == self.user).first()
-        user_id = user_data.id
-        conversation = (
-            session.query(Conversation)
-            .filter(
-                Conversation.name == self.conversation_name,
-                Conversation.user_id == user_id,
-            )
-            .first()
-        )
+        conversation = self.get_conversation_row(session)
         if not conversation:
             session.close()
             return 0
-        conversation = (
-            session.query(Conversation)
-            .filter(Conversation.id == conversation.id)
-            .first()
-        )
         conversation.attachment_count += 1
         session.commit()
         session.close()
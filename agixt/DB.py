@@ -1,26 +1,44 @@
+import sys
+import json
 import uuid
 import time
+import asyncio
 import logging
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
 from sqlalchemy import (
     create_engine,
     Column,
     Text,
     String,
     Integer,
+    BigInteger,
     ForeignKey,
+    Date,
     DateTime,
     Boolean,
+    Index,
     event,
     or_,
+    and_,
     func,
     text,
+    select,
+    literal,
+    union_all,
+    bindparam,
 )
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.types import TypeDecorator, VARCHAR
 from sqlalchemy.sql.sqltypes import ARRAY, Float
 from cryptography.fernet import Fernet
 from Globals import getenv
+from VectorIndex import vector_index
 import numpy as np
 
 logging.basicConfig(
@@ -28,6 +46,27 @@ logging.basicConfig(
     format=getenv("LOG_FORMAT"),
 )
 DEFAULT_USER = getenv("DEFAULT_USER")
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records how long connection checkouts take"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = {"checkouts": 0, "total_ms": 0.0, "max_ms": 0.0}
+        self.checkout_stats_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        connection = super()._do_get()
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.checkout_stats_lock:
+            self.checkout_stats["checkouts"] += 1
+            self.checkout_stats["total_ms"] += elapsed
+            self.checkout_stats["max_ms"] = max(self.checkout_stats["max_ms"], elapsed)
+        return connection
+
+
 try:
     DATABASE_TYPE = getenv("DATABASE_TYPE")
     DATABASE_NAME = getenv("DATABASE_NAME")
@@ -38,27 +77,271 @@ try:
         DATABASE_PORT = getenv("DATABASE_PORT")
         LOGIN_URI = f"{DATABASE_USER}:{DATABASE_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{DATABASE_NAME}"
         DATABASE_URI = f"postgresql://{LOGIN_URI}"
+        ASYNC_DATABASE_URI = f"postgresql+asyncpg://{LOGIN_URI}"
     else:
         DATABASE_URI = f"sqlite:///{DATABASE_NAME}.db"
-    engine = create_engine(DATABASE_URI, pool_size=40, max_overflow=-1)
+        ASYNC_DATABASE_URI = f"sqlite+aiosqlite:///{DATABASE_NAME}.db"
+    engine = create_engine(
+        DATABASE_URI,
+        pool_size=40,
+        max_overflow=-1,
+        poolclass=InstrumentedQueuePool,
+    )
     connection = engine.connect()
     Base = declarative_base()
 except Exception as e:
     logging.error(f"Error connecting to database: {e}")
     Base = None
     engine = None
+try:
+    # Used by coroutines so queries never block the event loop
+    async_engine = (
+        create_async_engine(ASYNC_DATABASE_URI, pool_size=20, max_overflow=-1)
+        if DATABASE_TYPE != "sqlite"
+        else create_async_engine(ASYNC_DATABASE_URI)
+    )
+except Exception as e:
+    logging.error(f"Error creating async database engine: {e}")
+    async_engine = None
+
+EMBEDDING_DIMENSIONS = 384
+USE_PGVECTOR = (
+    DATABASE_TYPE != "sqlite" and str(getenv("USE_PGVECTOR")).lower() == "true"
+)
+if USE_PGVECTOR:
+    from pgvector.sqlalchemy import Vector as PGVector
+
+
+SessionLocal = sessionmaker(bind=engine, autoflush=False)
+request_session_scope_var = ContextVar("request_session_scope", default=None)
+session_scope_stats = {"requests": 0, "shared_sessions": 0, "leaked_sessions": 0}
+session_scope_stats_lock = threading.Lock()
+
+
+class ScopedSession:
+    """
+    Handle on a request's shared session.
+
+    Closing a handle only releases it, the underlying session is closed once the
+    last handle opened during the request is closed (or when the request ends).
+    """
+
+    def __init__(self, scope):
+        self._scope = scope
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._scope.session, name)
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._scope.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RequestSessionScope:
+    """
+    Unit of work for one request.
+
+    Every get_session() call made by the request's own task shares one session,
+    so nested helpers reuse the caller's session and connection instead of
+    opening their own. Other tasks and threads spawned by the request (which may
+    outlive it) get independent sessions as before.
+    """
+
+    def __init__(self):
+        try:
+            self.owner = asyncio.current_task()
+        except RuntimeError:
+            self.owner = None
+        self.thread_id = threading.get_ident()
+        self.session = None
+        self.depth = 0
+        self.closed = False
+
+    def owns_caller(self):
+        if self.closed or threading.get_ident() != self.thread_id:
+            return False
+        try:
+            return asyncio.current_task() is self.owner
+        except RuntimeError:
+            return self.owner is None
+
+    def acquire(self):
+        if self.session is None:
+            self.session = SessionLocal()
+        self.depth += 1
+        with session_scope_stats_lock:
+            session_scope_stats["shared_sessions"] += 1
+        return ScopedSession(self)
+
+    def release(self):
+        # A helper that hit a flush error and closed without rolling back would
+        # otherwise leave the caller's session unusable (PendingRollback)
+        if not self.session.is_active:
+            self.session.rollback()
+        self.depth -= 1
+        if self.depth <= 0:
+            self.depth = 0
+            self.session.close()
+
+    def close(self):
+        self.closed = True
+        if self.session is None:
+            return
+        if self.depth > 0:
+            # Sessions opened during the request and never closed
+            with session_scope_stats_lock:
+                session_scope_stats["leaked_sessions"] += self.depth
+            logging.debug(f"Closing {self.depth} leaked database session(s)")
+            self.depth = 0
+        self.session.close()
+
+
+@contextmanager
+def request_session_scope():
+    scope = RequestSessionScope()
+    token = request_session_scope_var.set(scope)
+    with session_scope_stats_lock:
+        session_scope_stats["requests"] += 1
+    try:
+        yield scope
+    finally:
+        request_session_scope_var.reset(token)
+        scope.close()
+
+
+class RequestSessionMiddleware:
+    """ASGI middleware giving every HTTP request its own session scope"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Websocket subscriptions live for hours, they keep per-call sessions
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with request_session_scope():
+            await self.app(scope, receive, send)
+
+
+class ThreadedAsyncSession:
+    """
+    AsyncSession stand-in used when the async driver (asyncpg or aiosqlite) is
+    not installed. Each call runs on the synchronous session in a worker thread,
+    so coroutines still never block the event loop.
+    """
+
+    def __init__(self):
+        self.session = SessionLocal(expire_on_commit=False)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    async def _run(self, method, *args, **kwargs):
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._run(self.session.execute, *args, **kwargs)
+
+    async def scalar(self, *args, **kwargs):
+        return await self._run(self.session.scalar, *args, **kwargs)
+
+    async def scalars(self, *args, **kwargs):
+        return await self._run(self.session.scalars, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._run(self.session.get, *args, **kwargs)
+
+    async def delete(self, instance):
+        return await self._run(self.session.delete, instance)
+
+    async def flush(self, *args, **kwargs):
+        return await self._run(self.session.flush, *args, **kwargs)
+
+    async def refresh(self, *args, **kwargs):
+        return await self._run(self.session.refresh, *args, **kwargs)
+
+    async def commit(self):
+        return await self._run(self.session.commit)
+
+    async def rollback(self):
+        return await self._run(self.session.rollback)
+
+    async def close(self):
+        return await self._run(self.session.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+if async_engine is not None:
+    AsyncSessionLocal = async_sessionmaker(
+        async_engine, autoflush=False, expire_on_commit=False
+    )
+else:
+    logging.warning(
+        "Async database driver unavailable, install asyncpg (PostgreSQL) or aiosqlite (SQLite). Async queries will run on the synchronous engine in worker threads."
+    )
+    AsyncSessionLocal = ThreadedAsyncSession
+
+
+def get_async_session() -> AsyncSession:
+    """New AsyncSession, use as `async with get_async_session() as session:`"""
+    return AsyncSessionLocal()
 
 
 def get_session():
-    Session = sessionmaker(bind=engine, autoflush=False)
-    session = Session()
-    return session
+    scope = request_session_scope_var.get()
+    if scope is not None and scope.owns_caller():
+        return scope.acquire()
+    return SessionLocal()
+
+
+def get_pool_stats():
+    """Connection pool and session scope counters for the health endpoint"""
+    with session_scope_stats_lock:
+        stats = {"sessions": dict(session_scope_stats)}
+    pool = engine.pool if engine is not None else None
+    if pool is None:
+        return stats
+    stats["pool"] = {
+        "size": pool.size() if hasattr(pool, "size") else None,
+        "checked_in": pool.checkedin() if hasattr(pool, "checkedin") else None,
+        "in_use": pool.checkedout() if hasattr(pool, "checkedout") else None,
+        # QueuePool counts overflow from -pool_size, only connections past it matter
+        "overflow": max(pool.overflow(), 0) if hasattr(pool, "overflow") else None,
+    }
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool.checkout_stats_lock:
+            checkout_stats = dict(pool.checkout_stats)
+        checkouts = checkout_stats["checkouts"]
+        stats["pool"]["checkouts"] = checkouts
+        stats["pool"]["checkout_avg_ms"] = round(
+            checkout_stats["total_ms"] / checkouts if checkouts else 0.0, 3
+        )
+        stats["pool"]["checkout_max_ms"] = round(checkout_stats["max_ms"], 3)
+    return stats
 
 
 def get_new_id():
     return str(uuid.uuid4())
 
 
+def get_new_row_id():
+    """Primary key value in the column type used by the configured database"""
+    return get_new_id() if DATABASE_TYPE == "sqlite" else uuid.uuid4()
+
+
 class UserRole(Base):
     __tablename__ = "Role"
     id = Column(Integer, primary_key=True)
@@ -174,6 +457,41 @@ class UserPreferences(Base):
     pref_value = Column(String, nullable=True)
 
 
+class TokenUsage(Base):
+    """Token counters per user, agent and UTC day, only ever incremented in place"""
+
+    __tablename__ = "token_usage"
+    id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        primary_key=True,
+        default=get_new_id if DATABASE_TYPE == "sqlite" else uuid.uuid4,
+    )
+    user_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        ForeignKey("user.id"),
+        nullable=False,
+    )
+    # No foreign key, usage outlives deleted agents. None for usage that is
+    # not tied to an agent (and for totals migrated from UserPreferences).
+    agent_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        nullable=True,
+    )
+    usage_date = Column(Date, nullable=False)
+    input_tokens = Column(BigInteger, default=0, nullable=False)
+    output_tokens = Column(BigInteger, default=0, nullable=False)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    __table_args__ = (
+        Index(
+            "ix_token_usage_user_agent_date",
+            "user_id",
+            "agent_id",
+            "usage_date",
+            unique=True,
+        ),
+    )
+
+
 class UserOAuth(Base):
     __tablename__ = "user_oauth"
     id = Column(
@@ -334,6 +652,8 @@ class Agent(Base):
     )
     settings = relationship("AgentSetting", backref="agent")  # One-to-many relationship
     browsed_links = relationship("AgentBrowsedLink", backref="agent")
+    # Bumped on every config change so per-worker agent caches can tell they are stale
+    config_version = Column(Integer, nullable=True, default=0)
     user = relationship("User", backref="agent")
 
 
@@ -416,6 +736,50 @@ class Message(Base):
     )
     feedback_received = Column(Boolean, default=False)
     notify = Column(Boolean, default=False, nullable=False)
+    # "chat", "activity", "thinking" or "subactivity", see get_message_kind
+    kind = Column(String, nullable=True)
+    # The [ACTIVITY] message a [SUBACTIVITY][<id>] message belongs to
+    parent_activity_id = Column(
+        UUID(as_uuid=True) if DATABASE_TYPE != "sqlite" else String,
+        nullable=True,
+    )
+    __table_args__ = (
+        Index("ix_message_conversation_kind", "conversation_id", "kind", "timestamp"),
+        Index("ix_message_parent_activity", "parent_activity_id"),
+        # Keyset pagination and exports walk (timestamp, id) per conversation
+        Index(
+            "ix_message_conversation_timestamp", "conversation_id", "timestamp", "id"
+        ),
+    )
+
+
+THINKING_ACTIVITY = "[ACTIVITY] Thinking."
+# Kinds matched by the legacy content.like("[ACTIVITY]%") lookups
+ACTIVITY_KINDS = ["activity", "thinking"]
+
+
+def get_message_kind(content) -> str:
+    content = str(content)
+    if content == THINKING_ACTIVITY:
+        return "thinking"
+    if content.startswith("[ACTIVITY]"):
+        return "activity"
+    if content.startswith("[SUBACTIVITY]"):
+        return "subactivity"
+    return "chat"
+
+
+def get_parent_activity_id(content):
+    """Activity id of a "[SUBACTIVITY][<id>] ..." message, None for anything else"""
+    content = str(content)
+    if not content.startswith("[SUBACTIVITY]["):
+        return None
+    try:
+        parent_id = uuid.UUID(content[len("[SUBACTIVITY][") :].split("]", 1)[0])
+    except ValueError:
+        # "[SUBACTIVITY][ERROR] ..." and other tags without a parent
+        return None
+    return str(parent_id) if DATABASE_TYPE == "sqlite" else parent_id
 
 
 class Setting(Base):
@@ -720,10 +1084,49 @@ class Prompt(Base):
     arguments = relationship("Argument", backref="prompt", cascade="all, delete-orphan")
 
 
-class Vector(TypeDecorator):
-    """Unified vector storage for both SQLite and PostgreSQL"""
+# BLOB layout: one format byte followed by the little-endian components
+EMBEDDING_FORMATS = {"float32": b"f", "float16": b"e", "int8": b"b"}
+
 
-    impl = VARCHAR if DATABASE_TYPE == "sqlite" else ARRAY(Float)
+def encode_embedding(value, encoding: str = None) -> bytes:
+    """Pack an embedding into a compact little-endian BLOB (float32, float16 or int8)"""
+    encoding = str(encoding or getenv("SQLITE_VECTOR_ENCODING")).lower()
+    if encoding not in EMBEDDING_FORMATS:
+        encoding = "float32"
+    vector = np.asarray(value, dtype=np.float32).reshape(-1)
+    if encoding == "float16":
+        data = vector.astype("<f2").tobytes()
+    elif encoding == "int8":
+        # Embeddings are unit vectors, so a fixed scale keeps every component in range.
+        data = np.clip(np.round(vector * 127), -127, 127).astype(np.int8).tobytes()
+    else:
+        data = vector.astype("<f4").tobytes()
+    return EMBEDDING_FORMATS[encoding] + data
+
+
+def decode_embedding(value) -> np.ndarray:
+    """Unpack a BLOB written by encode_embedding, float32 rows are read without copying"""
+    tag = bytes(value[:1])
+    if tag == EMBEDDING_FORMATS["float16"]:
+        return np.frombuffer(value, dtype="<f2", offset=1).astype(np.float32)
+    if tag == EMBEDDING_FORMATS["int8"]:
+        return np.frombuffer(value, dtype=np.int8, offset=1).astype(np.float32) / 127.0
+    if tag == EMBEDDING_FORMATS["float32"]:
+        return np.frombuffer(value, dtype="<f4", offset=1)
+    raise ValueError(f"Unknown embedding format {tag!r}")
+
+
+class Vector(TypeDecorator):
+    """Unified vector storage for SQLite, PostgreSQL arrays and pgvector"""
+
+    # SQLite stores BLOBs as-is under any declared column type, so existing
+    # VARCHAR columns hold the binary encoding without a schema change.
+    if DATABASE_TYPE == "sqlite":
+        impl = VARCHAR
+    elif USE_PGVECTOR:
+        impl = PGVector(EMBEDDING_DIMENSIONS)
+    else:
+        impl = ARRAY(Float)
     cache_ok = True
 
     def process_bind_param(self, value, dialect):
@@ -731,6 +1134,10 @@ class Vector(TypeDecorator):
         if value is None:
             return None
 
+        # For SQLite, store as a binary BLOB
+        if DATABASE_TYPE == "sqlite":
+            return encode_embedding(value)
+
         # Convert to numpy array and ensure 1D
         if isinstance(value, np.ndarray):
             value = value.reshape(-1).tolist()
@@ -738,10 +1145,6 @@ class Vector(TypeDecorator):
             # Handle nested lists
             value = np.array(value).reshape(-1).tolist()
 
-        # For SQLite, store as string representation
-        if DATABASE_TYPE == "sqlite":
-            return f'[{",".join(map(str, value))}]'
-
         # For PostgreSQL, return as list
         return value
 
@@ -750,10 +1153,15 @@ class Vector(TypeDecorator):
         if value is None:
             return None
 
-        # For SQLite, parse string representation
         if DATABASE_TYPE == "sqlite":
+            if isinstance(value, (bytes, memoryview)):
+                try:
+                    return decode_embedding(value)
+                except ValueError:
+                    return None
+            # Rows written before the binary encoding are JSON-style text
             try:
-                value = eval(value)
+                value = json.loads(value)
             except:
                 return None
 
@@ -808,6 +1216,28 @@ class Memory(Base):
         super().__init__(**kwargs)
 
 
+@event.listens_for(Memory.__table__, "before_create")
+def setup_vector_extension(target, connection, **kw):
+    if USE_PGVECTOR:
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+
+
+def create_pgvector_index(connection):
+    """Create the approximate nearest neighbour index on memory.embedding"""
+    index_type = str(getenv("PGVECTOR_INDEX")).lower()
+    if index_type == "ivfflat":
+        index_sql = """
+            CREATE INDEX IF NOT EXISTS memory_embedding_ivfflat_idx
+            ON memory USING ivfflat (embedding vector_cosine_ops) WITH (lists = 100);
+        """
+    else:
+        index_sql = """
+            CREATE INDEX IF NOT EXISTS memory_embedding_hnsw_idx
+            ON memory USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+        """
+    connection.execute(text(index_sql))
+
+
 @event.listens_for(Memory.__table__, "after_create")
 def setup_vector_column(target, connection, **kw):
     try:
@@ -820,6 +1250,8 @@ def setup_vector_column(target, connection, **kw):
                 """
             )
         )
+        if USE_PGVECTOR:
+            create_pgvector_index(connection)
     except Exception as e:
         logging.error(f"Error setting up memory indices: {e}")
 
@@ -862,43 +1294,354 @@ def calculate_vector_similarity(query_embedding, stored_embedding):
         return 0.0
 
 
-# Update the memory search query for both databases:
-def get_similar_memories(
-    session, query_embedding, agent_id, conversation_id, limit, min_score
-):
-    """Get similar memories using basic SQL and Python-based similarity calculation"""
-    try:
-        # Get all potentially relevant memories
-        memories = (
-            session.query(Memory)
-            .filter(
-                Memory.agent_id == agent_id,
+def memory_collection_filter(agent_id, conversation_id):
+    return (
+        Memory.agent_id == agent_id,
+        (
+            Memory.conversation_id == None
+            if conversation_id is None
+            else Memory.conversation_id == conversation_id
+        ),
+    )
+
+
+def memory_scope_keys(agent_id, conversation_id):
+    """Collections a search covers, core memories plus the conversation's own"""
+    keys = [(str(agent_id), None)]
+    if conversation_id is not None:
+        keys.append((str(agent_id), str(conversation_id)))
+    return keys
+
+
+def get_memory_fingerprints(session, keys):
+    """Row count and latest timestamp of each memory collection, used to detect stale indexes"""
+    rows = (
+        session.query(
+            Memory.agent_id,
+            Memory.conversation_id,
+            func.count(Memory.id),
+            func.max(Memory.timestamp),
+        )
+        .filter(
+            or_(
+                *[
+                    and_(*memory_collection_filter(agent_id, conversation_id))
+                    for agent_id, conversation_id in keys
+                ]
+            )
+        )
+        .group_by(Memory.agent_id, Memory.conversation_id)
+        .all()
+    )
+    fingerprints = {key: (0, None) for key in keys}
+    for agent_id, conversation_id, count, latest in rows:
+        key = (
+            str(agent_id),
+            str(conversation_id) if conversation_id is not None else None,
+        )
+        fingerprints[key] = (int(count or 0), latest)
+    return fingerprints
+
+
+class MemoryRecord:
+    """Detached, read-only copy of a Memory row kept alongside the vector index"""
+
+    __slots__ = (
+        "id",
+        "text",
+        "external_source",
+        "description",
+        "additional_metadata",
+        "timestamp",
+        "embedding",
+    )
+
+    def __init__(self, **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, kwargs.get(field))
+
+    @classmethod
+    def from_row(cls, row, embedding=None):
+        return cls(
+            id=str(row.id),
+            text=row.text,
+            external_source=row.external_source,
+            description=row.description,
+            additional_metadata=row.additional_metadata,
+            timestamp=row.timestamp,
+            embedding=embedding,
+        )
+
+    def with_embedding(self, embedding):
+        record = MemoryRecord(**{f: getattr(self, f) for f in self.__slots__})
+        record.embedding = embedding
+        return record
+
+    @property
+    def nbytes(self):
+        return sum(
+            len(value) if isinstance(value, str) else 0
+            for value in (
+                self.text,
+                self.external_source,
+                self.description,
+                self.additional_metadata,
+            )
+        )
+
+
+def load_memory_vectors(session, agent_id, conversation_id):
+    """Load embeddings and row metadata of a memory collection for index building"""
+    rows = (
+        session.query(
+            Memory.id,
+            Memory.embedding,
+            Memory.text,
+            Memory.external_source,
+            Memory.description,
+            Memory.additional_metadata,
+            Memory.timestamp,
+        )
+        .filter(*memory_collection_filter(agent_id, conversation_id))
+        .all()
+    )
+    ids = []
+    vectors = []
+    records = {}
+    for row in rows:
+        if row.embedding is None:
+            continue
+        ids.append(str(row.id))
+        vectors.append(np.asarray(row.embedding, dtype=np.float32).reshape(-1))
+        records[str(row.id)] = MemoryRecord.from_row(row)
+    if not vectors:
+        return ids, np.zeros((0, 0), dtype=np.float32), records
+    return ids, np.vstack(vectors), records
+
+
+def hydrate_indexed_hits(session, collections, hits):
+    """Turn (id, score) index hits into (MemoryRecord, score) using the record caches"""
+    if not hits:
+        return []
+    found = {}
+    for memory_id, _ in hits:
+        for collection in collections:
+            with collection.lock:
+                record = collection.records.get(memory_id)
+                if record is not None:
+                    found[memory_id] = record.with_embedding(
+                        collection.index.vector(memory_id)
+                    )
+                    break
+    missing = [memory_id for memory_id, _ in hits if memory_id not in found]
+    if missing:
+        # Rows appended by this worker since the collection was loaded
+        for mem in session.query(Memory).filter(Memory.id.in_(missing)).all():
+            record = MemoryRecord.from_row(mem)
+            found[record.id] = record.with_embedding(mem.embedding)
+            for collection in collections:
+                with collection.lock:
+                    if collection.index.vector(record.id) is not None:
+                        collection.records[record.id] = record
+                        collection.records_nbytes += record.nbytes
+    return [
+        (found[memory_id], score) for memory_id, score in hits if memory_id in found
+    ]
+
+
+def get_similar_memories_indexed(session, query_embedding, scopes):
+    """Top-k search through the per-worker vector index, rows come from its record cache"""
+    keys = []
+    for scope in scopes:
+        for key in memory_scope_keys(scope["agent_id"], scope["conversation_id"]):
+            if key not in keys:
+                keys.append(key)
+    # One round trip validates every collection the scopes touch
+    fingerprints = get_memory_fingerprints(session, keys)
+    collections = {}
+    for key in keys:
+        collections[key] = vector_index.get_collection(
+            agent_id=key[0],
+            conversation_id=key[1],
+            fingerprint=fingerprints[key],
+            loader=lambda key=key: load_memory_vectors(session, *key),
+        )
+    results = []
+    for scope in scopes:
+        scope_collections = [
+            collections[key]
+            for key in memory_scope_keys(scope["agent_id"], scope["conversation_id"])
+        ]
+        hits = vector_index.search(
+            collections=scope_collections,
+            query_embedding=query_embedding,
+            limit=scope["limit"],
+            min_score=scope["min_score"],
+        )
+        results.append(hydrate_indexed_hits(session, scope_collections, hits))
+    return results
+
+
+def get_similar_memories_pgvector(session, query_embedding, scopes):
+    """Let PostgreSQL rank memories by cosine distance so only the top-k rows are returned"""
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    distance = Memory.embedding.op("<=>", return_type=Float)(query_embedding)
+    ef_search = int(getenv("PGVECTOR_EF_SEARCH"))
+    limit = max(int(scope["limit"]) for scope in scopes)
+    if str(getenv("PGVECTOR_INDEX")).lower() == "ivfflat":
+        session.execute(text(f"SET LOCAL ivfflat.probes = {max(1, ef_search // 8)}"))
+    else:
+        session.execute(text(f"SET LOCAL hnsw.ef_search = {max(limit, ef_search)}"))
+    # Each scope keeps its own ORDER BY ... LIMIT, UNION ALL runs them in one statement
+    ranked = []
+    for position, scope in enumerate(scopes):
+        ranked.append(
+            select(
+                Memory.id.label("id"),
+                distance.label("distance"),
+                literal(position).label("scope"),
+            )
+            .where(
+                Memory.agent_id == scope["agent_id"],
+                Memory.embedding.isnot(None),
                 or_(
-                    Memory.conversation_id == conversation_id,
+                    Memory.conversation_id == scope["conversation_id"],
                     Memory.conversation_id == None,
                 ),
             )
-            .all()
+            .order_by(distance)
+            .limit(int(scope["limit"]))
+            .subquery()
         )
-
-        # Calculate similarities
-        memory_scores = [
-            (mem, calculate_vector_similarity(query_embedding, mem.embedding))
-            for mem in memories
-        ]
-
+    rows = session.execute(union_all(*[select(subquery) for subquery in ranked]))
+    rows = rows.all()
+    memories = {}
+    ids = list({row.id for row in rows})
+    if ids:
+        memories = {
+            mem.id: mem
+            for mem in session.query(Memory).filter(Memory.id.in_(ids)).all()
+        }
+    results = [[] for _ in scopes]
+    for row in rows:
+        score = 1 - float(row.distance)
+        if row.id in memories and score >= scopes[row.scope]["min_score"]:
+            results[row.scope].append((memories[row.id], score))
+    for scope_results in results:
+        scope_results.sort(key=lambda x: x[1], reverse=True)
+    return results
+
+
+def score_memories(memories, query_embedding):
+    """Cosine similarity of each memory against the query with one matrix-vector product"""
+    query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+    query_norm = np.linalg.norm(query_vector)
+    matching = [
+        mem
+        for mem in memories
+        if mem.embedding is not None and mem.embedding.size == query_vector.size
+    ]
+    memory_scores = [
+        (mem, calculate_vector_similarity(query_embedding, mem.embedding))
+        for mem in memories
+        if mem.embedding is None or mem.embedding.size != query_vector.size
+    ]
+    if matching and query_norm != 0:
+        matrix = np.vstack([mem.embedding for mem in matching]).astype(np.float32)
+        norms = np.linalg.norm(matrix, axis=1)
+        norms[norms == 0] = np.inf
+        scores = (matrix @ query_vector) / (norms * query_norm)
+        memory_scores += list(zip(matching, scores.astype(float).tolist()))
+    else:
+        memory_scores += [(mem, 0.0) for mem in matching]
+    return memory_scores
+
+
+def get_similar_memories_scan(session, query_embedding, scopes):
+    """Load every row the scopes cover in one query and score them all at once"""
+    keys = []
+    for scope in scopes:
+        for key in memory_scope_keys(scope["agent_id"], scope["conversation_id"]):
+            if key not in keys:
+                keys.append(key)
+    memories = (
+        session.query(Memory)
+        .filter(
+            or_(
+                *[
+                    and_(*memory_collection_filter(agent_id, conversation_id))
+                    for agent_id, conversation_id in keys
+                ]
+            )
+        )
+        .all()
+    )
+    by_collection = {}
+    for mem, score in score_memories(memories, query_embedding):
+        key = (
+            str(mem.agent_id),
+            str(mem.conversation_id) if mem.conversation_id is not None else None,
+        )
+        by_collection.setdefault(key, []).append((mem, score))
+    results = []
+    for scope in scopes:
         # Filter by minimum score and sort by similarity
         filtered_memories = [
-            (mem, score) for mem, score in memory_scores if score >= min_score
+            (mem, score)
+            for key in memory_scope_keys(scope["agent_id"], scope["conversation_id"])
+            for mem, score in by_collection.get(key, [])
+            if score >= scope["min_score"]
         ]
         filtered_memories.sort(key=lambda x: x[1], reverse=True)
+        results.append(filtered_memories[: int(scope["limit"])])
+    return results
 
-        # Return top N results
-        return filtered_memories[:limit]
 
+def get_similar_memories_for_scopes(session, query_embedding, scopes):
+    """
+    Search several memory scopes with a single query embedding.
+
+    Each scope is a dict with agent_id, conversation_id, limit and min_score, and
+    covers the agent's core memories plus the conversation's when one is given.
+    Returns one list of (memory, score) per scope, in the order of the scopes.
+    """
+    if not scopes:
+        return []
+    if USE_PGVECTOR:
+        try:
+            return get_similar_memories_pgvector(session, query_embedding, scopes)
+        except Exception as e:
+            session.rollback()
+            logging.warning(f"pgvector search failed, falling back to scan: {e}")
+    elif vector_index.enabled:
+        try:
+            return get_similar_memories_indexed(session, query_embedding, scopes)
+        except Exception as e:
+            logging.warning(f"Vector index search failed, falling back to scan: {e}")
+    try:
+        return get_similar_memories_scan(session, query_embedding, scopes)
     except Exception as e:
         logging.error(f"Error in memory search: {e}")
-        return []
+        return [[] for _ in scopes]
+
+
+# Update the memory search query for both databases:
+def get_similar_memories(
+    session, query_embedding, agent_id, conversation_id, limit, min_score
+):
+    """Get similar memories from pgvector or the vector index, falling back to a full scan with Python-based similarity"""
+    return get_similar_memories_for_scopes(
+        session,
+        query_embedding,
+        [
+            {
+                "agent_id": agent_id,
+                "conversation_id": conversation_id,
+                "limit": limit,
+                "min_score": min_score,
+            }
+        ],
+    )[0]
 
 
 def setup_default_roles():
@@ -969,7 +1712,372 @@ def migrate_company_agent_name():
         session.close()
 
 
+def migrate_agent_config_version():
+    """
+    Migration function to add config_version column to Agent table.
+    This should be run before the app starts.
+    """
+    try:
+        session = get_session()
+        connection = session.connection()
+        if DATABASE_TYPE != "sqlite":
+            exists_query = """
+                SELECT EXISTS (
+                    SELECT 1 
+                    FROM information_schema.columns 
+                    WHERE table_name='agent' AND column_name='config_version'
+                );
+            """
+        else:
+            exists_query = """
+                SELECT COUNT(*) 
+                FROM pragma_table_info('agent') 
+                WHERE name='config_version';
+            """
+        table_query = (
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='agent';"
+            if DATABASE_TYPE == "sqlite"
+            else "SELECT to_regclass('public.agent');"
+        )
+        if not connection.execute(text(table_query)).scalar():
+            return
+        column_exists = connection.execute(text(exists_query)).scalar()
+        if not column_exists:
+            connection.execute(
+                text("ALTER TABLE agent ADD COLUMN config_version INTEGER DEFAULT 0;")
+            )
+            session.commit()
+            logging.info("Successfully added config_version column to Agent table")
+    except Exception as e:
+        logging.error(f"Error during agent config_version migration: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def migrate_message_kind(batch_size: int = 1000):
+    """
+    Migration function to add the kind and parent_activity_id columns to Message,
+    index them (along with the (conversation_id, timestamp, id) pagination
+    index) and backfill existing rows from their content.
+    Only rows without a kind are touched, so it is cheap to run on every start.
+    """
+    migrated = 0
+    session = get_session()
+    try:
+        connection = session.connection()
+        table_query = (
+            "SELECT name FROM sqlite_master WHERE type='table' AND name='message';"
+            if DATABASE_TYPE == "sqlite"
+            else "SELECT to_regclass('public.message');"
+        )
+        if not connection.execute(text(table_query)).scalar():
+            return 0
+        if DATABASE_TYPE != "sqlite":
+            columns_query = """
+                SELECT column_name
+                FROM information_schema.columns
+                WHERE table_name='message';
+            """
+            parent_type = "UUID"
+        else:
+            columns_query = "SELECT name FROM pragma_table_info('message');"
+            parent_type = "VARCHAR"
+        columns = [row[0] for row in connection.execute(text(columns_query))]
+        if "kind" not in columns:
+            connection.execute(text("ALTER TABLE message ADD COLUMN kind VARCHAR;"))
+        if "parent_activity_id" not in columns:
+            connection.execute(
+                text(
+                    f"ALTER TABLE message ADD COLUMN parent_activity_id {parent_type};"
+                )
+            )
+        connection.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_message_conversation_kind "
+                "ON message (conversation_id, kind, timestamp);"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_message_parent_activity "
+                "ON message (parent_activity_id);"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS ix_message_conversation_timestamp "
+                "ON message (conversation_id, timestamp, id);"
+            )
+        )
+        session.commit()
+        while True:
+            rows = session.execute(
+                select(Message.id, Message.content)
+                .where(Message.kind == None)
+                .limit(batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            session.execute(
+                Message.__table__.update()
+                .where(Message.id == bindparam("message_id"))
+                .values(
+                    kind=bindparam("kind"),
+                    parent_activity_id=bindparam("parent_id"),
+                ),
+                [
+                    {
+                        "message_id": message_id,
+                        "kind": get_message_kind(content),
+                        "parent_id": get_parent_activity_id(content),
+                    }
+                    for message_id, content in rows
+                ],
+            )
+            session.commit()
+            migrated += len(rows)
+        if migrated:
+            logging.info(f"Backfilled message kind for {migrated} messages")
+    except Exception as e:
+        logging.error(f"Error during message kind migration: {e}")
+        session.rollback()
+    finally:
+        session.close()
+    return migrated
+
+
+def migrate_token_usage():
+    """
+    Migration function to move the input_tokens and output_tokens counters
+    from UserPreferences into the token_usage table. Each user's running total
+    becomes one row without an agent dated the day of the migration, and the
+    preference rows are removed in the same transaction so nothing is counted
+    twice.
+    """
+    migrated = 0
+    session = get_session()
+    try:
+        Base.metadata.create_all(engine, tables=[TokenUsage.__table__])
+        preferences = (
+            session.query(UserPreferences)
+            .filter(UserPreferences.pref_key.in_(["input_tokens", "output_tokens"]))
+            .all()
+        )
+        if not preferences:
+            return 0
+        totals = {}
+        for preference in preferences:
+            try:
+                value = int(preference.pref_value)
+            except (TypeError, ValueError):
+                value = 0
+            counts = totals.setdefault(str(preference.user_id), [0, 0])
+            counts[0 if preference.pref_key == "input_tokens" else 1] += value
+        usage_date = datetime.utcnow().date()
+        for user_id, (input_tokens, output_tokens) in totals.items():
+            if not input_tokens and not output_tokens:
+                continue
+            session.add(
+                TokenUsage(
+                    user_id=user_id,
+                    agent_id=None,
+                    usage_date=usage_date,
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens,
+                )
+            )
+            migrated += 1
+        for preference in preferences:
+            session.delete(preference)
+        session.commit()
+        if migrated:
+            logging.info(f"Migrated token usage counters for {migrated} users")
+    except Exception as e:
+        logging.error(f"Error during token usage migration: {e}")
+        session.rollback()
+    finally:
+        session.close()
+    return migrated
+
+
+def bump_agent_config_version(session, agent_id):
+    """Mark an agent's config as changed so every worker rebuilds its cached agent"""
+    session.query(Agent).filter(Agent.id == agent_id).update(
+        {Agent.config_version: func.coalesce(Agent.config_version, 0) + 1},
+        synchronize_session=False,
+    )
+
+
+def migrate_memory_embeddings_to_pgvector():
+    """
+    Migration function to convert memory.embedding from float arrays to pgvector.
+    This should be run before the app starts.
+    """
+    if not USE_PGVECTOR:
+        return
+    session = get_session()
+    try:
+        connection = session.connection()
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS vector;"))
+        column_type = connection.execute(
+            text(
+                """
+                SELECT udt_name
+                FROM information_schema.columns
+                WHERE table_name='memory' AND column_name='embedding';
+                """
+            )
+        ).scalar()
+        if column_type is None:
+            # Table does not exist yet, create_all will build it with pgvector.
+            session.commit()
+            return
+        if column_type != "vector":
+            logging.info("Migrating memory embeddings to pgvector...")
+            # Embeddings of another dimension cannot be cast. Keep a copy in
+            # memory_embedding_backup and clear them so the memories survive
+            # and can be re-embedded.
+            connection.execute(
+                text(
+                    """
+                    CREATE TABLE IF NOT EXISTS memory_embedding_backup AS
+                    SELECT id, embedding FROM memory WITH NO DATA;
+                    """
+                )
+            )
+            connection.execute(
+                text(
+                    f"""
+                    INSERT INTO memory_embedding_backup (id, embedding)
+                    SELECT id, embedding FROM memory
+                    WHERE embedding IS NOT NULL
+                    AND array_length(embedding, 1) != {EMBEDDING_DIMENSIONS};
+                    """
+                )
+            )
+            cleared = connection.execute(
+                text(
+                    f"""
+                    UPDATE memory SET embedding = NULL
+                    WHERE embedding IS NOT NULL
+                    AND array_length(embedding, 1) != {EMBEDDING_DIMENSIONS};
+                    """
+                )
+            ).rowcount
+            if cleared:
+                logging.warning(
+                    f"Cleared {cleared} memory embeddings that are not {EMBEDDING_DIMENSIONS}-dimensional, the originals are in memory_embedding_backup. Re-embed these memories to make them searchable again."
+                )
+            connection.execute(
+                text(
+                    f"""
+                    ALTER TABLE memory
+                    ALTER COLUMN embedding TYPE vector({EMBEDDING_DIMENSIONS})
+                    USING embedding::vector({EMBEDDING_DIMENSIONS});
+                    """
+                )
+            )
+            logging.info("Successfully migrated memory embeddings to pgvector")
+        create_pgvector_index(connection)
+        session.commit()
+    except Exception as e:
+        logging.error(f"Error during pgvector migration: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def migrate_sqlite_embeddings_to_binary(batch_size: int = 1000):
+    """
+    Migration function to re-encode text embeddings in SQLite as binary BLOBs.
+    Only rows still stored as text are touched, so it is cheap to run on every start.
+    """
+    if DATABASE_TYPE != "sqlite":
+        return 0
+    migrated = 0
+    session = get_session()
+    try:
+        table_exists = session.execute(
+            text("SELECT name FROM sqlite_master WHERE type='table' AND name='memory';")
+        ).scalar()
+        if not table_exists:
+            return 0
+        while True:
+            rows = session.execute(
+                text(
+                    "SELECT id, embedding FROM memory WHERE typeof(embedding) = 'text' LIMIT :limit;"
+                ),
+                {"limit": batch_size},
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for memory_id, embedding in rows:
+                try:
+                    updates.append(
+                        {
+                            "id": memory_id,
+                            "embedding": encode_embedding(json.loads(embedding)),
+                        }
+                    )
+                except Exception:
+                    # Unparseable embeddings are unsearchable, null them so they are not retried
+                    updates.append({"id": memory_id, "embedding": None})
+            session.execute(
+                text("UPDATE memory SET embedding = :embedding WHERE id = :id;"),
+                updates,
+            )
+            session.commit()
+            migrated += len(updates)
+        if migrated:
+            logging.info(f"Migrated {migrated} SQLite embeddings to binary encoding")
+    except Exception as e:
+        logging.error(f"Error during SQLite embedding migration: {e}")
+        session.rollback()
+    finally:
+        session.close()
+    return migrated
+
+
+def benchmark_embedding_decoding(rows: int = 10000):
+    """Compare per-row decode cost of the legacy text format against the binary formats"""
+    vectors = np.random.default_rng(0).normal(size=(rows, EMBEDDING_DIMENSIONS))
+    vectors = (vectors / np.linalg.norm(vectors, axis=1)[:, np.newaxis]).astype(
+        np.float32
+    )
+    legacy = [f'[{",".join(map(str, vector.tolist()))}]' for vector in vectors]
+    started = time.perf_counter()
+    for value in legacy:
+        np.array(eval(value)).reshape(-1)
+    results = {
+        "text_eval": {
+            "us_per_row": (time.perf_counter() - started) / rows * 1e6,
+            "bytes_per_row": sum(len(v) for v in legacy) / rows,
+        }
+    }
+    for encoding in ["float32", "float16", "int8"]:
+        blobs = [encode_embedding(vector, encoding) for vector in vectors]
+        started = time.perf_counter()
+        for value in blobs:
+            decode_embedding(value)
+        results[encoding] = {
+            "us_per_row": (time.perf_counter() - started) / rows * 1e6,
+            "bytes_per_row": len(blobs[0]),
+        }
+    return results
+
+
 if __name__ == "__main__":
+    if "--benchmark-embeddings" in sys.argv:
+        for name, result in benchmark_embedding_decoding().items():
+            print(
+                f"{name:>9}: {result['us_per_row']:8.2f} us/row, {result['bytes_per_row']:8.0f} bytes/row"
+            )
+        sys.exit(0)
+    if "--migrate-embeddings" in sys.argv:
+        migrate_sqlite_embeddings_to_binary()
+        sys.exit(0)
     import uvicorn
 
     if DATABASE_TYPE != "sqlite":
@@ -985,6 +2093,11 @@ if __name__ == "__main__":
     # Create any missing tables
     try:
         migrate_company_agent_name()
+        migrate_agent_config_version()
+        migrate_message_kind()
+        migrate_token_usage()
+        migrate_memory_embeddings_to_pgvector()
+        migrate_sqlite_embeddings_to_binary()
     except Exception as e:
         logging.error(f"Error during migration: {e}")
     Base.metadata.create_all(engine)
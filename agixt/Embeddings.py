@@ -0,0 +1,152 @@
+import os
+import logging
+import threading
+import numpy as np
+from typing import List, cast, Union, Sequence
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+# Borrowed ONNX MiniLM embedder from ChromaDB <3 https://github.com/chroma-core/chroma
+# Moved to a minimal implementation with a single model load per worker.
+class EmbeddingEngine:
+    """
+    Thread-safe ONNX embedding engine.
+
+    The tokenizer and inference session are loaded lazily on first use and then
+    shared by every caller in the worker process.
+    """
+
+    def __init__(
+        self,
+        model_directory: str = None,
+        max_length: int = 256,
+        batch_size: int = None,
+        intra_op_threads: int = None,
+        inter_op_threads: int = None,
+    ):
+        self.model_directory = (
+            model_directory if model_directory else os.path.join(os.getcwd(), "onnx")
+        )
+        self.max_length = max_length
+        self.batch_size = (
+            int(batch_size) if batch_size else int(getenv("EMBEDDING_BATCH_SIZE"))
+        )
+        self.intra_op_threads = (
+            int(intra_op_threads)
+            if intra_op_threads is not None
+            else int(getenv("EMBEDDING_INTRA_OP_THREADS"))
+        )
+        self.inter_op_threads = (
+            int(inter_op_threads)
+            if inter_op_threads is not None
+            else int(getenv("EMBEDDING_INTER_OP_THREADS"))
+        )
+        self.tokenizer = None
+        self.model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self.model is not None:
+            return
+        with self._lock:
+            if self.model is not None:
+                return
+            from onnxruntime import InferenceSession, SessionOptions
+            from tokenizers import Tokenizer
+
+            tokenizer = Tokenizer.from_file(
+                os.path.join(self.model_directory, "tokenizer.json")
+            )
+            tokenizer.enable_truncation(max_length=self.max_length)
+            # No fixed length, each batch is padded to its longest sequence.
+            tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+            options = SessionOptions()
+            if self.intra_op_threads > 0:
+                options.intra_op_num_threads = self.intra_op_threads
+            if self.inter_op_threads > 0:
+                options.inter_op_num_threads = self.inter_op_threads
+            model = InferenceSession(
+                os.path.join(self.model_directory, "model.onnx"),
+                sess_options=options,
+                providers=["CPUExecutionProvider"],
+            )
+            self.tokenizer = tokenizer
+            self.model = model
+            logging.info(
+                f"Loaded embedding model from {self.model_directory} "
+                f"(intra_op_threads={self.intra_op_threads}, inter_op_threads={self.inter_op_threads})"
+            )
+
+    def warmup(self):
+        try:
+            self.embed(["warmup"])
+            return True
+        except Exception as e:
+            logging.warning(f"Unable to warm up embedding model: {e}")
+            return False
+
+    def embed_array(self, input: List[str]) -> np.ndarray:
+        """Embed a list of strings, returns a float32 matrix of unit vectors."""
+        self.load()
+        if isinstance(input, str):
+            input = [input]
+        if not input:
+            return np.zeros((0, 0), dtype=np.float32)
+        all_embeddings = []
+        for i in range(0, len(input), self.batch_size):
+            batch = input[i : i + self.batch_size]
+            encoded = self.tokenizer.encode_batch(batch)
+            input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+            attention_mask = np.array(
+                [e.attention_mask for e in encoded], dtype=np.int64
+            )
+            onnx_input = {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "token_type_ids": np.zeros_like(input_ids),
+            }
+            model_output = self.model.run(None, onnx_input)
+            last_hidden_state = model_output[0]
+            input_mask_expanded = np.broadcast_to(
+                np.expand_dims(attention_mask, -1), last_hidden_state.shape
+            )
+            embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
+                input_mask_expanded.sum(1), a_min=1e-9, a_max=None
+            )
+            norm = np.linalg.norm(embeddings, axis=1)
+            norm[norm == 0] = 1e-12
+            embeddings = (embeddings / norm[:, np.newaxis]).astype(np.float32)
+            all_embeddings.append(embeddings)
+        return np.concatenate(all_embeddings)
+
+    def embed(self, input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
+        return cast(
+            List[Union[Sequence[float], Sequence[int]]], self.embed_array(input)
+        ).tolist()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_embedding_engine() -> EmbeddingEngine:
+    """Returns the embedding engine shared by this worker process."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = EmbeddingEngine()
+    return _engine
+
+
+def embed(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
+    return get_embedding_engine().embed(input)
+
+
+def warmup_embeddings():
+    return get_embedding_engine().warmup()
@@ -1,4 +1,5 @@
 import importlib
+import copy
 import os
 import glob
 from inspect import signature, Parameter
@@ -68,6 +69,21 @@ class Extensions:
         self.commands = self.load_commands()
         self.available_commands = self.get_available_commands()
 
+    def with_client(self, ApiClient=None, api_key=None, agent_config=None):
+        """Copy sharing the loaded chains and commands, bound to another request"""
+        extensions = copy.copy(self)
+        extensions.ApiClient = ApiClient
+        extensions.api_key = api_key
+        if agent_config is not None:
+            extensions.agent_config = agent_config
+        # Chains run through execute_chain of the instance that loaded them
+        extensions.commands = []
+        for name, module, function_name, params in self.commands:
+            if not isinstance(module, type):
+                module = extensions.execute_chain
+            extensions.commands.append((name, module, function_name, params))
+        return extensions
+
     async def execute_chain(self, chain_name, user_input="", **kwargs):
         return self.ApiClient.run_chain(
             agent_name=self.agent_name,
@@ -1,5 +1,6 @@
 import os
 import json
+import functools
 import tiktoken
 from dotenv import load_dotenv
 
@@ -38,6 +39,42 @@ def getenv(var_name: str, default_value: str = "") -> str:
         "CREATE_AGIXT_AGENT": "true",
         "SEED_DATA": "true",
         "GRAPHIQL": "true",
+        "EMBEDDING_BATCH_SIZE": "32",
+        "EMBEDDING_INTRA_OP_THREADS": "0",
+        "EMBEDDING_INTER_OP_THREADS": "0",
+        "EMBEDDING_WARMUP": "true",
+        "EMBEDDING_INGEST_BATCHES": "8",
+        "NLP_WINDOW_SIZE": "100000",
+        "VECTOR_INDEX": "hnsw",
+        "VECTOR_INDEX_MIN_SIZE": "10000",
+        "VECTOR_INDEX_EF_SEARCH": "64",
+        "VECTOR_INDEX_MEMORY_MB": "512",
+        "USE_PGVECTOR": "false",
+        "PGVECTOR_INDEX": "hnsw",
+        "PGVECTOR_EF_SEARCH": "64",
+        "SQLITE_VECTOR_ENCODING": "float32",
+        "AGENT_CACHE_SIZE": "256",
+        "AGENT_CACHE_TTL": "300",
+        "CONVERSATION_CACHE_TTL": "60",
+        "USER_TIMEZONE_CACHE_TTL": "300",
+        "TOKEN_USAGE_FLUSH_INTERVAL": "5",
+        "AUTH_CACHE_SIZE": "4096",
+        "AUTH_CACHE_TTL": "30",
+        "CONVERSATION_HISTORY_CACHE_SIZE": "512",
+        "INTERACTION_LOG_FLUSH_INTERVAL": "0.5",
+        "INTERACTION_LOG_BATCH_SIZE": "50",
+        "INTERACTION_LOG_MAX_RETRIES": "120",
+        "PROVIDER_TIMEOUT": "300",
+        "PROVIDER_CONNECT_TIMEOUT": "10",
+        "PROVIDER_MAX_CONNECTIONS": "500",
+        "PROVIDER_MAX_KEEPALIVE": "100",
+        "TOKEN_COUNT_CACHE_SIZE": "256",
+        "ROTATION_STATS_WINDOW": "100",
+        "ROTATION_FAILURE_THRESHOLD": "3",
+        "ROTATION_OPEN_SECONDS": "30",
+        "ROTATION_MAX_OPEN_SECONDS": "300",
+        "ROTATION_DECISION_LOG_SIZE": "100",
+        "ROTATION_HEDGE_MIN_SAMPLES": "20",
     }
     if default_value != "":
         default_values[var_name] = default_value
@@ -45,10 +82,52 @@ def getenv(var_name: str, default_value: str = "") -> str:
     return os.getenv(var_name, default_value)
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str = "cl100k_base"):
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=int(getenv("TOKEN_COUNT_CACHE_SIZE")))
+def count_tokens(text: str) -> int:
+    # The same prompts, histories and answers are counted several times a turn
+    return len(get_encoding().encode_ordinary(text))
+
+
 def get_tokens(text: str) -> int:
-    encoding = tiktoken.get_encoding("cl100k_base")
-    num_tokens = len(encoding.encode(text))
-    return num_tokens
+    if not text:
+        return 0
+    return count_tokens(str(text))
+
+
+def get_tokens_batch(texts: list) -> list:
+    """Token counts for many strings, encoded in parallel by tiktoken"""
+    texts = [str(text) if text else "" for text in texts]
+    return [len(tokens) for tokens in get_encoding().encode_ordinary_batch(texts)]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Approximate token count without tokenizing: about 4 characters per token for
+    ASCII text and 1 or more tokens per non-ASCII character.
+    """
+    if not text:
+        return 0
+    text = str(text)
+    extra_bytes = len(text.encode("utf-8")) - len(text)
+    return (len(text) + 3) // 4 + (extra_bytes + 1) // 2
+
+
+def exceeds_tokens(text: str, limit: int) -> bool:
+    """
+    Whether text is longer than limit tokens. Only tokenizes when the estimate
+    is within a factor of 4 of the limit.
+    """
+    estimate = estimate_tokens(text)
+    if estimate * 4 < int(limit):
+        return False
+    if estimate > int(limit) * 4:
+        return True
+    return get_tokens(text) > int(limit)
 
 
 def get_default_agent_settings():
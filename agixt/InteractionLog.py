@@ -0,0 +1,345 @@
+import asyncio
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import insert, bindparam
+from sqlalchemy.exc import IntegrityError, OperationalError, DisconnectionError
+from DB import (
+    Conversation,
+    Message,
+    SessionLocal,
+    ACTIVITY_KINDS,
+    get_new_row_id,
+    get_message_kind,
+    get_parent_activity_id,
+)
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+def is_transient_error(error) -> bool:
+    """Errors caused by the connection rather than the rows being written"""
+    return isinstance(error, (OperationalError, DisconnectionError)) or getattr(
+        error, "connection_invalidated", False
+    )
+
+
+class InteractionLogBuffer:
+    """
+    Write-behind buffer for conversation messages.
+
+    log_interaction hands rows to the buffer with a client generated id and
+    timestamp and returns immediately. A background thread writes everything
+    pending in one session every INTERACTION_LOG_FLUSH_INTERVAL seconds (or
+    once INTERACTION_LOG_BATCH_SIZE rows are waiting): one batched INSERT and
+    one updated_at bump per conversation, one commit. Rows keep the order they
+    were logged in, timestamps are strictly increasing per worker. While the
+    database is unreachable rows stay buffered for the next flush, up to
+    INTERACTION_LOG_MAX_RETRIES attempts each. Any other error is narrowed down
+    to the failing conversation, then to the failing rows, which are dropped
+    with a log line so they cannot hold back the rest of the buffer.
+
+    Readers call flush() before querying a conversation that has pending rows,
+    requests flush on the way out and the app flushes on shutdown. Setting
+    INTERACTION_LOG_FLUSH_INTERVAL to 0 writes every message synchronously.
+    """
+
+    def __init__(self, flush_interval: float = None, batch_size: int = None):
+        self.flush_interval = (
+            float(flush_interval)
+            if flush_interval is not None
+            else float(getenv("INTERACTION_LOG_FLUSH_INTERVAL"))
+        )
+        self.batch_size = (
+            int(batch_size)
+            if batch_size is not None
+            else int(getenv("INTERACTION_LOG_BATCH_SIZE"))
+        )
+        self.max_retries = int(getenv("INTERACTION_LOG_MAX_RETRIES"))
+        self.pending = []
+        # message id -> failed flush attempts, for rows waiting on the database
+        self.attempts = {}
+        # conversation_id -> (id, kind, timestamp) of the newest [ACTIVITY]
+        # logged here
+        self.last_activities = {}
+        self.last_timestamp = None
+        # Called with every row as it is queued, e.g. to extend cached histories
+        self.listeners = []
+        # Called with the id of a conversation found deleted while flushing
+        self.deleted_listeners = []
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.running = False
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+
+    @property
+    def enabled(self):
+        return self.flush_interval > 0
+
+    def next_timestamp(self):
+        timestamp = datetime.utcnow()
+        if self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            timestamp = self.last_timestamp + timedelta(microseconds=1)
+        self.last_timestamp = timestamp
+        return timestamp
+
+    def append(self, conversation_id, role, content, notify=False) -> str:
+        """Queue a message and return its id"""
+        message_id = get_new_row_id()
+        conversation_id = str(conversation_id)
+        kind = get_message_kind(content)
+        with self.lock:
+            row = {
+                "id": message_id,
+                "role": role,
+                "content": content,
+                "conversation_id": conversation_id,
+                "notify": notify,
+                "kind": kind,
+                "parent_activity_id": get_parent_activity_id(content),
+                "timestamp": self.next_timestamp(),
+                "updated_at": self.last_timestamp,
+            }
+            self.pending.append(row)
+            if kind in ACTIVITY_KINDS:
+                if len(self.last_activities) >= 10000:
+                    self.last_activities.clear()
+                self.last_activities[conversation_id] = (
+                    str(message_id),
+                    kind,
+                    row["timestamp"],
+                )
+            pending_count = len(self.pending)
+        for listener in self.listeners:
+            try:
+                listener(row)
+            except Exception as e:
+                logging.error(f"Error in interaction log listener: {e}")
+        if not self.enabled:
+            self.flush()
+        else:
+            self.start()
+            if pending_count >= self.batch_size:
+                self.wakeup.set()
+        return str(message_id)
+
+    def has_pending(self, conversation_id=None) -> bool:
+        with self.lock:
+            if conversation_id is None:
+                return len(self.pending) > 0
+            conversation_id = str(conversation_id)
+            return any(
+                row["conversation_id"] == conversation_id for row in self.pending
+            )
+
+    def last_activity(self, conversation_id):
+        """(id, kind, timestamp) of the newest [ACTIVITY] this worker logged"""
+        with self.lock:
+            return self.last_activities.get(str(conversation_id))
+
+    def last_activity_id(self, conversation_id):
+        last_activity = self.last_activity(conversation_id)
+        return last_activity[0] if last_activity else None
+
+    def forget(self, conversation_id):
+        with self.lock:
+            self.last_activities.pop(str(conversation_id), None)
+
+    def flush(self):
+        """Write all pending rows, oldest first, in a single transaction"""
+        with self.flush_lock:
+            with self.lock:
+                rows = self.pending
+                self.pending = []
+            if not rows:
+                return
+            session = SessionLocal()
+            try:
+                self.write(session, rows)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error flushing {len(rows)} buffered messages: {e}")
+                if is_transient_error(e):
+                    self.retry(rows)
+                else:
+                    self.write_by_conversation(session, rows)
+            finally:
+                session.close()
+
+    def write_by_conversation(self, session, rows):
+        """
+        Write rows one conversation at a time after a failed batch, dropping the
+        messages of conversations deleted meanwhile and isolating bad rows
+        """
+        conversation_ids = list(dict.fromkeys(row["conversation_id"] for row in rows))
+        for index, conversation_id in enumerate(conversation_ids):
+            conversation_rows = [
+                row for row in rows if row["conversation_id"] == conversation_id
+            ]
+            try:
+                self.write(session, conversation_rows)
+                continue
+            except Exception as e:
+                session.rollback()
+                if is_transient_error(e):
+                    unwritten = conversation_rows
+                elif (
+                    isinstance(e, IntegrityError)
+                    and session.get(Conversation, conversation_id) is None
+                ):
+                    logging.warning(
+                        f"Dropped {len(conversation_rows)} buffered messages of deleted conversation {conversation_id}"
+                    )
+                    self.drop(conversation_rows)
+                    for listener in self.deleted_listeners:
+                        try:
+                            listener(conversation_id)
+                        except Exception as e:
+                            logging.error(f"Error in interaction log listener: {e}")
+                    continue
+                else:
+                    unwritten = self.write_by_row(session, conversation_rows)
+            if unwritten:
+                remaining = set(conversation_ids[index + 1 :])
+                self.retry(
+                    unwritten
+                    + [row for row in rows if row["conversation_id"] in remaining]
+                )
+                return
+
+    def write_by_row(self, session, rows):
+        """
+        Write rows one at a time, dropping the ones the database rejects.
+        Returns the rows left unwritten because the database became unreachable.
+        """
+        for index, row in enumerate(rows):
+            try:
+                self.write(session, [row])
+            except Exception as e:
+                session.rollback()
+                if is_transient_error(e):
+                    return rows[index:]
+                logging.error(
+                    f"Dropped buffered message {row['id']} for conversation {row['conversation_id']}: {e}"
+                )
+                self.drop([row])
+        return []
+
+    def retry(self, rows):
+        """Put rows back in front of the buffer unless they ran out of attempts"""
+        requeued = []
+        for row in rows:
+            attempts = self.attempts.get(row["id"], 0) + 1
+            if attempts > self.max_retries:
+                logging.error(
+                    f"Dropped buffered message {row['id']} for conversation {row['conversation_id']} after {attempts - 1} failed flushes"
+                )
+                self.drop([row])
+                continue
+            self.attempts[row["id"]] = attempts
+            requeued.append(row)
+        self.requeue(requeued)
+
+    def drop(self, rows):
+        for row in rows:
+            self.attempts.pop(row["id"], None)
+        self.rows_dropped += len(rows)
+
+    def requeue(self, rows):
+        with self.lock:
+            self.pending = rows + self.pending
+
+    def write(self, session, rows):
+        session.execute(insert(Message), rows)
+        # updated_at becomes the newest message timestamp, which lets cached
+        # histories tell whether anyone else wrote to the conversation since
+        updated = {}
+        for row in rows:
+            updated[row["conversation_id"]] = row["timestamp"]
+        session.execute(
+            Conversation.__table__.update()
+            .where(Conversation.id == bindparam("conversation_id_"))
+            .values(updated_at=bindparam("updated_at_")),
+            [
+                {"conversation_id_": conversation_id, "updated_at_": updated_at}
+                for conversation_id, updated_at in updated.items()
+            ],
+        )
+        session.commit()
+        if self.attempts:
+            for row in rows:
+                self.attempts.pop(row["id"], None)
+        self.flushes += 1
+        self.rows_written += len(rows)
+
+    async def flush_async(self):
+        if self.has_pending():
+            await asyncio.to_thread(self.flush)
+
+    def start(self):
+        if self.running:
+            return
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.worker = threading.Thread(
+                target=self.run, name="interaction-log", daemon=True
+            )
+            self.worker.start()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error in interaction log flusher: {e}")
+
+    def close(self):
+        """Stop the flusher thread and write whatever is left"""
+        self.running = False
+        self.wakeup.set()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join(timeout=5)
+        self.worker = None
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            "pending": pending,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "rows_dropped": self.rows_dropped,
+        }
+
+
+interaction_log = InteractionLogBuffer()
+atexit.register(interaction_log.close)
+
+
+class InteractionLogMiddleware:
+    """ASGI middleware writing buffered messages once a request is done"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await interaction_log.flush_async()
@@ -8,7 +8,7 @@ import base64
 import uuid
 import asyncio
 from datetime import datetime
-from Memories import Memories
+from Memories import Memories, RetrievalContext, memory_to_context
 from Websearch import Websearch
 from Extensions import Extensions
 from Memories import extract_keywords
@@ -20,7 +20,8 @@ from ApiClient import (
     AGIXT_URI,
 )
 from MagicalAuth import MagicalAuth, impersonate_user
-from Globals import getenv, DEFAULT_USER, get_tokens
+from Globals import getenv, DEFAULT_USER, get_tokens, exceeds_tokens
+from Streaming import AnswerStream
 
 logging.basicConfig(
     level=getenv("LOG_LEVEL"),
@@ -68,22 +69,41 @@ class Interactions:
         self.chain = Chain(user=user)
         self.cp = Prompts(user=user)
         self._processed_commands = set()
+        self.retrieval_stats = {}
+        # Set to an asyncio.Queue to have the next run stream its answer there
+        self.stream_queue = None
 
     def custom_format(self, string, **kwargs):
+        return self.custom_format_with_tokens(string, count_tokens=False, **kwargs)[0]
+
+    def custom_format_with_tokens(self, string, count_tokens=True, **kwargs):
+        """
+        custom_format that also returns the token count of the result, summed
+        from the template text and each substituted value rather than tokenizing
+        the whole prompt again. Values counted before (the template, history,
+        persona) come from the get_tokens cache.
+        """
         if isinstance(string, list):
             string = "".join(str(x) for x in string)
+        values = []
 
         def replace(match):
             key = match.group(1)
             value = kwargs.get(key, match.group(0))
             if isinstance(value, list):
-                return "".join(str(x) for x in value)
+                value = "".join(str(x) for x in value)
             else:
-                return str(value)
+                value = str(value)
+            values.append(value)
+            return value
 
         pattern = r"(?<!{){([^{}\n]+)}(?!})"
         result = re.sub(pattern, replace, string)
-        return result
+        if not count_tokens:
+            return result, 0
+        tokens = get_tokens(re.sub(pattern, "", string))
+        tokens += sum(get_tokens(value) for value in values)
+        return result, tokens
 
     async def format_prompt(
         self,
@@ -121,6 +141,12 @@ class Interactions:
             f"http://localhost:7437/outputs/{self.agent.agent_id}/{conversation_id}/"
         )
         context = []
+        # Memoizes query embeddings and collects retrieval stats for this prompt
+        retrieval_context = RetrievalContext()
+        company_id = self.auth.company_id
+        if "company_id" in kwargs:
+            company_id = kwargs["company_id"]
+        company_context = []
         if int(top_results) > 0:
             if user_input:
                 min_relevance_score = 0.2
@@ -129,59 +155,77 @@ class Interactions:
                         min_relevance_score = float(kwargs["min_relevance_score"])
                     except:
                         min_relevance_score = 0.2
-                context += await self.agent_memory.get_memories(
-                    user_input=user_input,
-                    limit=top_results,
-                    min_relevance_score=min_relevance_score,
-                )
+                # Every collection the prompt draws from is searched in one pass
+                scopes = [
+                    {
+                        "scope": "core",
+                        "collection": "0",
+                        "limit": top_results,
+                        "min_relevance_score": min_relevance_score,
+                    }
+                ]
                 if "inject_memories_from_collection_number" in kwargs:
-                    collection_id = kwargs["inject_memories_from_collection_number"]
+                    scopes.append(
+                        {
+                            "scope": "injected",
+                            "collection": kwargs[
+                                "inject_memories_from_collection_number"
+                            ],
+                            "limit": top_results,
+                            "min_relevance_score": min_relevance_score,
+                        }
+                    )
+                scopes.append(
+                    {
+                        "scope": "conversation",
+                        "collection": self.websearch.agent_memory.collection_number,
+                        "limit": int(top_results) * 4,
+                        "min_relevance_score": min_relevance_score,
+                    }
+                )
+                if company_id:
                     try:
-                        context += await Memories(
-                            agent_name=self.agent_name,
-                            agent_config=self.agent.AGENT_CONFIG,
-                            collection_number=collection_id,
-                            ApiClient=self.ApiClient,
-                            user=self.user,
-                        ).get_memories(
-                            user_input=user_input,
-                            limit=top_results,
-                            min_relevance_score=min_relevance_score,
+                        company_agent_id = self.auth.get_company_agent_id(
+                            company_id=company_id
                         )
                     except Exception as e:
-                        logging.error(
-                            f"Error: {self.agent_name} failed to get memories from collection {collection_id}. {e}"
+                        company_agent_id = None
+                    if company_agent_id:
+                        scopes.append(
+                            {
+                                "scope": "company",
+                                "agent_id": company_agent_id,
+                                "collection": "0",
+                                "limit": top_results,
+                                "min_relevance_score": 0.0,
+                            }
                         )
-                conversation_context = await self.websearch.agent_memory.get_memories(
+                scoped_context = {}
+                for scope, memory, _ in await self.agent_memory.search_scopes_async(
                     user_input=user_input,
-                    limit=top_results,
-                    min_relevance_score=min_relevance_score,
-                )
+                    scopes=scopes,
+                    retrieval_context=retrieval_context,
+                ):
+                    metadata = memory_to_context(memory)
+                    scope_context = scoped_context.setdefault(scope, [])
+                    if metadata not in scope_context and metadata != "":
+                        scope_context.append(metadata)
+                context += scoped_context.get("core", [])
+                context += scoped_context.get("injected", [])
+                company_context = scoped_context.get("company", [])
+                conversation_memories = scoped_context.get("conversation", [])
+                conversation_context = conversation_memories[: int(top_results)]
                 if len(conversation_context) == int(top_results):
-                    conversational_context_tokens = get_tokens(
-                        " ".join(conversation_context)
-                    )
-                    if int(conversational_context_tokens) < 4000:
-                        conversational_results = top_results * 2
-                        conversation_context = (
-                            await self.websearch.agent_memory.get_memories(
-                                user_input=user_input,
-                                limit=conversational_results,
-                                min_relevance_score=min_relevance_score,
-                            )
-                        )
-                        conversational_context_tokens = get_tokens(
-                            " ".join(conversation_context)
-                        )
-                        if int(conversational_context_tokens) < 4000:
-                            conversational_results = conversational_results * 2
-                            conversation_context = (
-                                await self.websearch.agent_memory.get_memories(
-                                    user_input=user_input,
-                                    limit=conversational_results,
-                                    min_relevance_score=min_relevance_score,
-                                )
-                            )
+                    # Widen to 2x then 4x top_results while the context stays small
+                    for conversational_results in [
+                        int(top_results) * 2,
+                        int(top_results) * 4,
+                    ]:
+                        if exceeds_tokens(" ".join(conversation_context), 4000):
+                            break
+                        conversation_context = conversation_memories[
+                            :conversational_results
+                        ]
                 context += conversation_context
         if "context" in kwargs:
             context.append(kwargs["context"])
@@ -225,44 +269,18 @@ class Interactions:
         agent_tasks = self.agent.get_conversation_tasks(conversation_id=conversation_id)
         if agent_tasks != "":
             context.append(agent_tasks)
-        conversation_history = ""
-        conversation = c.get_conversation()
-        if "interactions" in conversation:
-            if conversation["interactions"] != []:
-                activity_history = [
-                    interaction
-                    for interaction in conversation["interactions"]
-                    if str(interaction["message"]).startswith("[ACTIVITY]")
-                ]
-                activities = []
-                for activity in activity_history:
-                    if "audio response" not in activity["message"]:
-                        activities.append(activity)
-                if len(activity_history) > 5:
-                    activity_history = activity_history[-5:]
-                interactions = []
-                for interaction in conversation["interactions"]:
-                    if (
-                        not str(interaction["message"]).startswith("<audio controls>")
-                        and not str(interaction["message"]).startswith("[ACTIVITY]")
-                        and not str(interaction["message"]).startswith("[SUBACTIVITY]")
-                    ):
-                        timestamp = (
-                            interaction["timestamp"]
-                            if "timestamp" in interaction
-                            else ""
-                        )
-                        role = interaction["role"] if "role" in interaction else ""
-                        message = (
-                            interaction["message"] if "message" in interaction else ""
-                        )
-                        message = regex.sub(r"(```.*?```)", "", message)
-                        interactions.append(f"{timestamp} {role}: {message} \n ")
-                if len(interactions) > 0:
-                    interactions = interactions[-conversation_results:]
-                    conversation_history = "\n".join(interactions)
-                conversation_history += "\n## The assistant's recent activities:\n"
-                conversation_history += c.get_activities_with_subactivities()
+        if "activity_results" in kwargs:
+            try:
+                activity_results = int(kwargs["activity_results"])
+            except:
+                activity_results = 5
+        else:
+            activity_results = 5
+        conversation_history = await asyncio.to_thread(
+            c.get_recent_history,
+            chat_limit=conversation_results,
+            activity_limit=activity_results,
+        )
         if conversation_history != "":
             context.append(
                 f"### Recent Activities and Conversation History\n{conversation_history}\n"
@@ -273,37 +291,12 @@ class Interactions:
         if "persona" in self.agent.AGENT_CONFIG["settings"]:
             persona = self.agent.AGENT_CONFIG["settings"]["persona"]
         try:
-            company_id = self.auth.company_id
-            if "company_id" in kwargs:
-                company_id = kwargs["company_id"]
             if company_id:
                 company_training = self.auth.get_training_data(company_id=company_id)
                 persona += f"\n\n**Guidelines as they pertain to the company:**\n{company_training}"
-                cs = self.auth.get_company_agent_session(company_id=company_id)
-                company_memories = cs.get_agent_memories(
-                    agent_name="AGiXT", user_input=user_input
-                )
-                if company_memories:
-                    for result in company_memories:
-                        metadata = (
-                            result["additional_metadata"]
-                            if "additional_metadata" in result
-                            else ""
-                        )
-                        external_source = (
-                            result["external_source_name"]
-                            if "external_source_name" in result
-                            else None
-                        )
-                        timestamp = (
-                            result["timestamp"]
-                            if "timestamp" in result
-                            else datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                        if external_source:
-                            metadata = f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
-                        if metadata not in context and metadata != "":
-                            context.append(metadata)
+                for metadata in company_context:
+                    if metadata not in context:
+                        context.append(metadata)
         except Exception as e:
             pass
         if persona != "":
@@ -390,9 +383,12 @@ class Interactions:
                     user_input=f"{user_input} {file_list}",
                     min_relevance_score=0.3,
                     limit=top_results if top_results > 0 else 5,
+                    retrieval_context=retrieval_context,
                 )
                 if fragmented_content != "":
                     file_contents = f"Here is some potentially relevant information from {the_files}\n{fragmented_content}\n\n"
+        self.retrieval_stats = retrieval_context.stats()
+        logging.debug(f"Memory retrieval for this prompt: {self.retrieval_stats}")
         skip_args = [
             "user_input",
             "agent_name",
@@ -416,7 +412,7 @@ class Interactions:
             agent_commands = self.agent.get_commands_prompt(
                 conversation_id=conversation_id
             )
-        formatted_prompt = self.custom_format(
+        formatted_prompt, tokens = self.custom_format_with_tokens(
             string=prompt,
             user_input=user_input,
             agent_name=self.agent_name,
@@ -432,7 +428,6 @@ class Interactions:
             output_url=conversation_outputs,
             **args,
         )
-        tokens = get_tokens(formatted_prompt)
         return formatted_prompt, prompt, tokens
 
     def process_thinking_tags(
@@ -527,6 +522,45 @@ class Interactions:
 
         return response
 
+    async def agent_inference(
+        self,
+        prompt: str,
+        tokens: int = 0,
+        use_smartest: bool = False,
+        stream: AnswerStream = None,
+        c: Conversations = None,
+        prefix: str = "",
+    ) -> str:
+        """
+        Run inference on the agent, feeding the tokens to stream as they arrive.
+
+        Args:
+            prompt: The formatted prompt
+            tokens: Token count of the prompt if already known
+            use_smartest: Whether to use the smartest provider
+            stream: AnswerStream of the run, None to wait for the whole answer
+            c: Conversation to log completed thoughts to
+            prefix: Response so far that this inference continues
+
+        Returns:
+            The full response
+        """
+        if stream is None:
+            return await self.agent.inference(
+                prompt=prompt, tokens=tokens, use_smartest=use_smartest
+            )
+        response = ""
+        async for token in self.agent.inference_stream(
+            prompt=prompt, tokens=tokens, use_smartest=use_smartest
+        ):
+            response += token
+            if stream.feed(token):
+                thinking_id = c.get_thinking_id(agent_name=self.agent_name)
+                self.process_thinking_tags(
+                    response=f"{prefix}{response}", thinking_id=thinking_id, c=c
+                )
+        return response
+
     async def run(
         self,
         user_input: str = "",
@@ -631,6 +665,16 @@ class Interactions:
         if conversation_name == "":
             conversation_name = "-"
         c = Conversations(conversation_name=conversation_name, user=self.user)
+        # Only the top level run streams, nested runs (searches, shots) do not
+        stream = None
+        if self.stream_queue is not None and not searching:
+            stream = AnswerStream(
+                queue=self.stream_queue,
+                replacements={
+                    f"http://localhost:7437/outputs/{self.agent.agent_id}": self.outputs
+                },
+            )
+        self.stream_queue = None
         async_tasks = []
         vision_response = ""
         if "vision_provider" in self.agent.AGENT_CONFIG["settings"]:
@@ -787,8 +831,12 @@ class Interactions:
                 message=log_message,
             )
         try:
-            self.response = await self.agent.inference(
-                prompt=formatted_prompt, use_smartest=use_smartest
+            self.response = await self.agent_inference(
+                prompt=formatted_prompt,
+                tokens=tokens,
+                use_smartest=use_smartest,
+                stream=stream,
+                c=c,
             )
         except Exception as e:
             # Log the error with the full traceback for the provider
@@ -835,8 +883,14 @@ class Interactions:
                     if new_processed_length > processed_length:
                         # Get continuation only if we got new content
                         new_prompt = f"{formatted_prompt}\n\n{self.agent_name}: {self.response}\n\nThe assistant has executed a command and should continue its thought process..."
-                        command_response = await self.agent.inference(
-                            prompt=new_prompt, use_smartest=use_smartest
+                        command_response = await self.agent_inference(
+                            prompt=new_prompt,
+                            tokens=tokens
+                            + get_tokens(new_prompt[len(formatted_prompt) :]),
+                            use_smartest=use_smartest,
+                            stream=stream,
+                            c=c,
+                            prefix=self.response,
                         )
                         self.response = f"{self.response}{command_response}"
                         processed_length = new_processed_length
@@ -860,8 +914,14 @@ class Interactions:
                     if new_processed_length > processed_length:
                         # Only continue if we actually got new content
                         new_prompt = f"{formatted_prompt}\n\n{self.agent_name}: {self.response}\n\nThe assistant has executed a command and should continue its thought process, the user does not see this message. Proceed with thinking, responding, or executing more commands before the response to the user. This can be used also to evaluate output of previously executed commands and retry executing a command if the output of the command was not as expected. The assistant should never try to fill in the command output, it will be returned to the assistant after the command is executed by the system. Ensure the <answer> block does not contain <thinking>, <reflection>, <execute>, or <output> tags, those should only exist before and after the <answer> block. The <answer> block should only contain the final, well reasoned response to the user."
-                        command_response = await self.agent.inference(
-                            prompt=new_prompt, use_smartest=use_smartest
+                        command_response = await self.agent_inference(
+                            prompt=new_prompt,
+                            tokens=tokens
+                            + get_tokens(new_prompt[len(formatted_prompt) :]),
+                            use_smartest=use_smartest,
+                            stream=stream,
+                            c=c,
+                            prefix=self.response,
                         )
                         self.response = f"{self.response}{command_response}"
                         processed_length = new_processed_length
@@ -876,8 +936,13 @@ class Interactions:
                 # If no answer block yet, try to get it
                 elif "</answer>" not in self.response:
                     new_prompt = f"{formatted_prompt}\n\n{self.agent_name}: {self.response}\n\nWas the assistant {self.agent_name} done typing? If not, continue from where you left off without acknowledging this message or repeating anything that was already typed and the response will be appended. If the assistant needs to rewrite the response, start a new <answer> tag with the new response and close it with </answer> when complete. If the assistant was done, simply respond with '</answer>' as long as there is a <answer> block present, otherwise, the final answer to the user should be within the <answer> block. to send the message to the user. Ensure the <answer> block does not contain <thinking>, <reflection>, <execute>, or <output> tags, those should only exist before and after the <answer> block. The <answer> block should only contain the final, well reasoned response to the user."
-                    response = await self.agent.inference(
-                        prompt=new_prompt, use_smartest=use_smartest
+                    response = await self.agent_inference(
+                        prompt=new_prompt,
+                        tokens=tokens + get_tokens(new_prompt[len(formatted_prompt) :]),
+                        use_smartest=use_smartest,
+                        stream=stream,
+                        c=c,
+                        prefix=self.response,
                     )
                     self.response = f"{self.response}{response}"
                     continue
@@ -896,6 +961,8 @@ class Interactions:
                         )
                     else:
                         break
+        if stream is not None:
+            stream.close()
         if "<thinking>" in self.response:
             thinking_id = c.get_thinking_id(agent_name=self.agent_name)
             self.response = self.process_thinking_tags(
@@ -4,11 +4,15 @@ from DB import (
     UserOAuth,
     OAuthProvider,
     UserPreferences,
+    TokenUsage,
     get_session,
+    get_async_session,
     Company,
     UserCompany,
     Invitation,
+    Agent,
 )
+from sqlalchemy import select, func
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import joinedload
 from sendgrid.helpers.mail import Mail
@@ -23,11 +27,13 @@ from Models import (
     UserResponse,
 )
 from typing import List, Optional
+from collections import OrderedDict
 from fastapi import Header, HTTPException
 from Globals import getenv
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from fastapi import HTTPException
 from agixtsdk import AGiXTSDK
+from TokenUsage import token_usage
 from sso.amazon import amazon_sso
 from sso.github import github_sso
 from sso.google import google_sso
@@ -35,11 +41,14 @@ from sso.microsoft import microsoft_sso
 from sso.walmart import walmart_sso
 import pyotp
 import logging
+import threading
+import functools
 import traceback
 import requests
 import pytz
 import jwt
 import json
+import time
 import uuid
 import os
 
@@ -189,12 +198,129 @@ def get_admin_user():
     return user
 
 
+class VerifiedTokenCache:
+    """
+    Per-worker LRU of validated auth tokens.
+
+    A hit maps the raw token straight to the user context it resolved to (user
+    id, email, company id and the User row verify_api_key returns), so
+    verify_api_key, MagicalAuth and Agent authenticate a request without
+    decoding the JWT again or touching the database. Entries live for
+    AUTH_CACHE_TTL seconds and never past the token's own expiry. update_user,
+    delete_user and company membership changes drop the user's entries right
+    away, other workers see them after at most AUTH_CACHE_TTL seconds.
+    """
+
+    # jwt.decode is called with this leeway, a token stays valid this long past exp
+    LEEWAY = timedelta(hours=5).total_seconds()
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = (
+            int(max_entries)
+            if max_entries is not None
+            else int(getenv("AUTH_CACHE_SIZE"))
+        )
+        self.ttl = float(ttl) if ttl is not None else float(getenv("AUTH_CACHE_TTL"))
+        # token -> dict of resolved fields plus "expires"
+        self.entries = OrderedDict()
+        # user_id -> (token, expires) minted by impersonate_user
+        self.impersonation_tokens = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def get(self, key, field: str = None) -> Optional[dict]:
+        """Cached context of a token, None when missing or lacking field"""
+        if not self.enabled or not key:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() > entry["expires"]:
+                del self.entries[key]
+                entry = None
+            if entry is None or (field is not None and field not in entry):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, exp=None, **fields):
+        """Remember (or extend) what a verified token resolved to"""
+        if not self.enabled or not key or not fields.get("user_id"):
+            return
+        fields["user_id"] = str(fields["user_id"])
+        expires = time.time() + self.ttl
+        if exp:
+            expires = min(expires, float(exp) + self.LEEWAY)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["user_id"] != fields["user_id"]:
+                entry = {"expires": expires}
+                self.entries[key] = entry
+            entry.update(fields)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_impersonation_token(self, user_id) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self.lock:
+            cached = self.impersonation_tokens.get(str(user_id))
+            if cached is None or time.time() > cached[1]:
+                return None
+            return cached[0]
+
+    def set_impersonation_token(self, user_id, token):
+        if not self.enabled:
+            return
+        with self.lock:
+            if len(self.impersonation_tokens) >= self.max_entries:
+                self.impersonation_tokens.clear()
+            self.impersonation_tokens[str(user_id)] = (token, time.time() + self.ttl)
+
+    def invalidate(self, user_id=None):
+        """Drop every token of one user, or everything"""
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+                self.impersonation_tokens.clear()
+                return
+            user_id = str(user_id)
+            for token in [
+                token
+                for token, entry in self.entries.items()
+                if entry["user_id"] == user_id
+            ]:
+                del self.entries[token]
+            self.impersonation_tokens.pop(user_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+auth_cache = VerifiedTokenCache()
+
+
 def verify_api_key(authorization: str = Header(None)):
     AGIXT_API_KEY = getenv("AGIXT_API_KEY")
     authorization = str(authorization).replace("Bearer ", "").replace("bearer ", "")
     if AGIXT_API_KEY:
         if authorization == AGIXT_API_KEY:
             return get_admin_user()
+        entry = auth_cache.get(authorization, field="user")
+        if entry is not None:
+            return dict(entry["user"])
         try:
             if authorization == AGIXT_API_KEY:
                 return get_admin_user()
@@ -210,6 +336,13 @@ def verify_api_key(authorization: str = Header(None)):
             user_dict = user.__dict__
             user_dict.pop("_sa_instance_state")
             db.close()
+            auth_cache.set(
+                authorization,
+                exp=token.get("exp"),
+                user_id=user_dict["id"],
+                email=user_dict["email"],
+                user=dict(user_dict),
+            )
             return user_dict
         except Exception as e:
             logging.info(f"Error verifying API Key: {str(e)}")
@@ -254,14 +387,16 @@ def get_user_by_email(email: str):
 def impersonate_user(email: str):
     # Get token for the user
     AGIXT_API_KEY = getenv("AGIXT_API_KEY")
+    user_id = str(get_user_id(email))
     token = jwt.encode(
         {
-            "sub": str(get_user_id(email)),
+            "sub": user_id,
             "email": email,
         },
         AGIXT_API_KEY,
         algorithm="HS256",
     )
+    auth_cache.set(token, user_id=user_id, email=email)
     return token
 
 
@@ -329,40 +464,48 @@ class MagicalAuth:
         encryption_key = getenv("AGIXT_API_KEY")
         self.link = getenv("APP_URI")
         self.encryption_key = encryption_key
-        token = (
-            str(token)
-            .replace("%2B", "+")
-            .replace("%2F", "/")
-            .replace("%3D", "=")
-            .replace("%20", " ")
-            .replace("%3A", ":")
-            .replace("%3F", "?")
-            .replace("%26", "&")
-            .replace("%23", "#")
-            .replace("%3B", ";")
-            .replace("%40", "@")
-            .replace("%21", "!")
-            .replace("%24", "$")
-            .replace("%27", "'")
-            .replace("%28", "(")
-            .replace("%29", ")")
-            .replace("%2A", "*")
-            .replace("%2C", ",")
-            .replace("%3B", ";")
-            .replace("%5B", "[")
-            .replace("%5D", "]")
-            .replace("%7B", "{")
-            .replace("%7D", "}")
-            .replace("%7C", "|")
-            .replace("%5C", "\\")
-            .replace("%5E", "^")
-            .replace("%60", "`")
-            .replace("%7E", "~")
-            .replace("Bearer ", "")
-            .replace("bearer ", "")
-            if token
-            else None
-        )
+        token = str(token) if token else None
+        if token and "%" in token:
+            token = (
+                token.replace("%2B", "+")
+                .replace("%2F", "/")
+                .replace("%3D", "=")
+                .replace("%20", " ")
+                .replace("%3A", ":")
+                .replace("%3F", "?")
+                .replace("%26", "&")
+                .replace("%23", "#")
+                .replace("%3B", ";")
+                .replace("%40", "@")
+                .replace("%21", "!")
+                .replace("%24", "$")
+                .replace("%27", "'")
+                .replace("%28", "(")
+                .replace("%29", ")")
+                .replace("%2A", "*")
+                .replace("%2C", ",")
+                .replace("%3B", ";")
+                .replace("%5B", "[")
+                .replace("%5D", "]")
+                .replace("%7B", "{")
+                .replace("%7D", "}")
+                .replace("%7C", "|")
+                .replace("%5C", "\\")
+                .replace("%5E", "^")
+                .replace("%60", "`")
+                .replace("%7E", "~")
+            )
+        if token:
+            token = token.replace("Bearer ", "").replace("bearer ", "")
+        # Keyed by the normalized token, the same value verify_api_key decodes
+        entry = auth_cache.get(token, field="company_id")
+        if entry is not None:
+            self.email = entry["email"]
+            self.user_id = entry["user_id"]
+            self.token = entry.get("token", token)
+            self.company_id = entry["company_id"]
+            return
+        exp = None
         try:
             # Decode jwt
             decoded = jwt.decode(
@@ -374,6 +517,7 @@ class MagicalAuth:
             self.email = decoded["email"]
             self.user_id = decoded["sub"]
             self.token = token
+            exp = decoded.get("exp")
             self.company_id = self.get_user_company_id()
         except:
             self.email = None
@@ -385,6 +529,14 @@ class MagicalAuth:
             self.user_id = get_user_id(self.email)
             self.token = token
             self.company_id = self.get_user_company_id()
+        if self.user_id is not None:
+            context = {
+                "user_id": self.user_id,
+                "email": self.email,
+                "company_id": self.company_id,
+                "token": self.token,
+            }
+            auth_cache.set(token, exp=exp, **context)
 
     def validate_user(self):
         if self.user_id is None:
@@ -769,8 +921,6 @@ class MagicalAuth:
             # Add default user preferences
             default_preferences = [
                 ("timezone", getenv("TZ")),
-                ("input_tokens", "0"),
-                ("output_tokens", "0"),
                 ("verify_email", "true" if verify_email else "false"),
             ]
             for pref_key, pref_value in default_preferences:
@@ -839,6 +989,9 @@ class MagicalAuth:
                     user_preference.pref_value = str(value)
         session.commit()
         session.close()
+        auth_cache.invalidate(self.user_id)
+        if "timezone" in kwargs:
+            user_timezone_cache.invalidate(self.user_id)
         return "User updated successfully."
 
     def delete_company(self, company_id):
@@ -852,6 +1005,7 @@ class MagicalAuth:
         )
         for user_company in user_companies:
             session.delete(user_company)
+            auth_cache.invalidate(user_company.user_id)
         session.commit()
         # Delete the company
         session.delete(company)
@@ -865,6 +1019,7 @@ class MagicalAuth:
         user.is_active = False
         session.commit()
         session.close()
+        auth_cache.invalidate(self.user_id)
         return "User deleted successfully"
 
     def registration_requirements(self):
@@ -991,10 +1146,7 @@ class MagicalAuth:
         user_requirements = self.registration_requirements()
         if not user_preferences:
             user_preferences = {}
-        if "input_tokens" not in user_preferences:
-            user_preferences["input_tokens"] = 0
-        if "output_tokens" not in user_preferences:
-            user_preferences["output_tokens"] = 0
+        user_preferences.update(self.get_token_counts())
         if user.email != getenv("DEFAULT_USER"):
             api_key = getenv("STRIPE_API_KEY")
             if api_key != "" and api_key is not None and str(api_key).lower() != "none":
@@ -1462,96 +1614,76 @@ class MagicalAuth:
         return decrypted_preferences
 
     def get_token_counts(self):
+        """Total tokens the user has used across all agents"""
+        if token_usage.has_pending(self.user_id):
+            token_usage.flush()
         session = get_session()
-        user_preferences = (
-            session.query(UserPreferences)
-            .filter(UserPreferences.user_id == self.user_id)
-            .all()
-        )
-        input_tokens = 0
-        output_tokens = 0
-        found_input_tokens = False
-        found_output_tokens = False
-        for preference in user_preferences:
-            if preference.pref_key == "input_tokens":
-                input_tokens = int(preference.pref_value)
-                found_input_tokens = True
-            if preference.pref_key == "output_tokens":
-                output_tokens = int(preference.pref_value)
-                found_output_tokens = True
-        if not found_input_tokens:
-            user_preference = UserPreferences(
-                user_id=self.user_id,
-                pref_key="input_tokens",
-                pref_value=str(input_tokens),
-            )
-            session.add(user_preference)
-            session.commit()
-        if not found_output_tokens:
-            user_preference = UserPreferences(
-                user_id=self.user_id,
-                pref_key="output_tokens",
-                pref_value=str(output_tokens),
-            )
-            session.add(user_preference)
-            session.commit()
+        input_tokens, output_tokens = session.execute(
+            select(
+                func.coalesce(func.sum(TokenUsage.input_tokens), 0),
+                func.coalesce(func.sum(TokenUsage.output_tokens), 0),
+            ).where(TokenUsage.user_id == self.user_id)
+        ).one()
         session.close()
-        return {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        return {
+            "input_tokens": int(input_tokens),
+            "output_tokens": int(output_tokens),
+        }
 
-    def increase_token_counts(self, input_tokens: int = 0, output_tokens: int = 0):
-        self.validate_user()
+    def get_token_usage(
+        self,
+        start_date: date = None,
+        end_date: date = None,
+        agent_id: str = None,
+    ) -> List[dict]:
+        """Daily token usage per agent, oldest day first"""
+        if token_usage.has_pending(self.user_id):
+            token_usage.flush()
         session = get_session()
-        counts = self.get_token_counts()
-        current_input_tokens = int(counts["input_tokens"])
-        current_output_tokens = int(counts["output_tokens"])
-        updated_input_tokens = current_input_tokens + input_tokens
-        updated_output_tokens = current_output_tokens + output_tokens
-        user_preferences = (
-            session.query(UserPreferences)
-            .filter(UserPreferences.user_id == self.user_id)
-            .all()
-        )
-        if not user_preferences:
-            user_input_tokens = None
-            user_output_tokens = None
-        else:
-            user_input_tokens = next(
-                (x for x in user_preferences if x.pref_key == "input_tokens"),
-                None,
-            )
-            user_output_tokens = next(
-                (x for x in user_preferences if x.pref_key == "output_tokens"),
-                None,
+        query = (
+            select(
+                TokenUsage.usage_date,
+                TokenUsage.agent_id,
+                Agent.name,
+                func.sum(TokenUsage.input_tokens),
+                func.sum(TokenUsage.output_tokens),
             )
-        # Update input tokens
-        if user_input_tokens is None:
-            user_input_tokens = UserPreferences(
-                user_id=self.user_id,
-                pref_key="input_tokens",
-                pref_value=str(updated_input_tokens),
-            )
-            session.add(user_input_tokens)
-            session.commit()
-        else:
-            user_input_tokens.pref_value = str(updated_input_tokens)
-            session.commit()
-        # Update output tokens
-        if user_output_tokens is None:
-            user_output_tokens = UserPreferences(
-                user_id=self.user_id,
-                pref_key="output_tokens",
-                pref_value=str(updated_output_tokens),
-            )
-            session.add(user_output_tokens)
-            session.commit()
-        else:
-            user_output_tokens.pref_value = str(updated_output_tokens)
-            session.commit()
+            .outerjoin(Agent, Agent.id == TokenUsage.agent_id)
+            .where(TokenUsage.user_id == self.user_id)
+        )
+        if start_date:
+            query = query.where(TokenUsage.usage_date >= start_date)
+        if end_date:
+            query = query.where(TokenUsage.usage_date <= end_date)
+        if agent_id:
+            query = query.where(TokenUsage.agent_id == agent_id)
+        rows = session.execute(
+            query.group_by(
+                TokenUsage.usage_date, TokenUsage.agent_id, Agent.name
+            ).order_by(TokenUsage.usage_date.asc())
+        ).all()
         session.close()
-        return {
-            "input_tokens": updated_input_tokens,
-            "output_tokens": updated_output_tokens,
-        }
+        return [
+            {
+                "date": row[0],
+                "agent_id": str(row[1]) if row[1] else None,
+                "agent_name": row[2],
+                "input_tokens": int(row[3]),
+                "output_tokens": int(row[4]),
+            }
+            for row in rows
+        ]
+
+    def increase_token_counts(
+        self, input_tokens: int = 0, output_tokens: int = 0, agent_id: str = None
+    ):
+        self.validate_user()
+        token_usage.add(
+            user_id=self.user_id,
+            agent_id=agent_id,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+        )
 
     def get_user_companies(self) -> List[str]:
         """Get list of company IDs that the user has access to"""
@@ -1675,6 +1807,7 @@ class MagicalAuth:
                     )
                     db.add(user_company)
                     db.commit()
+                    auth_cache.invalidate(user.id)
                     # send an email letting the user know they have been added to the company
                     company = (
                         db.query(Company)
@@ -1868,6 +2001,7 @@ class MagicalAuth:
                 )
                 db.add(user_company)
                 db.commit()
+                auth_cache.invalidate(self.user_id)
                 return True
             except SQLAlchemyError as e:
                 db.rollback()
@@ -2101,6 +2235,7 @@ class MagicalAuth:
                 )
                 db.add(user_company)
                 db.commit()
+                auth_cache.invalidate(self.user_id)
                 agixt = AGiXTSDK(base_uri=getenv("AGIXT_URI"))
                 company_email = f"{str(new_company.id)}@{str(new_company.id)}.xt"
                 auth = MagicalAuth()
@@ -2279,6 +2414,27 @@ class MagicalAuth:
         agixt.login(email=f"{company_id}@{company_id}.xt", otp=totp.now())
         return agixt
 
+    def get_company_agent_id(self, company_id: str = None) -> Optional[str]:
+        """Agent ID of the company's AGiXT agent, for searching its memories in-process"""
+        if not company_id:
+            company_id = self.company_id
+        if str(company_id) not in self.get_user_companies():
+            raise HTTPException(
+                status_code=403,
+                detail="Unauthorized. Insufficient permissions.",
+            )
+        with get_session() as db:
+            agent = (
+                db.query(Agent)
+                .join(User, Agent.user_id == User.id)
+                .filter(
+                    User.email == f"{company_id}@{company_id}.xt",
+                    Agent.name == "AGiXT",
+                )
+                .first()
+            )
+            return str(agent.id) if agent else None
+
     def sso(
         self,
         code,
@@ -2609,7 +2765,64 @@ class MagicalAuth:
             )
 
 
+class UserTimezoneCache:
+    """
+    Per-worker TTL cache of each user's timezone preference. convert_time runs
+    for every timestamp we render, so it must not query UserPreferences per
+    call. update_user invalidates the user when the timezone changes, other
+    workers see the change after at most USER_TIMEZONE_CACHE_TTL seconds.
+    """
+
+    def __init__(self, ttl: float = None, max_entries: int = 10000):
+        self.ttl = (
+            float(ttl) if ttl is not None else float(getenv("USER_TIMEZONE_CACHE_TTL"))
+        )
+        self.max_entries = max_entries
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        if self.ttl <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(str(user_id))
+            if entry is None:
+                return None
+            timezone, created = entry
+            if time.monotonic() - created > self.ttl:
+                del self.entries[str(user_id)]
+                return None
+            return timezone
+
+    def set(self, user_id, timezone):
+        if self.ttl <= 0 or not timezone:
+            return
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            self.entries[str(user_id)] = (timezone, time.monotonic())
+
+    def invalidate(self, user_id=None):
+        with self.lock:
+            if user_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(str(user_id), None)
+
+
+user_timezone_cache = UserTimezoneCache()
+
+
+@functools.lru_cache(maxsize=256)
+def get_tzinfo(timezone: str):
+    """pytz zone by name, built once per worker"""
+    return pytz.timezone(timezone)
+
+
 def get_user_timezone(user_id):
+    timezone = user_timezone_cache.get(user_id)
+    if timezone:
+        return timezone
     session = get_session()
     user_preferences = (
         session.query(UserPreferences)
@@ -2627,10 +2840,50 @@ def get_user_timezone(user_id):
         session.commit()
     timezone = user_preferences.pref_value
     session.close()
+    user_timezone_cache.set(user_id, timezone)
+    return timezone
+
+
+async def get_user_timezone_async(user_id):
+    timezone = user_timezone_cache.get(user_id)
+    if timezone:
+        return timezone
+    async with get_async_session() as session:
+        user_preferences = await session.scalar(
+            select(UserPreferences)
+            .where(
+                UserPreferences.user_id == user_id,
+                UserPreferences.pref_key == "timezone",
+            )
+            .limit(1)
+        )
+        if not user_preferences:
+            user_preferences = UserPreferences(
+                user_id=user_id, pref_key="timezone", pref_value=getenv("TZ")
+            )
+            session.add(user_preferences)
+            await session.commit()
+        timezone = user_preferences.pref_value
+    user_timezone_cache.set(user_id, timezone)
     return timezone
 
 
-def convert_time(utc_time, user_id):
-    gmt = pytz.timezone("GMT")
-    local_tz = pytz.timezone(get_user_timezone(user_id))
-    return gmt.localize(utc_time).astimezone(local_tz)
+def convert_time(utc_time, user_id, timezone=None):
+    if not timezone:
+        timezone = get_user_timezone(user_id)
+    return pytz.utc.localize(utc_time).astimezone(get_tzinfo(timezone))
+
+
+def convert_times(utc_times, user_id, timezone=None) -> list:
+    """
+    convert_time for a whole list of naive UTC datetimes. The user's zone is
+    resolved once for the batch, None entries stay None.
+    """
+    if not timezone:
+        timezone = get_user_timezone(user_id)
+    local_tz = get_tzinfo(timezone)
+    localize = pytz.utc.localize
+    return [
+        localize(utc_time).astimezone(local_tz) if utc_time is not None else None
+        for utc_time in utc_times
+    ]
@@ -1,26 +1,28 @@
 import logging
 import os
 import asyncio
+import threading
 import sys
 from DB import (
     Memory,
     Agent,
     User,
     get_session,
+    get_new_row_id,
     get_similar_memories,
+    get_similar_memories_for_scopes,
     process_embedding_for_storage,
 )
+from VectorIndex import vector_index
 import spacy
 from numpy import array, linalg, ndarray
 from collections import Counter
-from typing import List
+from typing import Callable, List
+from sqlalchemy import insert
 from Globals import getenv, DEFAULT_USER
 from textacy.extract.keyterms import textrank  # type: ignore
 from youtube_transcript_api import YouTubeTranscriptApi
-from onnxruntime import InferenceSession
-from tokenizers import Tokenizer
-from typing import List, cast, Union, Sequence
-from numpy import array, linalg, ndarray
+from Embeddings import embed, get_embedding_engine
 import numpy as np
 from datetime import datetime
 from uuid import UUID
@@ -33,50 +35,33 @@ if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
 
 
+# Components the chunker never reads, excluded when the pipeline is loaded.
+NLP_EXCLUDED_PIPES = ["ner"]
+# Components only needed for keyword scoring (POS filters and lemmas for textrank).
+NLP_KEYWORD_PIPES = ["tagger", "attribute_ruler", "lemmatizer"]
+_nlp_pipeline = None
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    """Returns the spaCy pipeline shared by this worker process, loading it once."""
+    global _nlp_pipeline
+    if _nlp_pipeline is None:
+        with _nlp_lock:
+            if _nlp_pipeline is None:
+                try:
+                    sp = spacy.load("en_core_web_sm", exclude=NLP_EXCLUDED_PIPES)
+                except OSError:
+                    spacy.cli.download("en_core_web_sm")
+                    sp = spacy.load("en_core_web_sm", exclude=NLP_EXCLUDED_PIPES)
+                # Text is fed in bounded windows, this only guards direct nlp() calls.
+                sp.max_length = 99999999999999999999999
+                _nlp_pipeline = sp
+    return _nlp_pipeline
+
+
 def nlp(text):
-    try:
-        sp = spacy.load("en_core_web_sm")
-    except:
-        spacy.cli.download("en_core_web_sm")
-        sp = spacy.load("en_core_web_sm")
-    sp.max_length = 99999999999999999999999
-    return sp(text)
-
-
-def embed(input: List[str]) -> List[Union[Sequence[float], Sequence[int]]]:
-    tokenizer = Tokenizer.from_file(os.path.join(os.getcwd(), "onnx", "tokenizer.json"))
-    tokenizer.enable_truncation(max_length=256)
-    tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=256)
-    model = InferenceSession(os.path.join(os.getcwd(), "onnx", "model.onnx"))
-    all_embeddings = []
-    for i in range(0, len(input), 32):
-        batch = input[i : i + 32]
-        encoded = [tokenizer.encode(d) for d in batch]
-        input_ids = np.array([e.ids for e in encoded])
-        attention_mask = np.array([e.attention_mask for e in encoded])
-        onnx_input = {
-            "input_ids": np.array(input_ids, dtype=np.int64),
-            "attention_mask": np.array(attention_mask, dtype=np.int64),
-            "token_type_ids": np.array(
-                [np.zeros(len(e), dtype=np.int64) for e in input_ids],
-                dtype=np.int64,
-            ),
-        }
-        model_output = model.run(None, onnx_input)
-        last_hidden_state = model_output[0]
-        input_mask_expanded = np.broadcast_to(
-            np.expand_dims(attention_mask, -1), last_hidden_state.shape
-        )
-        embeddings = np.sum(last_hidden_state * input_mask_expanded, 1) / np.clip(
-            input_mask_expanded.sum(1), a_min=1e-9, a_max=None
-        )
-        norm = np.linalg.norm(embeddings, axis=1)
-        norm[norm == 0] = 1e-12
-        embeddings = (embeddings / norm[:, np.newaxis]).astype(np.float32)
-        all_embeddings.append(embeddings)
-    return cast(
-        List[Union[Sequence[float], Sequence[int]]], np.concatenate(all_embeddings)
-    ).tolist()
+    return get_nlp()(text)
 
 
 def extract_keywords(doc=None, text="", limit=10):
@@ -85,6 +70,73 @@ def extract_keywords(doc=None, text="", limit=10):
     return [k for k, s in textrank(doc, topn=limit)]
 
 
+def iter_text_windows(text: str, window_size: int = None):
+    """Yield slices of at most window_size characters, preferably ending on a line or sentence break."""
+    window_size = int(window_size or getenv("NLP_WINDOW_SIZE"))
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(start + window_size, length)
+        if end < length:
+            for separator in ["\n\n", "\n", ". ", " "]:
+                split_at = text.rfind(separator, start + window_size // 2, end)
+                if split_at != -1:
+                    end = split_at + len(separator)
+                    break
+        yield text[start:end]
+        start = end
+
+
+def stream_chunks(text: str, chunk_size: int, score_keywords: bool = True) -> List[str]:
+    """
+    Split text into chunks of whole sentences of at most chunk_size tokens.
+
+    The text is parsed in bounded windows through nlp.pipe, so memory stays flat
+    on very large inputs. When score_keywords is set, textrank keywords are
+    accumulated across windows and chunks are returned most relevant first.
+    """
+    sp = get_nlp()
+    disabled = (
+        []
+        if score_keywords
+        else [pipe for pipe in NLP_KEYWORD_PIPES if pipe in sp.pipe_names]
+    )
+    keyword_scores = Counter()
+    content_chunks = []
+    chunk = []
+    chunk_len = 0
+    for doc in sp.pipe(iter_text_windows(text), disable=disabled):
+        if score_keywords:
+            for keyword, score in textrank(doc, topn=10):
+                keyword_scores[keyword] += score
+        for sentence in doc.sents:
+            sentence_tokens = len(sentence)
+            if chunk_len + sentence_tokens > chunk_size and chunk:
+                content_chunks.append(" ".join(chunk))
+                chunk = []
+                chunk_len = 0
+            # Keep token text only, so the Doc of a finished window can be freed.
+            chunk.extend(token.text for token in sentence)
+            chunk_len += sentence_tokens
+    if chunk:
+        content_chunks.append(" ".join(chunk))
+    if not score_keywords:
+        return content_chunks
+    keywords = set(keyword for keyword, _ in keyword_scores.most_common(10))
+    scored = [
+        (score_chunk(chunk_text, keywords), chunk_text) for chunk_text in content_chunks
+    ]
+    # Sort the chunks by their score in descending order before returning them
+    scored.sort(key=lambda x: x[0], reverse=True)
+    return [chunk_text for score, chunk_text in scored]
+
+
+def score_chunk(chunk: str, keywords: set) -> int:
+    """Score a chunk based on the number of query keywords it contains."""
+    chunk_counter = Counter(chunk.split())
+    return sum(chunk_counter[keyword] for keyword in keywords)
+
+
 def snake(old_str: str = ""):
     if not old_str:
         return ""
@@ -378,6 +430,7 @@ class SQLCollection:
                 synchronize_session="fetch"
             )
             self.session.commit()
+            vector_index.remove(agent_id=self.memories.agent_id, ids=ids)
             return True
         except Exception as e:
             self.session.rollback()
@@ -385,25 +438,51 @@ class SQLCollection:
             return False
 
     def add(self, ids, metadatas, documents):
+        conversation_id = (
+            None
+            if self.memories.collection_number == "0"
+            else self.memories.collection_number
+        )
         try:
-            for id, metadata, document in zip(ids, metadatas, documents):
-                embedding = embed([document])
-                memory = Memory(
-                    id=id,
-                    agent_id=self.memories.agent_id,
-                    conversation_id=(
-                        None
-                        if self.memories.collection_number == "0"
-                        else self.memories.collection_number
-                    ),
-                    embedding=embedding,
-                    text=document,
-                    external_source=metadata.get("external_source_name", "user input"),
-                    description=metadata.get("description", ""),
-                    additional_metadata=metadata.get("additional_metadata", ""),
+            if not self.memories.agent_id:
+                raise ValueError("agent_id is required")
+            documents = list(documents)
+            embeddings = get_embedding_engine().embed_array(documents)
+            rows = []
+            for id, metadata, document, embedding in zip(
+                ids, metadatas, documents, embeddings
+            ):
+                rows.append(
+                    {
+                        "id": id,
+                        "agent_id": self.memories.agent_id,
+                        "conversation_id": conversation_id,
+                        "embedding": embedding,
+                        "text": document,
+                        "external_source": metadata.get(
+                            "external_source_name", "user input"
+                        ),
+                        "description": metadata.get("description", ""),
+                        "additional_metadata": metadata.get("additional_metadata", ""),
+                    }
+                )
+            timestamps = []
+            if rows:
+                timestamps = (
+                    self.session.execute(
+                        insert(Memory).returning(Memory.timestamp), rows
+                    )
+                    .scalars()
+                    .all()
                 )
-                self.session.add(memory)
             self.session.commit()
+            vector_index.add(
+                agent_id=self.memories.agent_id,
+                conversation_id=conversation_id,
+                ids=[row["id"] for row in rows],
+                vectors=[row["embedding"] for row in rows],
+                timestamps=timestamps,
+            )
             return True
         except Exception as e:
             self.session.rollback()
@@ -431,6 +510,90 @@ def format_timestamp(timestamp):
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def memory_to_context(memory) -> str:
+    """Formats a memory row the way it is injected into prompt context"""
+    metadata = memory.additional_metadata if memory.additional_metadata else ""
+    external_source = memory.external_source if memory.external_source else None
+    timestamp = format_timestamp(memory.timestamp)
+    if external_source:
+        metadata = (
+            f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
+        )
+    return metadata
+
+
+def collection_to_conversation_id(collection_number: str = "0"):
+    """Collection "0" is the agent's core memory, anything else is a conversation"""
+    collection_number = str(collection_number)
+    if collection_number == "0":
+        return None
+    try:
+        return str(UUID(collection_number))
+    except:
+        return collection_number
+
+
+class RetrievalContext:
+    """
+    Request-scoped cache for memory retrieval.
+
+    Each distinct query is embedded once, and each (agent, collection, query,
+    min score) search runs once with at least prefetch_limit results. Later
+    calls asking for fewer results are served by slicing the cached list.
+    """
+
+    def __init__(self, prefetch_limit: int = 0):
+        self.prefetch_limit = int(prefetch_limit)
+        self.embeddings = {}
+        self.results = {}
+        self.embeds = 0
+        self.scans = 0
+        self.cache_hits = 0
+
+    def embed(self, text: str):
+        if text not in self.embeddings:
+            self.embeddings[text] = embed([text])[0]
+            self.embeds += 1
+        return self.embeddings[text]
+
+    def search(
+        self,
+        session,
+        agent_id,
+        conversation_id,
+        user_input: str,
+        limit: int,
+        min_relevance_score: float = 0.0,
+    ):
+        key = (str(agent_id), str(conversation_id), user_input, min_relevance_score)
+        cached = self.results.get(key)
+        # A short cached list is exhaustive, nothing else passed min_relevance_score.
+        if cached is not None and (
+            cached["limit"] >= limit or len(cached["results"]) < cached["limit"]
+        ):
+            self.cache_hits += 1
+            return cached["results"][:limit]
+        fetch_limit = max(int(limit), self.prefetch_limit)
+        results = get_similar_memories(
+            session,
+            self.embed(user_input),
+            agent_id,
+            conversation_id,
+            fetch_limit,
+            min_relevance_score,
+        )
+        self.scans += 1
+        self.results[key] = {"limit": fetch_limit, "results": results}
+        return results[:limit]
+
+    def stats(self):
+        return {
+            "embeds": self.embeds,
+            "scans": self.scans,
+            "cache_hits": self.cache_hits,
+        }
+
+
 class Memories:
     def __init__(
         self,
@@ -485,6 +648,9 @@ class Memories:
                 query = query.filter_by(conversation_id=conversation_id)
             query.delete()
             session.commit()
+            vector_index.invalidate(
+                agent_id=self.agent_id, conversation_id=conversation_id
+            )
             return True
         except Exception as e:
             session.rollback()
@@ -639,9 +805,53 @@ class Memories:
         return summary
 
     async def write_text_to_memory(
-        self, user_input: str, text: str, external_source: str = "user input"
+        self,
+        user_input: str,
+        text: str,
+        external_source: str = "user input",
+        progress_callback: Callable = None,
     ):
         """Write text to memory with proper validation"""
+        return await self.write_texts_to_memory(
+            user_input=user_input,
+            texts=[text],
+            external_source=external_source,
+            progress_callback=progress_callback,
+        )
+
+    async def embed_chunks(
+        self, chunks: List[str], progress_callback: Callable = None
+    ) -> np.ndarray:
+        """
+        Embed chunks in large batches off the event loop.
+
+        progress_callback(embedded, total) is called after every batch, it may be
+        a coroutine function.
+        """
+        engine = get_embedding_engine()
+        batch_size = engine.batch_size * int(getenv("EMBEDDING_INGEST_BATCHES"))
+        embeddings = []
+        for start in range(0, len(chunks), batch_size):
+            batch = chunks[start : start + batch_size]
+            embeddings.append(await asyncio.to_thread(engine.embed_array, batch))
+            done = min(start + batch_size, len(chunks))
+            logging.debug(f"Embedded {done}/{len(chunks)} chunks for {self.agent_name}")
+            if progress_callback:
+                result = progress_callback(done, len(chunks))
+                if asyncio.iscoroutine(result):
+                    await result
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(embeddings)
+
+    async def write_texts_to_memory(
+        self,
+        user_input: str,
+        texts: List[str],
+        external_source: str = "user input",
+        progress_callback: Callable = None,
+    ):
+        """Chunk, embed and store many texts from one source with a single bulk insert"""
         if not self.agent_id:
             logging.error(
                 f"No agent_id found for agent {self.agent_name} and user {self.user}"
@@ -656,58 +866,81 @@ class Memories:
                 logging.error(f"Agent not found with id {self.agent_id}")
                 return False
 
-            chunks = await self.chunk_content(text=text, chunk_size=self.chunk_size)
+            chunks = []
+            for text in texts:
+                # Every chunk is stored, so ordering them by keyword relevance is wasted work
+                chunks += await self.chunk_content(
+                    text=text, chunk_size=self.chunk_size, score_keywords=False
+                )
+            chunks = [chunk for chunk in chunks if chunk]
 
             # Handle core memories vs conversation memories
             conversation_id = (
                 None if self.collection_number == "0" else self.collection_number
             )
 
+            try:
+                embeddings = await self.embed_chunks(
+                    chunks=chunks, progress_callback=progress_callback
+                )
+            except Exception as e:
+                logging.error(f"Error generating embeddings: {str(e)}")
+                return False
+            if len(embeddings) != len(chunks):
+                logging.warning(
+                    f"Expected {len(chunks)} embeddings but received {len(embeddings)}"
+                )
+                return False
+
             # If replacing external source content, delete old entries
+            replaced = 0
             if external_source.startswith(("file", "http://", "https://")):
-                session.query(Memory).filter_by(
-                    agent_id=self.agent_id,
-                    conversation_id=conversation_id,
-                    external_source=external_source,
-                ).delete()
-
-            # Process all chunks first to ensure they're valid
-            memories_to_add = []
-            for chunk in chunks:
-                # Get embedding and ensure proper shape
-                try:
-                    chunk_embedding = embed([chunk])
-                    if not chunk_embedding or len(chunk_embedding) == 0:
-                        logging.warning(
-                            f"Failed to generate embedding for chunk: {chunk[:100]}..."
-                        )
-                        continue
-
-                    embedding = process_embedding_for_storage(chunk_embedding[0])
-
-                    memory = Memory(
-                        agent_id=self.agent_id,  # Explicitly set agent_id
+                replaced = (
+                    session.query(Memory)
+                    .filter_by(
+                        agent_id=self.agent_id,
                         conversation_id=conversation_id,
-                        embedding=embedding,
-                        text=chunk,
                         external_source=external_source,
-                        description=user_input,
-                        additional_metadata=chunk,
                     )
-                    # Validate memory object
-                    if not memory.agent_id:
-                        logging.error("Memory created with null agent_id")
-                        continue
-
-                    memories_to_add.append(memory)
-                except Exception as e:
-                    logging.error(f"Error processing chunk: {str(e)}")
-                    continue
+                    .delete()
+                )
+
+            memories_to_add = [
+                {
+                    "id": get_new_row_id(),
+                    "agent_id": self.agent_id,
+                    "conversation_id": conversation_id,
+                    "embedding": process_embedding_for_storage(embedding),
+                    "text": chunk,
+                    "external_source": external_source,
+                    "description": user_input,
+                    "additional_metadata": chunk,
+                }
+                for chunk, embedding in zip(chunks, embeddings)
+            ]
 
-            # Add all valid memories
+            # Add all valid memories in one executemany round-trip
             if memories_to_add:
-                session.bulk_save_objects(memories_to_add)
+                timestamps = (
+                    session.execute(
+                        insert(Memory).returning(Memory.timestamp), memories_to_add
+                    )
+                    .scalars()
+                    .all()
+                )
                 session.commit()
+                if replaced:
+                    vector_index.invalidate(
+                        agent_id=self.agent_id, conversation_id=conversation_id
+                    )
+                else:
+                    vector_index.add(
+                        agent_id=self.agent_id,
+                        conversation_id=conversation_id,
+                        ids=[memory["id"] for memory in memories_to_add],
+                        vectors=embeddings,
+                        timestamps=timestamps,
+                    )
                 logging.info(f"Successfully added {len(memories_to_add)} memories")
                 return True
             else:
@@ -721,58 +954,97 @@ class Memories:
         finally:
             session.close()
 
+    def search_memories(
+        self,
+        session,
+        user_input: str,
+        limit: int,
+        min_relevance_score: float = 0.0,
+        retrieval_context: RetrievalContext = None,
+    ):
+        conversation_id = (
+            None if self.collection_number == "0" else self.collection_number
+        )
+        if retrieval_context is not None:
+            return retrieval_context.search(
+                session=session,
+                agent_id=self.agent_id,
+                conversation_id=conversation_id,
+                user_input=user_input,
+                limit=limit,
+                min_relevance_score=min_relevance_score,
+            )
+        # Get similar memories using the new helper function
+        return get_similar_memories(
+            session,
+            embed([user_input])[0],
+            self.agent_id,
+            conversation_id,
+            limit,
+            min_relevance_score,
+        )
+
+    def find_memories(
+        self,
+        user_input: str,
+        limit: int,
+        min_relevance_score: float = 0.0,
+        retrieval_context: RetrievalContext = None,
+    ):
+        """search_memories with its own session, safe to run on a worker thread"""
+        session = get_session()
+        try:
+            return self.search_memories(
+                session=session,
+                user_input=user_input,
+                limit=limit,
+                min_relevance_score=min_relevance_score,
+                retrieval_context=retrieval_context,
+            )
+        finally:
+            session.close()
+
     # Update the get_memories_data method:
     async def get_memories_data(
         self,
         user_input: str,
         limit: int,
         min_relevance_score: float = 0.0,
+        retrieval_context: RetrievalContext = None,
     ) -> List[dict]:
         if not user_input:
             return []
 
-        session = get_session()
-        try:
-            query_embedding = embed([user_input])[0]
-            conversation_id = (
-                None if self.collection_number == "0" else self.collection_number
-            )
+        memory_results = await asyncio.to_thread(
+            self.find_memories,
+            user_input=user_input,
+            limit=limit,
+            min_relevance_score=min_relevance_score,
+            retrieval_context=retrieval_context,
+        )
 
-            # Get similar memories using the new helper function
-            memory_results = get_similar_memories(
-                session,
-                query_embedding,
-                self.agent_id,
-                conversation_id,
-                limit,
-                min_relevance_score,
+        # Format results
+        memories = []
+        for memory, similarity in memory_results:
+            memories.append(
+                {
+                    "external_source_name": memory.external_source,
+                    "id": str(memory.id),
+                    "key": str(memory.id),
+                    "description": memory.description,
+                    "text": memory.text,
+                    "embedding": (
+                        memory.embedding.tolist()
+                        if isinstance(memory.embedding, np.ndarray)
+                        else memory.embedding
+                    ),
+                    "additional_metadata": memory.additional_metadata,
+                    "timestamp": format_timestamp_iso(memory.timestamp),
+                    "relevance_score": float(similarity),
+                }
             )
 
-            # Format results
-            memories = []
-            for memory, similarity in memory_results:
-                memories.append(
-                    {
-                        "external_source_name": memory.external_source,
-                        "id": str(memory.id),
-                        "key": str(memory.id),
-                        "description": memory.description,
-                        "text": memory.text,
-                        "embedding": (
-                            memory.embedding.tolist()
-                            if isinstance(memory.embedding, np.ndarray)
-                            else memory.embedding
-                        ),
-                        "additional_metadata": memory.additional_metadata,
-                        "timestamp": format_timestamp_iso(memory.timestamp),
-                        "relevance_score": float(similarity),
-                    }
-                )
-
-            return memories
-
-        finally:
-            session.close()
+        return memories
 
     # Update the get_memories method similarly:
     async def get_memories(
@@ -780,45 +1052,98 @@ class Memories:
         user_input: str,
         limit: int,
         min_relevance_score: float = 0.0,
+        retrieval_context: RetrievalContext = None,
     ) -> List[str]:
-        session = get_session()
-        try:
-            query_embedding = embed([user_input])[0]
-            conversation_id = (
-                None if self.collection_number == "0" else self.collection_number
-            )
-
-            # Get similar memories using the new helper function
-            memory_results = get_similar_memories(
-                session,
-                query_embedding,
-                self.agent_id,
-                conversation_id,
-                limit,
-                min_relevance_score,
-            )
-
-            # Format results
-            response = []
-            for memory, similarity in memory_results:
-                metadata = (
-                    memory.additional_metadata if memory.additional_metadata else ""
-                )
-                external_source = (
-                    memory.external_source if memory.external_source else None
-                )
-                timestamp = format_timestamp(memory.timestamp)
+        memory_results = await asyncio.to_thread(
+            self.find_memories,
+            user_input=user_input,
+            limit=limit,
+            min_relevance_score=min_relevance_score,
+            retrieval_context=retrieval_context,
+        )
 
-                if external_source:
-                    metadata = f"Sourced from {external_source}:\nSourced on: {timestamp}\n{metadata}"
+        # Format results
+        response = []
+        for memory, similarity in memory_results:
+            metadata = memory_to_context(memory)
+            if metadata not in response and metadata != "":
+                response.append(metadata)
 
-                if metadata not in response and metadata != "":
-                    response.append(metadata)
+        return response
 
-            return response
+    async def search_scopes_async(
+        self,
+        user_input: str,
+        scopes: List[dict],
+        retrieval_context: RetrievalContext = None,
+    ) -> List[tuple]:
+        """search_scopes on a worker thread, embedding and scoring are CPU bound"""
+        return await asyncio.to_thread(
+            self.search_scopes,
+            user_input=user_input,
+            scopes=scopes,
+            retrieval_context=retrieval_context,
+        )
 
+    def search_scopes(
+        self,
+        user_input: str,
+        scopes: List[dict],
+        retrieval_context: RetrievalContext = None,
+    ) -> List[tuple]:
+        """
+        Search several (agent, collection) scopes with one embedding and one session.
+
+        Each scope is a dict with a "scope" tag, "limit" and "min_relevance_score",
+        and optionally "agent_id" and "collection" (defaulting to this instance's).
+        Returns (scope, memory, relevance_score) tuples sorted by relevance, a memory
+        found by several scopes is only returned once, tagged with the first of them.
+        """
+        if not user_input or not scopes:
+            return []
+        tags = []
+        searches = []
+        for scope in scopes:
+            agent_id = scope.get("agent_id", self.agent_id)
+            if not agent_id:
+                continue
+            tags.append(scope["scope"])
+            searches.append(
+                {
+                    "agent_id": agent_id,
+                    "conversation_id": collection_to_conversation_id(
+                        scope.get("collection", self.collection_number)
+                    ),
+                    "limit": int(scope["limit"]),
+                    "min_score": float(scope.get("min_relevance_score", 0.0)),
+                }
+            )
+        if not searches:
+            return []
+        query_embedding = (
+            retrieval_context.embed(user_input)
+            if retrieval_context is not None
+            else embed([user_input])[0]
+        )
+        session = get_session()
+        try:
+            scope_results = get_similar_memories_for_scopes(
+                session, query_embedding, searches
+            )
         finally:
             session.close()
+        if retrieval_context is not None:
+            retrieval_context.scans += 1
+        results = []
+        seen = set()
+        for tag, memory_results in zip(tags, scope_results):
+            for memory, similarity in memory_results:
+                if str(memory.id) in seen:
+                    continue
+                seen.add(str(memory.id))
+                results.append((tag, memory, float(similarity)))
+        results.sort(key=lambda x: x[2], reverse=True)
+        return results
 
     async def get_external_data_sources(self):
         session = get_session()
@@ -853,6 +1178,7 @@ class Memories:
             )
 
             session.commit()
+            vector_index.invalidate(agent_id=self.agent_id)
             return bool(result)
         except Exception as e:
             session.rollback()
@@ -863,37 +1189,17 @@ class Memories:
 
     def score_chunk(self, chunk: str, keywords: set) -> int:
         """Score a chunk based on the number of query keywords it contains."""
-        chunk_counter = Counter(chunk.split())
-        score = sum(chunk_counter[keyword] for keyword in keywords)
-        return score
+        return score_chunk(chunk=chunk, keywords=keywords)
 
-    async def chunk_content(self, text: str, chunk_size: int) -> List[str]:
-        doc = nlp(text)
-        sentences = list(doc.sents)
-        content_chunks = []
-        chunk = []
-        chunk_len = 0
-        keywords = set(extract_keywords(doc=doc, limit=10))
-        for sentence in sentences:
-            sentence_tokens = len(sentence)
-            if chunk_len + sentence_tokens > chunk_size and chunk:
-                chunk_text = " ".join(token.text for token in chunk)
-                content_chunks.append(
-                    (self.score_chunk(chunk_text, keywords), chunk_text)
-                )
-                chunk = []
-                chunk_len = 0
-
-            chunk.extend(sentence)
-            chunk_len += sentence_tokens
-
-        if chunk:
-            chunk_text = " ".join(token.text for token in chunk)
-            content_chunks.append((self.score_chunk(chunk_text, keywords), chunk_text))
-
-        # Sort the chunks by their score in descending order before returning them
-        content_chunks.sort(key=lambda x: x[0], reverse=True)
-        return [chunk_text for score, chunk_text in content_chunks]
+    async def chunk_content(
+        self, text: str, chunk_size: int, score_keywords: bool = True
+    ) -> List[str]:
+        return await asyncio.to_thread(
+            stream_chunks,
+            text=text,
+            chunk_size=int(chunk_size),
+            score_keywords=score_keywords,
+        )
 
     async def get_transcription(self, video_id: str = None):
         if "?v=" in video_id:
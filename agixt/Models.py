@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import date, datetime
 from typing import List, Optional, Dict, Any, Union
 from pydantic.fields import Field
 from Globals import getenv
@@ -258,6 +258,8 @@ class HistoryModel(BaseModel):
     conversation_name: Optional[str] = None
     limit: Optional[int] = 100
     page: Optional[int] = 1
+    # next_cursor of the previous page, takes precedence over page
+    cursor: Optional[str] = None
 
 
 class FeedbackInput(BaseModel):
@@ -538,6 +540,7 @@ class ConversationDetailResponse(BaseModel):
 
 class ConversationHistoryResponse(BaseModel):
     conversation_history: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
 
 
 class NotificationResponse(BaseModel):
@@ -615,3 +618,17 @@ class UpdateUserRole(BaseModel):
 
 class RenameCompanyInput(BaseModel):
     name: str
+
+
+class TokenUsageDay(BaseModel):
+    date: date
+    agent_id: Optional[str] = None
+    agent_name: Optional[str] = None
+    input_tokens: int
+    output_tokens: int
+
+
+class TokenUsageResponse(BaseModel):
+    input_tokens: int
+    output_tokens: int
+    usage: List[TokenUsageDay]
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import threading
+import weakref
+import importlib.util
+import httpx
+from Globals import getenv
+from ProviderHealth import current_attempt
+
+# HTTP/2 support for httpx, installed with httpx[http2]
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+def get_provider_timeout(timeout: float = None) -> httpx.Timeout:
+    """Timeout for provider requests, PROVIDER_TIMEOUT seconds unless given"""
+    timeout = float(timeout) if timeout else float(getenv("PROVIDER_TIMEOUT"))
+    connect = min(timeout, float(getenv("PROVIDER_CONNECT_TIMEOUT")))
+    return httpx.Timeout(timeout, connect=connect)
+
+
+async def record_provider_response(response: httpx.Response):
+    """Report status and rate limit headers to the rotation attempt in flight"""
+    attempt = current_attempt.get()
+    if attempt is not None:
+        attempt.record_response(response.status_code, response.headers)
+
+
+class ProviderClients:
+    """
+    Pooled HTTP clients shared by every provider in the worker.
+
+    Providers used to construct (or reconfigure the global) SDK clients on
+    every call, paying a new TLS handshake each time and blocking the event
+    loop with synchronous requests. Here each event loop gets one
+    httpx.AsyncClient with keep-alive (and HTTP/2 when h2 is installed, so
+    many in-flight completions multiplex over a few connections), and SDK
+    clients are built once per (loop, provider, credentials, endpoint) on top
+    of it. Connections cannot move between event loops, hence the per-loop
+    pools. A synchronous pool serves the few sync callers (embeddings).
+    """
+
+    def __init__(self):
+        # event loop -> {"http": httpx.AsyncClient, "sdk": {key: client}}
+        self.loops = weakref.WeakKeyDictionary()
+        self.sync_http = None
+        self.sync_sdk = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def limits() -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=int(getenv("PROVIDER_MAX_CONNECTIONS")),
+            max_keepalive_connections=int(getenv("PROVIDER_MAX_KEEPALIVE")),
+            keepalive_expiry=30,
+        )
+
+    def get_loop_clients(self) -> dict:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = self.loops.get(loop)
+            if clients is None or clients["http"].is_closed:
+                clients = {
+                    "http": httpx.AsyncClient(
+                        http2=HTTP2,
+                        limits=self.limits(),
+                        timeout=get_provider_timeout(),
+                        follow_redirects=True,
+                        event_hooks={"response": [record_provider_response]},
+                    ),
+                    "sdk": {},
+                }
+                self.loops[loop] = clients
+            return clients
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        return self.get_loop_clients()["http"]
+
+    def get_sync_http_client(self) -> httpx.Client:
+        with self.lock:
+            if self.sync_http is None or self.sync_http.is_closed:
+                self.sync_http = httpx.Client(
+                    http2=HTTP2,
+                    limits=self.limits(),
+                    timeout=get_provider_timeout(),
+                    follow_redirects=True,
+                )
+                self.sync_sdk = {}
+            return self.sync_http
+
+    def get_sdk_client(self, key: tuple, factory):
+        """SDK client for key on this loop, factory(http_client) builds it once"""
+        clients = self.get_loop_clients()
+        with self.lock:
+            client = clients["sdk"].get(key)
+            if client is None:
+                if len(clients["sdk"]) >= 256:
+                    clients["sdk"].clear()
+                client = factory(clients["http"])
+                clients["sdk"][key] = client
+            return client
+
+    def get_sync_sdk_client(self, key: tuple, factory):
+        http_client = self.get_sync_http_client()
+        with self.lock:
+            client = self.sync_sdk.get(key)
+            if client is None:
+                if len(self.sync_sdk) >= 256:
+                    self.sync_sdk.clear()
+                client = factory(http_client)
+                self.sync_sdk[key] = client
+            return client
+
+    async def aclose(self):
+        """Close the pool of the running loop and the synchronous pool"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = self.loops.pop(loop, None)
+            sync_http = self.sync_http
+            self.sync_http = None
+            self.sync_sdk = {}
+        if clients is not None:
+            await clients["http"].aclose()
+        if sync_http is not None:
+            sync_http.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "event_loops": len(self.loops),
+                "sdk_clients": sum(len(c["sdk"]) for c in self.loops.values()),
+                "http2": HTTP2,
+            }
+
+
+provider_clients = ProviderClients()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    return provider_clients.get_http_client()
+
+
+def get_openai_client(api_key: str, base_url: str, timeout: float = None):
+    import openai
+
+    return provider_clients.get_sdk_client(
+        ("openai", api_key, base_url, timeout),
+        lambda http_client: openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            timeout=get_provider_timeout(timeout),
+            max_retries=0,
+        ),
+    )
+
+
+def get_sync_openai_client(api_key: str, base_url: str, timeout: float = None):
+    import openai
+
+    return provider_clients.get_sync_sdk_client(
+        ("openai", api_key, base_url, timeout),
+        lambda http_client: openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=http_client,
+            timeout=get_provider_timeout(timeout),
+            max_retries=0,
+        ),
+    )
+
+
+def get_azure_openai_client(
+    api_key: str,
+    azure_endpoint: str,
+    azure_deployment: str,
+    api_version: str = "2024-02-01",
+    timeout: float = None,
+):
+    import openai
+
+    return provider_clients.get_sdk_client(
+        ("azure", api_key, azure_endpoint, azure_deployment, api_version, timeout),
+        lambda http_client: openai.AsyncAzureOpenAI(
+            api_key=api_key,
+            api_version=api_version,
+            azure_endpoint=azure_endpoint,
+            azure_deployment=azure_deployment,
+            http_client=http_client,
+            timeout=get_provider_timeout(timeout),
+            max_retries=0,
+        ),
+    )
+
+
+def get_anthropic_client(
+    api_key: str,
+    vertex_region: str = None,
+    vertex_project_id: str = None,
+    timeout: float = None,
+):
+    import anthropic
+
+    if vertex_project_id:
+        return provider_clients.get_sdk_client(
+            ("anthropic_vertex", api_key, vertex_region, vertex_project_id, timeout),
+            lambda http_client: anthropic.AsyncAnthropicVertex(
+                access_token=api_key,
+                region=vertex_region,
+                project_id=vertex_project_id,
+                http_client=http_client,
+                timeout=get_provider_timeout(timeout),
+                max_retries=0,
+            ),
+        )
+    return provider_clients.get_sdk_client(
+        ("anthropic", api_key, timeout),
+        lambda http_client: anthropic.AsyncAnthropic(
+            api_key=api_key,
+            http_client=http_client,
+            timeout=get_provider_timeout(timeout),
+            max_retries=0,
+        ),
+    )
+
+
+def get_chat_messages(prompt: str, images: list = []) -> list:
+    """OpenAI style messages for a prompt with optional image paths or URLs"""
+    messages = []
+    if len(images) > 0:
+        messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
+        for image in images:
+            if image.startswith("http"):
+                messages[0]["content"].append(
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image,
+                        },
+                    }
+                )
+            else:
+                file_type = image.split(".")[-1]
+                with open(image, "rb") as f:
+                    image_base64 = f.read()
+                messages[0]["content"].append(
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/{file_type};base64,{image_base64}"
+                        },
+                    }
+                )
+    else:
+        messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+async def stream_chat_completion(client, fallback, **kwargs):
+    """
+    Yield the content deltas of a streamed OpenAI style chat completion.
+
+    If the request fails before the first token, fallback() (the provider's
+    non-streaming inference with its own retry handling) is awaited and its
+    answer yielded whole. Failures after the first token are raised.
+    """
+    started = False
+    try:
+        stream = await client.chat.completions.create(stream=True, **kwargs)
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                started = True
+                yield content
+    except Exception as e:
+        if started:
+            raise
+        logging.info(f"Streaming request failed, retrying without streaming: {e}")
+        yield await fallback()
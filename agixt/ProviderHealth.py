@@ -0,0 +1,343 @@
+import re
+import time
+import hashlib
+import logging
+import threading
+import contextvars
+from collections import deque
+from datetime import datetime, timezone
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Set around a provider call so the shared HTTP clients can report what they saw
+current_attempt = contextvars.ContextVar("provider_attempt", default=None)
+
+REMAINING_HEADERS = {
+    "requests": (
+        "x-ratelimit-remaining-requests",
+        "anthropic-ratelimit-requests-remaining",
+    ),
+    "tokens": (
+        "x-ratelimit-remaining-tokens",
+        "anthropic-ratelimit-tokens-remaining",
+        "anthropic-ratelimit-input-tokens-remaining",
+    ),
+}
+RESET_HEADERS = (
+    "retry-after",
+    "x-ratelimit-reset-requests",
+    "x-ratelimit-reset-tokens",
+    "anthropic-ratelimit-requests-reset",
+    "anthropic-ratelimit-tokens-reset",
+)
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset(value: str) -> float:
+    """Seconds until a limit resets, from retry-after, OpenAI (1m30s) or RFC 3339"""
+    value = str(value).strip()
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    if "T" in value:
+        try:
+            reset = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return 0.0
+        return max((reset - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    return sum(
+        float(amount) * DURATION_UNITS[unit]
+        for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    )
+
+
+class ProviderError(Exception):
+    """A provider call failed after the provider's own retries"""
+
+
+def in_rotation() -> bool:
+    """Whether the running provider call was made by the rotation provider"""
+    return current_attempt.get() is not None
+
+
+def provider_error(message: str) -> str:
+    """
+    Answer for a failed provider call. Providers show errors to the user as
+    the answer, inside a rotation attempt it is raised instead so the failure
+    is recorded and the next provider is tried.
+    """
+    if in_rotation():
+        raise ProviderError(message)
+    return message
+
+
+class ProviderAttempt:
+    """HTTP responses received while one provider call is in flight"""
+
+    def __init__(self, health):
+        self.health = health
+        self.statuses = []
+
+    def record_response(self, status_code: int, headers):
+        self.statuses.append(status_code)
+        self.health.record_rate_limits(headers, rate_limited=status_code == 429)
+
+    @property
+    def failed(self) -> bool:
+        # For providers that still return API errors as text, the statuses tell
+        # whether anything actually succeeded
+        return bool(self.statuses) and all(status >= 400 for status in self.statuses)
+
+
+class ProviderHealth:
+    """
+    Rolling health of one provider configuration in this worker.
+
+    Keeps the last ROTATION_STATS_WINDOW calls for latency percentiles and the
+    error rate, and the latest rate limit headers. After
+    ROTATION_FAILURE_THRESHOLD consecutive failures the circuit opens for
+    ROTATION_OPEN_SECONDS, doubling each time it reopens up to
+    ROTATION_MAX_OPEN_SECONDS. Once that passes a single probe request is let
+    through (half open): success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, key: str, provider: str):
+        self.key = key
+        self.provider = provider
+        # (latency in seconds, succeeded)
+        self.samples = deque(maxlen=int(getenv("ROTATION_STATS_WINDOW")))
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.rate_limited_until = 0.0
+        self.remaining = {}
+        self.remaining_at = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+
+    def retry_at(self) -> float:
+        return max(self.open_until, self.rate_limited_until)
+
+    def ready(self, tokens: int = 0) -> bool:
+        """Whether a request of `tokens` input tokens may be sent now"""
+        now = time.time()
+        with self.lock:
+            if self.rate_limited_until > now:
+                return False
+            if self.state == "open" and self.open_until > now:
+                return False
+            if self.state != "closed" and self.probing:
+                return False
+            remaining_tokens = self.remaining.get("tokens")
+            if (
+                tokens
+                and remaining_tokens is not None
+                and remaining_tokens < tokens
+                and now - self.remaining_at < 60
+            ):
+                return False
+            return True
+
+    def begin(self):
+        """Claim the probe when the circuit is not closed"""
+        with self.lock:
+            if self.state == "open" and self.open_until <= time.time():
+                self.state = "half_open"
+            if self.state == "half_open":
+                self.probing = True
+
+    def release(self):
+        """Give up the probe of a call that was cancelled before it finished"""
+        with self.lock:
+            self.probing = False
+
+    def record_success(self, latency: float):
+        with self.lock:
+            self.samples.append((latency, True))
+            self.requests += 1
+            self.consecutive_failures = 0
+            self.times_opened = 0
+            self.state = "closed"
+            self.probing = False
+
+    def record_failure(self, latency: float, error=None):
+        now = time.time()
+        with self.lock:
+            self.samples.append((latency, False))
+            self.requests += 1
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)[:500] if error is not None else None
+            if self.state == "half_open" or self.consecutive_failures >= int(
+                getenv("ROTATION_FAILURE_THRESHOLD")
+            ):
+                self.times_opened += 1
+                cooldown = min(
+                    float(getenv("ROTATION_OPEN_SECONDS"))
+                    * 2 ** (self.times_opened - 1),
+                    float(getenv("ROTATION_MAX_OPEN_SECONDS")),
+                )
+                self.state = "open"
+                self.open_until = now + cooldown
+                self.probing = False
+                logging.warning(
+                    f"Provider {self.provider} circuit opened for {cooldown:.0f}s: {self.last_error}"
+                )
+
+    def record_rate_limits(self, headers, rate_limited: bool = False):
+        remaining = {}
+        for name, header_names in REMAINING_HEADERS.items():
+            for header in header_names:
+                if header in headers:
+                    try:
+                        remaining[name] = int(float(headers[header]))
+                    except ValueError:
+                        pass
+                    break
+        if remaining.get("requests") == 0:
+            rate_limited = True
+        reset = 0.0
+        if rate_limited:
+            resets = [
+                parse_reset(headers[header])
+                for header in RESET_HEADERS
+                if header in headers
+            ]
+            # Without a reset time, back off for a second
+            reset = max(resets) if resets else 1.0
+        with self.lock:
+            if remaining:
+                self.remaining.update(remaining)
+                self.remaining_at = time.time()
+            if reset:
+                self.rate_limited_until = max(
+                    self.rate_limited_until, time.time() + reset
+                )
+
+    def percentile(self, percent: float, successful_only: bool = True):
+        """Latency percentile in seconds, None until there are samples"""
+        with self.lock:
+            latencies = sorted(
+                latency for latency, ok in self.samples if ok or not successful_only
+            )
+        if not latencies:
+            return None
+        index = min(int(len(latencies) * percent / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def error_rate(self) -> float:
+        with self.lock:
+            if not self.samples:
+                return 0.0
+            return sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+
+    def stats(self):
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        now = time.time()
+        with self.lock:
+            return {
+                "provider": self.provider,
+                "key": self.key,
+                "state": self.state,
+                "samples": len(self.samples),
+                "requests": self.requests,
+                "failures": self.failures,
+                "consecutive_failures": self.consecutive_failures,
+                "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "error_rate": round(
+                    (
+                        sum(1 for _, ok in self.samples if not ok) / len(self.samples)
+                        if self.samples
+                        else 0.0
+                    ),
+                    4,
+                ),
+                "open_for_seconds": round(max(self.open_until - now, 0.0), 1),
+                "rate_limited_for_seconds": round(
+                    max(self.rate_limited_until - now, 0.0), 1
+                ),
+                "remaining": dict(self.remaining),
+                "last_error": self.last_error,
+            }
+
+
+class ProviderHealthRegistry:
+    """Health of every provider configuration used in this worker"""
+
+    def __init__(self):
+        self.providers = {}
+        self.decisions = deque(maxlen=int(getenv("ROTATION_DECISION_LOG_SIZE")))
+        # (user, agent name) -> hedged request counters
+        self.hedging = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(provider: str, settings: dict) -> str:
+        # Providers used with different keys, endpoints or models are tracked
+        # apart, the key only carries a hash of their settings
+        prefix = f"{provider.upper()}_"
+        provider_settings = sorted(
+            (key, str(value))
+            for key, value in settings.items()
+            if str(key).startswith(prefix)
+        )
+        digest = hashlib.sha256(repr(provider_settings).encode()).hexdigest()
+        return f"{provider}:{digest[:12]}"
+
+    def get(self, provider: str, settings: dict) -> ProviderHealth:
+        key = self.get_key(provider, settings)
+        with self.lock:
+            health = self.providers.get(key)
+            if health is None:
+                health = ProviderHealth(key=key, provider=provider)
+                self.providers[key] = health
+            return health
+
+    def record_decision(self, **decision):
+        decision["timestamp"] = datetime.now(timezone.utc).isoformat()
+        with self.lock:
+            self.decisions.append(decision)
+
+    def record_hedge(self, user, agent_name: str, **counts):
+        with self.lock:
+            hedging = self.hedging.setdefault(
+                (str(user), agent_name),
+                {
+                    "requests": 0,
+                    "hedged": 0,
+                    "primary_wins": 0,
+                    "backup_wins": 0,
+                    "failed": 0,
+                    "cancelled": 0,
+                },
+            )
+            for name, count in counts.items():
+                hedging[name] += count
+
+    def stats(self):
+        with self.lock:
+            providers = list(self.providers.values())
+            decisions = list(self.decisions)
+            hedging = [
+                {"user": user, "agent_name": agent_name, **counts}
+                for (user, agent_name), counts in self.hedging.items()
+            ]
+        return {
+            "providers": [health.stats() for health in providers],
+            "decisions": decisions,
+            "hedging": hedging,
+        }
+
+
+provider_health = ProviderHealthRegistry()
@@ -0,0 +1,113 @@
+import re
+import asyncio
+import logging
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+# Tags whose content is never shown to the user, even inside <answer>
+HIDDEN_TAGS = {"thinking", "reflection", "execute", "output", "rate", "reward", "count"}
+THOUGHT_TAGS = {"thinking", "reflection"}
+PARTIAL_TAG = re.compile(r"</?[a-z_]*$")
+TAG = re.compile(r"<(/?)([a-z_]+)>")
+
+
+class AnswerStream:
+    """
+    Incremental filter turning raw model tokens into the text the user sees.
+
+    Only what the model writes inside <answer> is put on the queue, with
+    <thinking>, <reflection>, <execute> and <output> blocks dropped as they
+    arrive. A tag split across tokens is held back until it is complete, as is
+    the start of any `replacements` key so URLs are rewritten in one piece.
+    feed() returns True when a thought was just completed so the caller can
+    log it as a subactivity without waiting for the whole response.
+    """
+
+    def __init__(self, queue: asyncio.Queue, replacements: dict = None):
+        self.queue = queue
+        self.replacements = replacements or {}
+        self.buffer = ""
+        self.pending = ""
+        self.in_answer = False
+        self.hidden = None
+        self.in_thought = False
+        self.text = ""
+
+    def feed(self, token: str) -> bool:
+        thought_completed = False
+        self.buffer += token
+        while self.buffer:
+            start = self.buffer.find("<")
+            if start == -1:
+                self.emit(self.buffer)
+                self.buffer = ""
+                break
+            if start > 0:
+                self.emit(self.buffer[:start])
+                self.buffer = self.buffer[start:]
+            match = TAG.match(self.buffer)
+            if not match:
+                if PARTIAL_TAG.match(self.buffer):
+                    # Wait for the rest of the tag
+                    break
+                self.emit("<")
+                self.buffer = self.buffer[1:]
+                continue
+            self.buffer = self.buffer[match.end() :]
+            closing, name = match.group(1) == "/", match.group(2)
+            if self.in_thought and (name in THOUGHT_TAGS or name == "answer"):
+                # Either the thought was closed or the next block started
+                self.in_thought = False
+                thought_completed = True
+            if name == "answer":
+                self.in_answer = not closing
+                self.hidden = None
+                self.flush()
+            elif name in HIDDEN_TAGS:
+                if not closing:
+                    if self.hidden is None:
+                        self.flush()
+                        self.hidden = name
+                    if name in THOUGHT_TAGS:
+                        self.in_thought = True
+                elif self.hidden == name:
+                    self.hidden = None
+            else:
+                self.emit(match.group(0))
+        return thought_completed
+
+    def emit(self, text: str):
+        if not self.in_answer or self.hidden is not None:
+            return
+        text = self.pending + text
+        for old, new in self.replacements.items():
+            text = text.replace(old, new)
+        held = 0
+        for old in self.replacements:
+            for length in range(min(len(old) - 1, len(text)), held, -1):
+                if text.endswith(old[:length]):
+                    held = length
+                    break
+        self.pending = text[len(text) - held :] if held else ""
+        self.put(text[: len(text) - held])
+
+    def flush(self):
+        text = self.pending
+        self.pending = ""
+        self.put(text)
+
+    def put(self, text: str):
+        if text:
+            self.text += text
+            self.queue.put_nowait(text)
+
+    def close(self):
+        """Emit whatever is still held back once the model is done"""
+        buffer = self.buffer
+        self.buffer = ""
+        self.emit(buffer)
+        self.flush()
@@ -1,8 +1,9 @@
-from DB import get_session, TaskCategory, TaskItem, Agent
+from DB import get_async_session, TaskCategory, TaskItem, Agent
 from Globals import getenv
 from agixtsdk import AGiXTSDK
 from MagicalAuth import MagicalAuth
-from Conversations import get_conversation_name_by_id
+from Conversations import get_conversation_name_by_id_async
+from sqlalchemy import select
 from sqlalchemy.orm import joinedload
 from concurrent.futures import ThreadPoolExecutor
 import datetime
@@ -24,32 +25,29 @@ class Task:
         memory_collection: str = "0",
     ) -> str:
         """Create a new task category"""
-        session = get_session()
-        category = TaskCategory(
-            user_id=self.user_id,
-            name=name,
-            description=description,
-            category_id=parent_category_id,
-            memory_collection=memory_collection,
-        )
-        session.add(category)
-        session.commit()
-        category_id = str(category.id)
-        session.close()
-        return category_id
+        async with get_async_session() as session:
+            category = TaskCategory(
+                user_id=self.user_id,
+                name=name,
+                description=description,
+                category_id=parent_category_id,
+                memory_collection=memory_collection,
+            )
+            session.add(category)
+            await session.commit()
+            return str(category.id)
 
     async def get_category(self, category_name: str) -> TaskCategory:
         """Get a category by name"""
-        session = get_session()
-        category = (
-            session.query(TaskCategory)
-            .filter(
-                TaskCategory.name == category_name, TaskCategory.user_id == self.user_id
+        async with get_async_session() as session:
+            return await session.scalar(
+                select(TaskCategory)
+                .where(
+                    TaskCategory.name == category_name,
+                    TaskCategory.user_id == self.user_id,
+                )
+                .limit(1)
             )
-            .first()
-        )
-        session.close()
-        return category
 
     async def create_task(
         self,
@@ -63,81 +61,74 @@ class Task:
         memory_collection: str = "0",
     ) -> str:
         """Create a new task"""
-        session = get_session()
-
         # Get or create category
         category = await self.get_category(category_name)
-        if not category:
+        if category:
+            category_id = category.id
+        else:
             category_id = await self.create_category(category_name)
-            category = session.query(TaskCategory).get(category_id)
 
-        # Get agent ID if agent_name provided
-        agent_id = None
-        if agent_name:
-            agent = (
-                session.query(Agent)
-                .filter(Agent.name == agent_name, Agent.user_id == self.user_id)
-                .first()
+        async with get_async_session() as session:
+            # Get agent ID if agent_name provided
+            agent_id = None
+            if agent_name:
+                agent_id = await session.scalar(
+                    select(Agent.id)
+                    .where(Agent.name == agent_name, Agent.user_id == self.user_id)
+                    .limit(1)
+                )
+
+            task = TaskItem(
+                user_id=self.user_id,
+                category_id=category_id,
+                title=title,
+                description=description,
+                agent_id=agent_id,
+                due_date=due_date,
+                estimated_hours=estimated_hours,
+                priority=priority,
+                scheduled=bool(due_date),
+                memory_collection=memory_collection,
             )
-            if agent:
-                agent_id = agent.id
-
-        task = TaskItem(
-            user_id=self.user_id,
-            category_id=category.id,
-            title=title,
-            description=description,
-            agent_id=agent_id,
-            due_date=due_date,
-            estimated_hours=estimated_hours,
-            priority=priority,
-            scheduled=bool(due_date),
-            memory_collection=memory_collection,
-        )
-        session.add(task)
-        session.commit()
-        task_id = str(task.id)
-        session.close()
-        return task_id
+            session.add(task)
+            await session.commit()
+            return str(task.id)
 
     async def get_pending_tasks(self) -> list:
         """Get all pending tasks that are due"""
-        session = get_session()
         now = datetime.datetime.now()
-        tasks = (
-            session.query(TaskItem)
-            .options(joinedload(TaskItem.category))  # Eager load the category
-            .filter(
-                TaskItem.user_id == self.user_id,
-                TaskItem.completed == False,
-                TaskItem.scheduled == True,
-                TaskItem.due_date <= now,
+        async with get_async_session() as session:
+            tasks = await session.scalars(
+                select(TaskItem)
+                .options(joinedload(TaskItem.category))  # Eager load the category
+                .where(
+                    TaskItem.user_id == self.user_id,
+                    TaskItem.completed == False,
+                    TaskItem.scheduled == True,
+                    TaskItem.due_date <= now,
+                )
             )
-            .all()
-        )
-        session.close()
-        return tasks
+            return list(tasks.unique())
 
     async def mark_task_completed(self, task_id: str):
         """Mark a task as completed"""
-        session = get_session()
-        task = session.query(TaskItem).get(task_id)
-        if task and task.user_id == self.user_id:
-            task.completed = True
-            task.completed_at = datetime.datetime.now()
-            session.commit()
-        session.close()
+        async with get_async_session() as session:
+            task = await session.get(TaskItem, task_id)
+            if task and task.user_id == self.user_id:
+                task.completed = True
+                task.completed_at = datetime.datetime.now()
+                await session.commit()
 
     async def execute_pending_tasks(self):
         """Check and execute all pending tasks"""
         tasks = await self.get_pending_tasks()
         for task in tasks:
             try:
-                session = get_session()
                 if task.category.name == "Follow-ups" and task.agent_id:
-                    agent = session.query(Agent).get(task.agent_id)
+                    async with get_async_session() as session:
+                        agent = await session.get(Agent, task.agent_id)
                     if agent:
-                        conversation_name = get_conversation_name_by_id(
+                        conversation_name = await get_conversation_name_by_id_async(
                             conversation_id=task.memory_collection,
                             user_id=self.user_id,
                         )
@@ -180,27 +171,21 @@ class Task:
 
             except Exception as e:
                 logging.error(f"Error executing task {task.id}: {str(e)}")
-            finally:
-                if session:
-                    session.close()
 
     async def get_tasks_by_category(self, category_name: str) -> list:
         """Get all tasks in a category"""
-        session = get_session()
         category = await self.get_category(category_name)
         if not category:
-            session.close()
             return []
 
-        tasks = (
-            session.query(TaskItem)
-            .filter(
-                TaskItem.category_id == category.id, TaskItem.user_id == self.user_id
+        async with get_async_session() as session:
+            tasks = await session.scalars(
+                select(TaskItem).where(
+                    TaskItem.category_id == category.id,
+                    TaskItem.user_id == self.user_id,
+                )
             )
-            .all()
-        )
-        session.close()
-        return tasks
+            return list(tasks)
 
     async def update_task(
         self,
@@ -213,42 +198,38 @@ class Task:
         completed: bool = None,
     ):
         """Update a task's details"""
-        session = get_session()
-        task = session.query(TaskItem).get(task_id)
-        if not task:
-            session.close()
-            return "Task not found"
-        if task and task.user_id == self.user_id:
-            if title is not None:
-                task.title = title
-            if description is not None:
-                task.description = description
-            if due_date is not None:
-                task.due_date = due_date
-                task.scheduled = bool(due_date)
-            if estimated_hours is not None:
-                task.estimated_hours = estimated_hours
-            if priority is not None:
-                task.priority = priority
-            if completed is not None:
-                task.completed = completed
-                if completed:
-                    task.completed_at = datetime.datetime.now()
-            session.commit()
-        session.close()
+        async with get_async_session() as session:
+            task = await session.get(TaskItem, task_id)
+            if not task:
+                return "Task not found"
+            if task and task.user_id == self.user_id:
+                if title is not None:
+                    task.title = title
+                if description is not None:
+                    task.description = description
+                if due_date is not None:
+                    task.due_date = due_date
+                    task.scheduled = bool(due_date)
+                if estimated_hours is not None:
+                    task.estimated_hours = estimated_hours
+                if priority is not None:
+                    task.priority = priority
+                if completed is not None:
+                    task.completed = completed
+                    if completed:
+                        task.completed_at = datetime.datetime.now()
+                await session.commit()
         return "Task updated successfully"
 
     async def delete_task(self, task_id: str):
         """Delete a task"""
-        session = get_session()
-        task = session.query(TaskItem).get(task_id)
-        if not task:
-            session.close()
-            return "Task not found"
-        if task and task.user_id == self.user_id:
-            session.delete(task)
-            session.commit()
-        session.close()
+        async with get_async_session() as session:
+            task = await session.get(TaskItem, task_id)
+            if not task:
+                return "Task not found"
+            if task and task.user_id == self.user_id:
+                await session.delete(task)
+                await session.commit()
         return "Task deleted successfully"
 
     async def start_task_monitor(self, check_interval: int = 60):
@@ -1,11 +1,12 @@
 import asyncio
 import logging
-from DB import get_session, TaskItem, User
+from DB import get_session, get_async_session, TaskItem, User
 from Globals import getenv
 from Task import Task
 from datetime import datetime, timedelta
 from fastapi import HTTPException
 from hashlib import sha256
+from sqlalchemy import select, delete
 import jwt
 import random
 import socket
@@ -75,17 +76,14 @@ class TaskMonitor:
             logging.error("Worker ID not initialized!")
             return []
 
-        session = get_session()
-        try:
-            now = datetime.now()
-            all_tasks = (
-                session.query(TaskItem)
-                .filter(
+        now = datetime.now()
+        async with get_async_session() as session:
+            all_tasks = await session.scalars(
+                select(TaskItem).where(
                     TaskItem.completed == False,
                     TaskItem.scheduled == True,
                     TaskItem.due_date <= now,
                 )
-                .all()
             )
 
             # Filter tasks for this worker
@@ -93,9 +91,7 @@ class TaskMonitor:
                 task for task in all_tasks if self._should_process_task(str(task.id))
             ]
 
-            return my_tasks
-        finally:
-            session.close()
+        return my_tasks
 
     async def process_tasks(self):
         """Process tasks assigned to this worker"""
@@ -112,33 +108,34 @@ class TaskMonitor:
 
                     for pending_task in pending_tasks:
                         try:
-                            session = get_session()
-                            try:
-                                if not pending_task.user_id:
-                                    logging.error(
-                                        f"Task {pending_task.id} has no associated user"
+                            if not pending_task.user_id:
+                                logging.error(
+                                    f"Task {pending_task.id} has no associated user"
+                                )
+                                async with get_async_session() as session:
+                                    await session.execute(
+                                        delete(TaskItem).where(
+                                            TaskItem.id == pending_task.id
+                                        )
                                     )
-                                    session.delete(pending_task)
-                                    session.commit()
-                                    continue
+                                    await session.commit()
+                                continue
 
-                                logging.info(
-                                    f"Worker {self.worker_id} processing task {pending_task.id}"
-                                )
-                                task_manager = Task(
-                                    token=impersonate_user(user_id=pending_task.user_id)
-                                )
+                            logging.info(
+                                f"Worker {self.worker_id} processing task {pending_task.id}"
+                            )
+                            task_manager = Task(
+                                token=impersonate_user(user_id=pending_task.user_id)
+                            )
 
-                                try:
-                                    await asyncio.wait_for(
-                                        task_manager.execute_pending_tasks(),
-                                        timeout=300,
-                                    )
-                                except asyncio.TimeoutError:
-                                    logging.error(f"Task {pending_task.id} timed out")
-                                    continue
-                            finally:
-                                session.close()
+                            try:
+                                await asyncio.wait_for(
+                                    task_manager.execute_pending_tasks(),
+                                    timeout=300,
+                                )
+                            except asyncio.TimeoutError:
+                                logging.error(f"Task {pending_task.id} timed out")
+                                continue
 
                         except Exception as e:
                             logging.error(
@@ -0,0 +1,194 @@
+import asyncio
+import atexit
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from DB import TokenUsage, SessionLocal
+from Globals import getenv
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+class TokenUsageAggregator:
+    """
+    Write-behind accumulator for token usage.
+
+    increase_token_counts adds to an in-memory total per (user_id, agent_id,
+    UTC day) and returns. A background thread applies the totals every
+    TOKEN_USAGE_FLUSH_INTERVAL seconds as atomic
+    `input_tokens = input_tokens + :n` updates on token_usage, inserting the
+    row the first time a key is seen. Workers only ever add to the counters,
+    so concurrent requests cannot overwrite each other's usage.
+
+    Readers call flush() before querying a user that has pending usage, the app
+    flushes on shutdown. Setting TOKEN_USAGE_FLUSH_INTERVAL to 0 writes every
+    increment synchronously.
+    """
+
+    def __init__(self, flush_interval: float = None):
+        self.flush_interval = (
+            float(flush_interval)
+            if flush_interval is not None
+            else float(getenv("TOKEN_USAGE_FLUSH_INTERVAL"))
+        )
+        # (user_id, agent_id, usage_date) -> [input_tokens, output_tokens]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.worker = None
+        self.running = False
+        self.flushes = 0
+        self.rows_written = 0
+
+    @property
+    def enabled(self):
+        return self.flush_interval > 0
+
+    def add(
+        self, user_id, agent_id=None, input_tokens: int = 0, output_tokens: int = 0
+    ):
+        input_tokens = int(input_tokens or 0)
+        output_tokens = int(output_tokens or 0)
+        if not input_tokens and not output_tokens:
+            return
+        if agent_id is not None and str(agent_id) in ("", "None"):
+            agent_id = None
+        key = (
+            str(user_id),
+            str(agent_id) if agent_id else None,
+            datetime.utcnow().date(),
+        )
+        with self.lock:
+            counts = self.pending.setdefault(key, [0, 0])
+            counts[0] += input_tokens
+            counts[1] += output_tokens
+        if not self.enabled:
+            self.flush()
+        else:
+            self.start()
+
+    def has_pending(self, user_id=None) -> bool:
+        with self.lock:
+            if user_id is None:
+                return len(self.pending) > 0
+            user_id = str(user_id)
+            return any(key[0] == user_id for key in self.pending)
+
+    def flush(self):
+        """Apply all pending increments in a single transaction"""
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+            if not pending:
+                return
+            session = SessionLocal()
+            try:
+                self.write(session, pending)
+            except Exception as e:
+                session.rollback()
+                logging.error(f"Error flushing token usage: {e}")
+                # Keep the counts for the next flush rather than losing them
+                with self.lock:
+                    for key, (input_tokens, output_tokens) in pending.items():
+                        counts = self.pending.setdefault(key, [0, 0])
+                        counts[0] += input_tokens
+                        counts[1] += output_tokens
+            finally:
+                session.close()
+
+    def write(self, session, pending):
+        for (user_id, agent_id, usage_date), counts in pending.items():
+            input_tokens, output_tokens = counts
+            if self.increment(session, user_id, agent_id, usage_date, counts):
+                continue
+            try:
+                with session.begin_nested():
+                    session.execute(
+                        insert(TokenUsage).values(
+                            user_id=user_id,
+                            agent_id=agent_id,
+                            usage_date=usage_date,
+                            input_tokens=input_tokens,
+                            output_tokens=output_tokens,
+                        )
+                    )
+            except IntegrityError:
+                # Another worker inserted the row first
+                self.increment(session, user_id, agent_id, usage_date, counts)
+        session.commit()
+        self.flushes += 1
+        self.rows_written += len(pending)
+
+    @staticmethod
+    def increment(session, user_id, agent_id, usage_date, counts) -> bool:
+        result = session.execute(
+            update(TokenUsage)
+            .where(
+                TokenUsage.user_id == user_id,
+                (
+                    TokenUsage.agent_id == agent_id
+                    if agent_id
+                    else TokenUsage.agent_id.is_(None)
+                ),
+                TokenUsage.usage_date == usage_date,
+            )
+            .values(
+                input_tokens=TokenUsage.input_tokens + counts[0],
+                output_tokens=TokenUsage.output_tokens + counts[1],
+            )
+        )
+        return result.rowcount > 0
+
+    async def flush_async(self):
+        if self.has_pending():
+            await asyncio.to_thread(self.flush)
+
+    def start(self):
+        if self.running:
+            return
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+            self.worker = threading.Thread(
+                target=self.run, name="token-usage", daemon=True
+            )
+            self.worker.start()
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error in token usage flusher: {e}")
+
+    def close(self):
+        """Stop the flusher thread and write whatever is left"""
+        self.running = False
+        self.wakeup.set()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join(timeout=5)
+        self.worker = None
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            "pending": pending,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
+
+
+token_usage = TokenUsageAggregator()
+atexit.register(token_usage.close)
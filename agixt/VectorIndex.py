@@ -0,0 +1,567 @@
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+from Globals import getenv
+
+try:
+    import hnswlib  # type: ignore
+except ImportError:
+    hnswlib = None
+
+logging.basicConfig(
+    level=getenv("LOG_LEVEL"),
+    format=getenv("LOG_FORMAT"),
+)
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    norms = np.linalg.norm(vectors, axis=1)
+    norms[norms == 0] = 1e-12
+    return vectors / norms[:, np.newaxis]
+
+
+class FlatIndex:
+    """
+    Exact inner-product index over unit vectors, pure numpy.
+
+    Rows are kept in a contiguous float32 matrix that grows geometrically, removed
+    rows are masked out and compacted once they make up half of the matrix.
+    """
+
+    kind = "flat"
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self.live = np.zeros(0, dtype=bool)
+        self.ids: List[str] = []
+        self.positions: Dict[str, int] = {}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _reserve(self, extra: int):
+        needed = self.size + extra
+        if needed <= self.matrix.shape[0]:
+            return
+        capacity = max(needed, self.matrix.shape[0] * 2, 64)
+        matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+        matrix[: self.size] = self.matrix[: self.size]
+        live = np.zeros(capacity, dtype=bool)
+        live[: self.size] = self.live[: self.size]
+        self.matrix = matrix
+        self.live = live
+
+    def add(self, ids: List[str], vectors) -> List[int]:
+        if not ids:
+            return []
+        vectors = normalize_rows(vectors)
+        self.remove([str(i) for i in ids if str(i) in self.positions])
+        self._reserve(len(ids))
+        start = self.size
+        self.matrix[start : start + len(ids)] = vectors
+        self.live[start : start + len(ids)] = True
+        rows = list(range(start, start + len(ids)))
+        for row, memory_id in zip(rows, ids):
+            memory_id = str(memory_id)
+            self.ids.append(memory_id)
+            self.positions[memory_id] = row
+        self.size += len(ids)
+        return rows
+
+    def remove(self, ids: List[str]) -> int:
+        removed = 0
+        for memory_id in ids:
+            row = self.positions.pop(str(memory_id), None)
+            if row is not None:
+                self.live[row] = False
+                removed += 1
+        if self.size > 64 and len(self.positions) < self.size // 2:
+            self.compact()
+        return removed
+
+    def compact(self):
+        rows = np.flatnonzero(self.live[: self.size])
+        ids = [self.ids[row] for row in rows]
+        vectors = self.matrix[rows].copy()
+        self.__init__(self.dim)
+        self.add(ids, vectors)
+
+    def _score_rows(self, query: np.ndarray, rows: np.ndarray, k: int):
+        if rows.size == 0:
+            return []
+        scores = self.matrix[rows] @ query
+        if k < rows.size:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(rows.size)
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[rows[i]], float(scores[i])) for i in top]
+
+    def search(self, query, k: int) -> List[Tuple[str, float]]:
+        if k <= 0 or len(self) == 0:
+            return []
+        query = normalize_rows(query)[0]
+        # One matrix-vector product over the contiguous block, dead rows masked out.
+        scores = self.matrix[: self.size] @ query
+        if len(self) < self.size:
+            scores[~self.live[: self.size]] = -np.inf
+        k = min(k, len(self))
+        if k < self.size:
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(self.size)
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float(scores[row])) for row in top]
+
+    def vector(self, memory_id: str):
+        row = self.positions.get(str(memory_id))
+        return None if row is None else self.matrix[row].copy()
+
+    @property
+    def nbytes(self):
+        return self.matrix.nbytes
+
+
+class IVFFlatIndex(FlatIndex):
+    """
+    Inverted-file index with exact scoring inside the probed lists, pure numpy.
+
+    Centroids are trained with a few rounds of spherical k-means when the index is
+    first built. Later additions are assigned to their nearest centroid.
+    """
+
+    kind = "ivf"
+
+    def __init__(self, dim: int, nlist: int = 0, nprobe: int = 0):
+        super().__init__(dim)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists: List[List[int]] = []
+
+    def train(self, vectors, iterations: int = 10):
+        vectors = normalize_rows(vectors)
+        count = vectors.shape[0]
+        nlist = self.nlist if self.nlist else max(1, int(np.sqrt(count)))
+        nlist = min(nlist, count)
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(count, nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(vectors @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = vectors[assignments == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids = normalize_rows(centroids)
+        self.centroids = centroids
+        self.nlist = nlist
+        if not self.nprobe:
+            self.nprobe = max(1, int(np.ceil(nlist / 8)))
+        self.lists = [[] for _ in range(nlist)]
+
+    def add(self, ids: List[str], vectors) -> List[int]:
+        if not ids:
+            return []
+        vectors = normalize_rows(vectors)
+        if self.centroids is None:
+            self.train(vectors)
+        rows = super().add(ids, vectors)
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        for row, c in zip(rows, assignments):
+            self.lists[c].append(row)
+        return rows
+
+    def compact(self):
+        rows = np.flatnonzero(self.live[: self.size])
+        ids = [self.ids[row] for row in rows]
+        vectors = self.matrix[rows].copy()
+        centroids, nprobe = self.centroids, self.nprobe
+        FlatIndex.__init__(self, self.dim)
+        self.centroids, self.nprobe = centroids, nprobe
+        self.lists = [[] for _ in range(self.nlist)]
+        self.add(ids, vectors)
+
+    def search(self, query, k: int) -> List[Tuple[str, float]]:
+        if k <= 0 or len(self) == 0:
+            return []
+        query = normalize_rows(query)[0]
+        centroid_scores = self.centroids @ query
+        nprobe = min(self.nprobe, self.nlist)
+        probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.fromiter(
+            (row for c in probes for row in self.lists[c]), dtype=np.int64
+        )
+        rows = rows[self.live[rows]] if rows.size else rows
+        results = self._score_rows(query, rows, k)
+        if len(results) < k and rows.size < len(self):
+            # Probed lists were too sparse, fall back to an exact scan.
+            return super().search(query, k)
+        return results
+
+
+class HNSWIndex:
+    """Approximate graph index backed by hnswlib, only used when it is installed."""
+
+    kind = "hnsw"
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 200):
+        self.dim = dim
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        self.index.init_index(max_elements=1024, ef_construction=ef_construction, M=M)
+        self.index.set_ef(int(getenv("VECTOR_INDEX_EF_SEARCH")))
+        self.labels: Dict[str, int] = {}
+        self.ids: Dict[int, str] = {}
+        self.next_label = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, ids: List[str], vectors):
+        if not ids:
+            return
+        vectors = normalize_rows(vectors)
+        self.remove([str(i) for i in ids if str(i) in self.labels])
+        needed = self.next_label + len(ids)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, self.index.get_max_elements() * 2))
+        labels = np.arange(self.next_label, needed)
+        self.index.add_items(vectors, labels)
+        for label, memory_id in zip(labels, ids):
+            self.labels[str(memory_id)] = int(label)
+            self.ids[int(label)] = str(memory_id)
+        self.next_label = needed
+
+    def remove(self, ids: List[str]) -> int:
+        removed = 0
+        for memory_id in ids:
+            label = self.labels.pop(str(memory_id), None)
+            if label is not None:
+                self.index.mark_deleted(label)
+                del self.ids[label]
+                removed += 1
+        return removed
+
+    def search(self, query, k: int) -> List[Tuple[str, float]]:
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        labels, distances = self.index.knn_query(normalize_rows(query), k=k)
+        return [
+            (self.ids[int(label)], float(1 - distance))
+            for label, distance in zip(labels[0], distances[0])
+        ]
+
+    def vector(self, memory_id: str):
+        label = self.labels.get(str(memory_id))
+        if label is None:
+            return None
+        return np.asarray(self.index.get_items([label])[0], dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        # Vectors plus roughly M * 2 neighbour links of 4 bytes per element.
+        return self.index.get_max_elements() * (self.dim * 4 + 16 * 2 * 4)
+
+
+def create_index(dim: int, count: int = 0):
+    """Picks the index implementation from VECTOR_INDEX and the collection size."""
+    kind = str(getenv("VECTOR_INDEX")).lower()
+    if count < int(getenv("VECTOR_INDEX_MIN_SIZE")):
+        # Small collections are scanned faster than any ANN structure can be probed.
+        return FlatIndex(dim)
+    if kind == "hnsw":
+        if hnswlib is not None:
+            return HNSWIndex(dim)
+        kind = "ivf"
+    if kind == "ivf":
+        return IVFFlatIndex(dim)
+    return FlatIndex(dim)
+
+
+class VectorCollection:
+    def __init__(self, index, fingerprint, records: Dict[str, object] = None):
+        self.index = index
+        self.fingerprint = fingerprint
+        # Row metadata keyed by id, so hits can be returned without a database round-trip.
+        self.records = records if records is not None else {}
+        self.records_nbytes = sum(
+            getattr(record, "nbytes", 0) for record in self.records.values()
+        )
+        # Fingerprint our own incremental writes should produce, and whether
+        # they may have removed the newest row (leaving the timestamp unknown)
+        self.expected_fingerprint = None
+        self.newest_removed = False
+        self.lock = threading.Lock()
+
+    def expect(self, added: int = 0, removed: int = 0, timestamps=None):
+        """Advance the expected fingerprint by a write made through this worker"""
+        count, newest = (
+            self.expected_fingerprint
+            if self.expected_fingerprint is not None
+            else self.fingerprint
+        )
+        for timestamp in timestamps or []:
+            if timestamp is not None and (newest is None or timestamp > newest):
+                newest = timestamp
+        if removed:
+            self.newest_removed = True
+        self.expected_fingerprint = (count + added - removed, newest)
+
+    def matches_expected(self, fingerprint) -> bool:
+        if self.expected_fingerprint is None:
+            return False
+        count, newest = self.expected_fingerprint
+        if fingerprint[0] != count:
+            return False
+        if fingerprint[1] == newest:
+            return True
+        # Deleting the newest row lowers the timestamp, it can never go up without
+        # someone else inserting
+        return (
+            self.newest_removed
+            and newest is not None
+            and (fingerprint[1] is None or fingerprint[1] < newest)
+        )
+
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.records_nbytes
+
+
+class VectorIndexManager:
+    """
+    Per-worker registry of vector indexes keyed by (agent_id, conversation_id).
+
+    Collections are loaded from the database on first search and kept current by
+    the write and delete paths. A cheap fingerprint (row count and latest
+    timestamp) is compared on each search so writes made by other workers trigger
+    a rebuild instead of serving stale results. Least recently used collections
+    are evicted once VECTOR_INDEX_MEMORY_MB is exceeded.
+    """
+
+    def __init__(self):
+        self.collections: "OrderedDict[Tuple[str, str], VectorCollection]" = (
+            OrderedDict()
+        )
+        self.lock = threading.Lock()
+
+    @property
+    def memory_budget(self) -> int:
+        return int(float(getenv("VECTOR_INDEX_MEMORY_MB")) * 1024 * 1024)
+
+    def evict(self):
+        with self.lock:
+            total = sum(c.nbytes for c in self.collections.values())
+            # Always keep the most recently used collection, even when it alone is over budget.
+            while total > self.memory_budget and len(self.collections) > 1:
+                key, collection = self.collections.popitem(last=False)
+                total -= collection.nbytes
+                logging.debug(f"Evicted vector index for {key}")
+
+    @property
+    def enabled(self):
+        return str(getenv("VECTOR_INDEX")).lower() not in ["none", "false", "off", ""]
+
+    @staticmethod
+    def key(agent_id, conversation_id) -> Tuple[str, str]:
+        return (str(agent_id), str(conversation_id) if conversation_id else "0")
+
+    def get_collection(
+        self,
+        agent_id,
+        conversation_id,
+        fingerprint,
+        loader: Callable[[], Tuple[List[str], np.ndarray, Dict[str, object]]],
+    ) -> VectorCollection:
+        key = self.key(agent_id, conversation_id)
+        with self.lock:
+            collection = self.collections.get(key)
+            if collection is not None:
+                self.collections.move_to_end(key)
+        if collection is not None:
+            with collection.lock:
+                if collection.fingerprint == fingerprint:
+                    return collection
+                if collection.matches_expected(fingerprint):
+                    # The difference is exactly our own incremental writes.
+                    collection.fingerprint = fingerprint
+                    collection.expected_fingerprint = None
+                    collection.newest_removed = False
+                    return collection
+        ids, vectors, records = loader()
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dim = vectors.shape[1] if vectors.ndim == 2 and vectors.size else 384
+        index = create_index(dim=dim, count=len(ids))
+        if isinstance(index, IVFFlatIndex) and len(ids):
+            index.train(vectors)
+        index.add(ids, vectors)
+        collection = VectorCollection(
+            index=index, fingerprint=fingerprint, records=records
+        )
+        with self.lock:
+            self.collections[key] = collection
+            self.collections.move_to_end(key)
+        logging.debug(f"Built {index.kind} vector index for {key} ({len(ids)} rows)")
+        self.evict()
+        return collection
+
+    def search(
+        self,
+        collections: List[VectorCollection],
+        query_embedding,
+        limit: int,
+        min_score: float = 0.0,
+    ) -> List[Tuple[str, float]]:
+        results = []
+        for collection in collections:
+            with collection.lock:
+                results += collection.index.search(query_embedding, limit)
+        results = [(i, score) for i, score in results if score >= min_score]
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results[:limit]
+
+    def add(
+        self,
+        agent_id,
+        conversation_id,
+        ids: List[str],
+        vectors,
+        records: List[object] = None,
+        timestamps: List[object] = None,
+    ):
+        """
+        Append rows to a loaded collection, records are optional and hydrated on
+        demand when missing. Without the rows' stored timestamps the collection
+        cannot predict its next fingerprint and is reloaded on the next search.
+        """
+        with self.lock:
+            collection = self.collections.get(self.key(agent_id, conversation_id))
+        if collection is None:
+            return
+        vectors = normalize_rows(vectors)
+        with collection.lock:
+            if vectors.shape[1] != collection.index.dim:
+                rebuild = True
+            else:
+                ids = [str(i) for i in ids]
+                added = sum(
+                    1 for memory_id in ids if collection.index.vector(memory_id) is None
+                )
+                collection.index.add(ids, vectors)
+                for memory_id, record in zip(ids, records or []):
+                    collection.records[str(memory_id)] = record
+                    collection.records_nbytes += getattr(record, "nbytes", 0)
+                if timestamps is not None:
+                    collection.expect(added=added, timestamps=timestamps)
+                # Collections that outgrow the flat scan are rebuilt as ANN indexes.
+                rebuild = collection.index.kind == "flat" and len(
+                    collection.index
+                ) >= 2 * int(getenv("VECTOR_INDEX_MIN_SIZE"))
+        if rebuild:
+            self.invalidate(agent_id, conversation_id)
+        else:
+            self.evict()
+
+    def remove(self, agent_id, ids: List[str]):
+        ids = [str(i) for i in ids]
+        with self.lock:
+            collections = [
+                collection
+                for key, collection in self.collections.items()
+                if key[0] == str(agent_id)
+            ]
+        for collection in collections:
+            with collection.lock:
+                removed = collection.index.remove(ids)
+                if removed:
+                    collection.expect(removed=removed)
+                for memory_id in ids:
+                    record = collection.records.pop(memory_id, None)
+                    collection.records_nbytes -= getattr(record, "nbytes", 0)
+
+    def invalidate(self, agent_id, conversation_id=None):
+        """Drops one collection, or every collection of the agent when no conversation is given."""
+        with self.lock:
+            if conversation_id is not None:
+                self.collections.pop(self.key(agent_id, conversation_id), None)
+                return
+            for key in [k for k in self.collections if k[0] == str(agent_id)]:
+                del self.collections[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                f"{key[0]}:{key[1]}": {
+                    "kind": collection.index.kind,
+                    "rows": len(collection.index),
+                    "bytes": collection.nbytes,
+                }
+                for key, collection in self.collections.items()
+            }
+
+
+vector_index = VectorIndexManager()
+
+
+def evaluate_recall(
+    index, ids: List[str], vectors, queries, k: int = 10
+) -> Dict[str, float]:
+    """
+    Brute-force recall harness, compares an index against exact search.
+
+    Returns recall@k averaged over the queries and the mean absolute score error
+    of the neighbours both searches agree on.
+    """
+    exact = FlatIndex(dim=np.asarray(vectors).shape[1])
+    exact.add(ids, vectors)
+    hits = 0
+    errors = []
+    queries = normalize_rows(queries)
+    for query in queries:
+        expected = dict(exact.search(query, k))
+        found = dict(index.search(query, k))
+        shared = set(expected) & set(found)
+        hits += len(shared)
+        errors += [abs(expected[i] - found[i]) for i in shared]
+    return {
+        "recall": hits / float(k * len(queries)) if len(queries) else 1.0,
+        "score_error": float(np.mean(errors)) if errors else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    import time
+
+    rng = np.random.default_rng(42)
+    count, dim, k = 20000, 384, 10
+    # Clustered data resembles real embeddings better than uniform noise.
+    centers = rng.normal(size=(64, dim))
+    data = centers[rng.integers(0, 64, count)] + 0.35 * rng.normal(size=(count, dim))
+    data = normalize_rows(data)
+    data_ids = [str(i) for i in range(count)]
+    queries = normalize_rows(data[rng.integers(0, count, 200)] + 0.1)
+    candidates = [FlatIndex(dim), IVFFlatIndex(dim)]
+    if hnswlib is not None:
+        candidates.append(HNSWIndex(dim))
+    for candidate in candidates:
+        started = time.perf_counter()
+        if isinstance(candidate, IVFFlatIndex):
+            candidate.train(data)
+        candidate.add(data_ids, data)
+        built = time.perf_counter() - started
+        started = time.perf_counter()
+        for query in queries:
+            candidate.search(query, k)
+        per_query = (time.perf_counter() - started) / len(queries)
+        result = evaluate_recall(candidate, data_ids, data, queries, k)
+        print(
+            f"{candidate.kind:>5}: build {built:.2f}s, {per_query * 1000:.2f} ms/query, "
+            f"recall@{k} {result['recall']:.3f}, score error {result['score_error']:.5f}"
+        )
@@ -4,7 +4,7 @@ from Conversations import get_conversation_name_by_id, get_conversation_id_by_na
 from Memories import Memories
 from Extensions import Extensions
 from pydub import AudioSegment
-from Globals import getenv, get_tokens, DEFAULT_SETTINGS
+from Globals import getenv, get_tokens, get_tokens_batch, DEFAULT_SETTINGS
 from Models import ChatCompletions, TasksToDo, ChainCommandName, TranslationRequest
 from datetime import datetime
 from typing import (
@@ -236,6 +236,9 @@ class AGiXT:
             del kwargs["tts"]
         if "conversation_name" in kwargs:
             del kwargs["conversation_name"]
+        if language != "en":
+            # The answer is translated afterwards, streaming it would show English
+            self.agent_interactions.stream_queue = None
         response = await self.agent_interactions.run(
             user_input=user_input,
             prompt_category=prompt_category,
@@ -986,12 +989,14 @@ class AGiXT:
                 # Check how many lines are in the file content
                 lines = content.split("\n")
                 if len(lines) > 1:
-                    for line_number, line in enumerate(lines):
-                        await self.file_reader.write_text_to_memory(
-                            user_input=user_input,
-                            text=f"Content from file uploaded named `{file_name}` at {timestamp} on line number {line_number + 1}:\n{line}",
-                            external_source=f"file {fp}",
-                        )
+                    await self.file_reader.write_texts_to_memory(
+                        user_input=user_input,
+                        texts=[
+                            f"Content from file uploaded named `{file_name}` at {timestamp} on line number {line_number + 1}:\n{line}"
+                            for line_number, line in enumerate(lines)
+                        ],
+                        external_source=f"file {fp}",
+                    )
                 else:
                     await self.file_reader.write_text_to_memory(
                         user_input=user_input,
@@ -1669,7 +1674,7 @@ class AGiXT:
             file_contents.append(content)
         if file_contents:
             file_content = "\n".join(file_contents)
-            file_tokens = get_tokens(file_content)
+            file_tokens = sum(get_tokens_batch(file_contents))
             current_input_tokens = file_tokens + current_input_tokens
         else:
             file_content = ""
@@ -1927,6 +1932,73 @@ class AGiXT:
         }
         return res_model
 
+    async def chat_completions_stream(self, prompt: ChatCompletions):
+        """
+        Generate an OpenAI style chat completion as chat.completion.chunk events
+
+        The answer is streamed as the model writes it, everything else (thoughts,
+        command executions, logging) happens as in chat_completions, which runs
+        alongside. Whatever was not streamed, such as a command or chain mode
+        response, is sent once chat_completions is done.
+
+        Args:
+            prompt (ChatCompletions): Chat completions prompt
+
+        Yields:
+            dict: Chat completion chunks, the last one carrying the usage
+        """
+        queue = asyncio.Queue()
+        self.agent_interactions.stream_queue = queue
+        task = asyncio.create_task(self.chat_completions(prompt=prompt))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        created = int(time.time())
+
+        def chunk(delta: dict, finish_reason=None):
+            return {
+                "id": self.conversation_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": self.agent_name,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": finish_reason,
+                        "logprobs": None,
+                    }
+                ],
+            }
+
+        streamed = ""
+        try:
+            yield chunk({"role": "assistant", "content": ""})
+            while True:
+                content = await queue.get()
+                if content is None:
+                    break
+                streamed += content
+                yield chunk({"content": content})
+            response = await task
+        finally:
+            self.agent_interactions.stream_queue = None
+            if not task.done():
+                # The client went away, stop generating for it
+                task.cancel()
+        content = str(response["choices"][0]["message"]["content"])
+        if content.startswith(streamed):
+            if content[len(streamed) :]:
+                yield chunk({"content": content[len(streamed) :]})
+        elif not streamed.strip():
+            yield chunk({"content": content})
+        else:
+            logging.warning(
+                "Streamed answer differs from the final response, "
+                "the final response is in the conversation history."
+            )
+        final_chunk = chunk({}, finish_reason="stop")
+        final_chunk["usage"] = response["usage"]
+        yield final_chunk
+
     async def batch_inference(
         self,
         user_inputs: List[str] = [],
@@ -23,6 +23,11 @@ from contextlib import asynccontextmanager
 from Workspaces import WorkspaceManager
 from typing import Optional
 from TaskMonitor import TaskMonitor
+from Embeddings import warmup_embeddings
+from DB import RequestSessionMiddleware, async_engine
+from InteractionLog import InteractionLogMiddleware, interaction_log
+from TokenUsage import token_usage
+from ProviderClients import provider_clients
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -43,6 +48,9 @@ task_monitor = TaskMonitor()
 async def lifespan(app: FastAPI):
     workspace_manager.start_file_watcher()
     await task_monitor.start()
+    if str(getenv("EMBEDDING_WARMUP")).lower() == "true":
+        # Load the embedding model off the event loop so the worker stays responsive
+        asyncio.get_running_loop().run_in_executor(None, warmup_embeddings)
 
     try:
         yield
@@ -50,12 +58,19 @@ async def lifespan(app: FastAPI):
         # Shutdown
         workspace_manager.stop_file_watcher()
         await task_monitor.stop()
+        await asyncio.to_thread(interaction_log.close)
+        await asyncio.to_thread(token_usage.close)
+        await provider_clients.aclose()
+        if async_engine is not None:
+            await async_engine.dispose()
 
 
 # Register signal handlers for unexpected shutdowns
 async def cleanup():
     workspace_manager.stop_file_watcher()
     await task_monitor.stop()
+    interaction_log.close()
+    token_usage.close()
 
 
 def signal_handler(signum, frame):
@@ -75,6 +90,8 @@ app = FastAPI(
 )
 
 
+app.add_middleware(RequestSessionMiddleware)
+app.add_middleware(InteractionLogMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -11,11 +11,13 @@ from Models import (  # type: ignore
     NewCompanyResponse,
     RenameCompanyInput,
     UpdateUserRole,
+    TokenUsageResponse,
 )
 from fastapi import APIRouter, Request, Header, Depends, HTTPException
 from MagicalAuth import MagicalAuth, verify_api_key, impersonate_user  # type: ignore
 from Agent import Agent  # type: ignore
 from typing import List, Optional
+from datetime import date
 from Globals import getenv  # type: ignore
 import logging
 import pyotp
@@ -160,6 +162,30 @@ def get_user(
     }
 
 
+@app.get(
+    "/v1/user/usage",
+    dependencies=[Depends(verify_api_key)],
+    response_model=TokenUsageResponse,
+    summary="Get token usage",
+    description="Total tokens used by the user and the daily usage per agent, optionally limited to a date range or a single agent.",
+    tags=["Auth"],
+)
+def get_token_usage(
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    agent_id: Optional[str] = None,
+    authorization: str = Header(None),
+):
+    auth = MagicalAuth(token=authorization)
+    auth.validate_user()
+    return {
+        **auth.get_token_counts(),
+        "usage": auth.get_token_usage(
+            start_date=start_date, end_date=end_date, agent_id=agent_id
+        ),
+    }
+
+
 @app.post(
     "/v1/login",
     response_model=Detail,
@@ -1,12 +1,15 @@
 import time
 import uuid
+import json
+import logging
 from fastapi import APIRouter, Depends, Header
+from fastapi.responses import StreamingResponse
 from Globals import get_tokens
 from MagicalAuth import get_user_id
 from ApiClient import Agent, verify_api_key, get_api_client
 from Conversations import get_conversation_name_by_id
 from providers.default import DefaultProvider
-from Memories import embed
+from Embeddings import embed
 from fastapi import UploadFile, File, Form
 from typing import Optional, List
 from Models import (
@@ -33,7 +36,7 @@ app = APIRouter()
     tags=["Completions"],
     dependencies=[Depends(verify_api_key)],
     summary="Create Chat Completion",
-    description="Creates a completion for the chat message. Compatible with OpenAI's chat completions API format.",
+    description="Creates a completion for the chat message. Compatible with OpenAI's chat completions API format, including `stream` for server-sent `chat.completion.chunk` events.",
     response_model=ChatCompletionResponse,
 )
 async def chat_completion(
@@ -61,6 +64,23 @@ async def chat_completion(
         api_key=authorization,
         conversation_name=conversation_name,
     )
+    if prompt.stream:
+
+        async def event_stream():
+            try:
+                async for chunk in agixt.chat_completions_stream(prompt=prompt):
+                    yield f"data: {json.dumps(chunk)}\n\n"
+            except Exception as e:
+                logging.error(f"Error streaming chat completion: {e}")
+                error = {"error": {"message": str(e), "type": "server_error"}}
+                yield f"data: {json.dumps(error)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
     return await agixt.chat_completions(prompt=prompt)
 
 
@@ -1,10 +1,11 @@
-from fastapi import APIRouter, Depends, Header
-from typing import Dict
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Dict, Optional
 from ApiClient import verify_api_key
 from Conversations import (
     Conversations,
-    get_conversation_name_by_id,
-    get_conversation_id_by_name,
+    get_conversation_name_by_id_async,
+    get_conversation_id_by_name_async,
 )
 from XT import AGiXT
 from Models import (
@@ -81,25 +82,29 @@ async def get_conversations(user=Depends(verify_api_key)):
 )
 async def get_conversation_history(
     conversation_id: str,
+    limit: int = 100,
+    cursor: Optional[str] = None,
     user=Depends(verify_api_key),
     authorization: str = Header(None),
 ):
     auth = MagicalAuth(token=authorization)
     if conversation_id == "-":
-        conversation_id = get_conversation_id_by_name(
+        conversation_id = await get_conversation_id_by_name_async(
             conversation_name="-", user_id=auth.user_id
         )
-    conversation_name = get_conversation_name_by_id(
+    conversation_name = await get_conversation_name_by_id_async(
         conversation_id=conversation_id, user_id=auth.user_id
     )
-    conversation_history = Conversations(
-        conversation_name=conversation_name, user=user
-    ).get_conversation()
-    if conversation_history is None:
-        conversation_history = []
-    if "interactions" in conversation_history:
-        conversation_history = conversation_history["interactions"]
-    return {"conversation_history": conversation_history}
+    try:
+        conversation_history = await Conversations(
+            conversation_name=conversation_name, user=user
+        ).get_conversation_async(limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "conversation_history": conversation_history["interactions"],
+        "next_cursor": conversation_history["next_cursor"],
+    }
 
 
 @app.get(
@@ -118,22 +123,25 @@ async def get_conversation_history(
     auth = MagicalAuth(token=authorization)
     try:
         conversation_id = uuid.UUID(history.conversation_name)
-        history.conversation_name = get_conversation_name_by_id(
+        history.conversation_name = await get_conversation_name_by_id_async(
             conversation_id=str(conversation_id), user_id=auth.user_id
         )
     except:
         conversation_id = None
-    conversation_history = Conversations(
-        conversation_name=history.conversation_name, user=user
-    ).get_conversation(
-        limit=history.limit,
-        page=history.page,
-    )
-    if conversation_history is None:
-        conversation_history = []
-    if "interactions" in conversation_history:
-        conversation_history = conversation_history["interactions"]
-    return {"conversation_history": conversation_history}
+    try:
+        conversation_history = await Conversations(
+            conversation_name=history.conversation_name, user=user
+        ).get_conversation_async(
+            limit=history.limit,
+            page=history.page,
+            cursor=history.cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "conversation_history": conversation_history["interactions"],
+        "next_cursor": conversation_history["next_cursor"],
+    }
 
 
 @app.get(
@@ -148,25 +156,56 @@ async def get_conversation_data(
     conversation_name: str,
     limit: int = 100,
     page: int = 1,
+    cursor: Optional[str] = None,
     user=Depends(verify_api_key),
     authorization: str = Header(None),
 ):
     auth = MagicalAuth(token=authorization)
     try:
         conversation_id = uuid.UUID(conversation_name)
-        conversation_name = get_conversation_name_by_id(
+        conversation_name = await get_conversation_name_by_id_async(
             conversation_id=str(conversation_id), user_id=auth.user_id
         )
     except:
         conversation_id = None
-    conversation_history = Conversations(
+    try:
+        conversation_history = await Conversations(
+            conversation_name=conversation_name, user=user
+        ).get_conversation_async(limit=limit, page=page, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "conversation_history": conversation_history["interactions"],
+        "next_cursor": conversation_history["next_cursor"],
+    }
+
+
+@app.get(
+    "/v1/conversation/{conversation_id}/export",
+    summary="Export Conversation as NDJSON",
+    description="Streams every message of a conversation, oldest first, as newline delimited JSON without loading the whole history into memory.",
+    tags=["Conversation"],
+    dependencies=[Depends(verify_api_key)],
+)
+async def export_conversation(
+    conversation_id: str,
+    user=Depends(verify_api_key),
+    authorization: str = Header(None),
+):
+    auth = MagicalAuth(token=authorization)
+    conversation_name = await get_conversation_name_by_id_async(
+        conversation_id=conversation_id, user_id=auth.user_id
+    )
+    messages = Conversations(
         conversation_name=conversation_name, user=user
-    ).get_conversation(limit=limit, page=page)
-    if conversation_history is None:
-        conversation_history = []
-    if "interactions" in conversation_history:
-        conversation_history = conversation_history["interactions"]
-    return {"conversation_history": conversation_history}
+    ).iter_conversation_export()
+    return StreamingResponse(
+        (json.dumps(message, default=str) + "\n" for message in messages),
+        media_type="application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="{conversation_id}.ndjson"'
+        },
+    )
 
 
 @app.post(
@@ -203,7 +242,7 @@ async def delete_conversation_history(
     auth = MagicalAuth(token=authorization)
     try:
         conversation_id = uuid.UUID(history.conversation_name)
-        history.conversation_name = get_conversation_name_by_id(
+        history.conversation_name = await get_conversation_name_by_id_async(
             conversation_id=str(conversation_id), user_id=auth.user_id
         )
     except:
@@ -249,7 +288,7 @@ async def update_history_message(
     auth = MagicalAuth(token=authorization)
     try:
         conversation_id = uuid.UUID(history.conversation_name)
-        history.conversation_name = get_conversation_name_by_id(
+        history.conversation_name = await get_conversation_name_by_id_async(
             conversation_id=str(conversation_id), user_id=auth.user_id
         )
     except:
@@ -322,7 +361,7 @@ async def log_interaction(
     auth = MagicalAuth(token=authorization)
     try:
         conversation_id = uuid.UUID(log_interaction.conversation_name)
-        log_interaction.conversation_name = get_conversation_name_by_id(
+        log_interaction.conversation_name = await get_conversation_name_by_id_async(
             conversation_id=str(conversation_id), user_id=auth.user_id
         )
     except:
@@ -353,7 +392,7 @@ async def rename_conversation(
     auth = MagicalAuth(token=authorization)
     try:
         conversation_id = uuid.UUID(rename.conversation_name)
-        rename.conversation_name = get_conversation_name_by_id(
+        rename.conversation_name = await get_conversation_name_by_id_async(
             conversation_id=str(conversation_id), user_id=auth.user_id
         )
     except:
@@ -456,7 +495,7 @@ async def get_tts(
     authorization: str = Header(None),
 ):
     auth = MagicalAuth(token=user)
-    conversation_name = get_conversation_name_by_id(
+    conversation_name = await get_conversation_name_by_id_async(
         conversation_id=conversation_id, user_id=auth.user_id
     )
     c = Conversations(conversation_name=conversation_name, user=user)
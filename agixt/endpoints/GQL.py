@@ -253,6 +253,7 @@ class PageInfo:
 class ConversationDetail:
     metadata: ConversationMetadata
     messages: List[ConversationMessage]
+    next_cursor: Optional[str] = None
 
 
 @strawberry.type
@@ -1752,9 +1753,16 @@ class Query:
 
     @strawberry.field
     async def conversation(
-        self, info, conversation_id: str, pagination: Optional[PaginationInput] = None
+        self,
+        info,
+        conversation_id: str,
+        pagination: Optional[PaginationInput] = None,
+        cursor: Optional[str] = None,
     ) -> ConversationDetail:
-        """Get conversation details and paginated messages"""
+        """
+        Get conversation details and paginated messages. Pass the next_cursor of
+        the previous page as cursor to page by keyset instead of page number.
+        """
         user, auth, magical = await get_user_from_context(info)
         conversation_name = get_conversation_name_by_id(
             conversation_id=conversation_id, user_id=magical.user_id
@@ -1762,10 +1770,10 @@ class Query:
         # Get conversation metadata
         c = Conversations(user=user, conversation_name=conversation_name)
         result = {"conversations": c.get_conversations_with_detail()}
-        if conversation_id not in result.conversations:
+        if conversation_id not in result["conversations"]:
             raise Exception(f"Conversation {conversation_id} not found")
 
-        details = result.conversations[conversation_id]
+        details = result["conversations"][conversation_id]
         metadata = ConversationMetadata(
             id=conversation_id,
             name=details["name"],
@@ -1779,7 +1787,11 @@ class Query:
 
         # Get messages with pagination
         c = Conversations(user=user, conversation_name=metadata.name)
-        history_result = c.get_conversation()
+        history_result = c.get_conversation(
+            limit=pagination.limit if pagination else 100,
+            page=pagination.page if pagination else 1,
+            cursor=cursor,
+        )
 
         messages = [
             ConversationMessage(
@@ -1794,13 +1806,11 @@ class Query:
             for msg in history_result["interactions"]
         ]
 
-        # Apply pagination if provided
-        if pagination:
-            start_idx = (pagination.page - 1) * pagination.limit
-            end_idx = start_idx + pagination.limit
-            messages = messages[start_idx:end_idx]
-
-        return ConversationDetail(metadata=metadata, messages=messages)
+        return ConversationDetail(
+            metadata=metadata,
+            messages=messages,
+            next_cursor=history_result["next_cursor"],
+        )
 
     @strawberry.field
     async def notifications(
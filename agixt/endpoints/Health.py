@@ -1,8 +1,9 @@
 from fastapi import APIRouter
+from DB import get_pool_stats
 
 app = APIRouter()
 
 
 @app.get("/health", tags=["Health"])
 async def health():
-    return {"status": "UP"}
+    return {"status": "UP", "database": get_pool_stats()}
@@ -1,5 +1,5 @@
 from typing import Dict
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Header
 from Providers import (
     get_provider_options,
     get_providers,
@@ -14,6 +14,7 @@ from Models import (
     EmbedderResponse,
 )
 from ApiClient import verify_api_key, get_api_client, is_admin
+from ProviderHealth import provider_health
 from typing import Any
 
 app = APIRouter()
@@ -108,3 +109,18 @@ async def get_embedder_info(user=Depends(verify_api_key)) -> Dict[str, Any]:
 async def get_all_providers(user=Depends(verify_api_key)):
     providers = get_providers_with_details()
     return {"providers": providers}
+
+
+@app.get(
+    "/v1/providers/rotation",
+    tags=["Provider"],
+    dependencies=[Depends(verify_api_key)],
+    summary="Get Provider Rotation Health",
+    description="Returns the latency percentiles, error rates, circuit breaker states and rate limits of the providers used by the AGiXT rotation provider in this worker, along with its most recent routing decisions and hedged request counts per agent. This endpoint requires admin privileges.",
+)
+async def get_rotation_health(
+    user=Depends(verify_api_key), authorization: str = Header(None)
+):
+    if is_admin(email=user, api_key=authorization) != True:
+        raise HTTPException(status_code=403, detail="Access Denied")
+    return provider_health.stats()
@@ -6,10 +6,11 @@ except ImportError:
 
     subprocess.check_call([sys.executable, "-m", "pip", "install", "anthropic"])
     import anthropic
-import httpx
+import asyncio
 import base64
 import logging
-import time
+from ProviderClients import get_anthropic_client, get_http_client
+from ProviderHealth import provider_error, in_rotation
 
 
 # List of models available at https://docs.anthropic.com/claude/docs/models-overview
@@ -42,27 +43,26 @@ class AnthropicProvider:
         self.WAIT_BETWEEN_REQUESTS = (
             ANTHROPIC_WAIT_BETWEEN_REQUESTS if ANTHROPIC_WAIT_BETWEEN_REQUESTS else 1
         )
-        self.failures = 0
 
     @staticmethod
     def services():
         return ["llm", "vision"]
 
-    async def inference(self, prompt, tokens: int = 0, images: list = []):
-        if (
-            self.ANTHROPIC_API_KEY == ""
-            or self.ANTHROPIC_API_KEY == "YOUR_ANTHROPIC_API_KEY"
-        ):
-            return (
-                "Please go to the Agent Management page to set your Anthropic API key."
-            )
+    def get_client(self):
+        return get_anthropic_client(
+            api_key=self.ANTHROPIC_API_KEY,
+            vertex_region=self.GOOGLE_VERTEX_REGION,
+            vertex_project_id=self.GOOGLE_VERTEX_PROJECT_ID,
+        )
 
+    async def get_messages(self, prompt, images: list = []):
         messages = []
         if images:
             for image in images:
                 # If the image is a url, download it
                 if image.startswith("http"):
-                    image_base64 = base64.b64encode(httpx.get(image).content).decode(
+                    image_response = await get_http_client().get(image)
+                    image_base64 = base64.b64encode(image_response.content).decode(
                         "utf-8"
                     )
                 else:
@@ -91,33 +91,66 @@ class AnthropicProvider:
                 )
         else:
             messages.append({"role": "user", "content": prompt})
+        return messages
 
-        if self.GOOGLE_VERTEX_PROJECT_ID != "":
-            c = anthropic.AnthropicVertex(
-                access_token=self.ANTHROPIC_API_KEY,
-                region=self.GOOGLE_VERTEX_REGION,
-                project_id=self.GOOGLE_VERTEX_PROJECT_ID,
+    async def inference(self, prompt, tokens: int = 0, images: list = []):
+        if (
+            self.ANTHROPIC_API_KEY == ""
+            or self.ANTHROPIC_API_KEY == "YOUR_ANTHROPIC_API_KEY"
+        ):
+            return (
+                "Please go to the Agent Management page to set your Anthropic API key."
             )
-        else:
-            c = anthropic.Client(api_key=self.ANTHROPIC_API_KEY)
+        messages = await self.get_messages(prompt=prompt, images=images)
+        c = self.get_client()
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        failures = 0
+        while True:
+            try:
+                response = await c.messages.create(
+                    messages=messages,
+                    model=self.AI_MODEL,
+                    max_tokens=4096,
+                )
+                return response.content[0].text
+            except Exception as e:
+                logging.info(f"[CLAUDE PROVIDER] Error: {e}")
+                failures += 1
+                if failures > 3 or in_rotation():
+                    # The rotation provider tracks the rate limit and moves on
+                    # to another provider rather than waiting here
+                    return provider_error(f"Claude Error: {e}")
+                # https://console.anthropic.com/settings/limits
+                # Rate limits that impact AGiXT most with Anthropic API are the input tokens per minute being limited to 80k.
+                # If we hit an error, it is almost always because we exceeded this by sending 2 or more prompts in a row exceeding 80k.
+                # To get around it, we sleep for 61 seconds.
+                await asyncio.sleep(61)
+
+    async def inference_stream(self, prompt, tokens: int = 0, images: list = []):
+        """Yield the response to the prompt as it is generated"""
+        if (
+            self.ANTHROPIC_API_KEY == ""
+            or self.ANTHROPIC_API_KEY == "YOUR_ANTHROPIC_API_KEY"
+        ):
+            yield "Please go to the Agent Management page to set your Anthropic API key."
+            return
+        messages = await self.get_messages(prompt=prompt, images=images)
+        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        started = False
         try:
-            response = c.messages.create(
+            async with self.get_client().messages.stream(
                 messages=messages,
                 model=self.AI_MODEL,
                 max_tokens=4096,
-            )
-            return response.content[0].text
+            ) as stream:
+                async for text in stream.text_stream:
+                    started = True
+                    yield text
         except Exception as e:
-            logging.info(f"[CLAUDE PROVIDER] Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                return f"Claude Error: {e}"
-            else:
-                # https://console.anthropic.com/settings/limits
-                # Rate limits that impact AGiXT most with Anthropic API are the input tokens per minute being limited to 80k.
-                # If we hit an error, it is almost always because we exceeded this by sending 2 or more prompts in a row exceeding 80k.
-                # To get around it, we sleep for 61 seconds.
-                time.sleep(61)
-                return await self.inference(prompt=prompt, tokens=tokens, images=images)
+            if started:
+                raise
+            # Nothing was sent yet, let inference handle the rate limit retries
+            logging.info(f"[CLAUDE PROVIDER] Streaming error: {e}")
+            yield await self.inference(prompt=prompt, tokens=tokens, images=images)
@@ -1,6 +1,11 @@
-from openai import AzureOpenAI
+from ProviderHealth import provider_error
+from ProviderClients import (
+    get_azure_openai_client,
+    get_chat_messages,
+    stream_chat_completion,
+)
+import asyncio
 import logging
-import time
 
 
 class AzureProvider:
@@ -34,72 +39,71 @@ class AzureProvider:
         self.WAIT_BETWEEN_REQUESTS = (
             AZURE_WAIT_BETWEEN_REQUESTS if AZURE_WAIT_BETWEEN_REQUESTS else 1
         )
-        self.failures = 0
 
     @staticmethod
     def services():
         return ["llm", "vision"]
 
-    async def inference(self, prompt, tokens: int = 0, images: list = []):
+    def get_client(self):
         if not self.AZURE_OPENAI_ENDPOINT.endswith("/"):
             self.AZURE_OPENAI_ENDPOINT += "/"
-        openai = AzureOpenAI(
+        return get_azure_openai_client(
             api_key=self.AZURE_API_KEY,
             api_version="2024-02-01",
             azure_endpoint=self.AZURE_OPENAI_ENDPOINT,
             azure_deployment=self.AI_MODEL,
         )
+
+    async def inference(self, prompt, tokens: int = 0, images: list = []):
+        client = self.get_client()
         if self.AZURE_API_KEY == "" or self.AZURE_API_KEY == "YOUR_API_KEY":
             if self.AZURE_OPENAI_ENDPOINT == "https://your-endpoint.openai.azure.com":
                 return "Please go to the Agent Management page to set your Azure OpenAI API key."
-        messages = []
-        if len(images) > 0:
-            messages.append(
-                {"role": "user", "content": [{"type": "text", "text": prompt}]}
-            )
-            for image in images:
-                if image.startswith("http"):
-                    messages[0]["content"].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image,
-                            },
-                        }
-                    )
-                else:
-                    file_type = image.split(".")[-1]
-                    with open(image, "rb") as f:
-                        image_base64 = f.read()
-                    messages[0]["content"].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{file_type};base64,{image_base64}"
-                            },
-                        }
-                    )
-        else:
-            messages.append({"role": "user", "content": prompt})
+        messages = get_chat_messages(prompt=prompt, images=images)
+        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        failures = 0
+        while True:
+            try:
+                response = await client.chat.completions.create(
+                    model=self.AI_MODEL,
+                    messages=messages,
+                    temperature=float(self.AI_TEMPERATURE),
+                    max_tokens=4096,
+                    top_p=float(self.AI_TOP_P),
+                    n=1,
+                    stream=False,
+                )
+                return response.choices[0].message.content
+            except Exception as e:
+                logging.warning(f"Azure OpenAI API Error: {e}")
+                failures += 1
+                if failures > 3:
+                    return provider_error("Azure OpenAI API Error: Too many failures.")
+                if int(self.WAIT_AFTER_FAILURE) <= 0:
+                    return provider_error(f"Azure OpenAI API Error: {e}")
+                await asyncio.sleep(int(self.WAIT_AFTER_FAILURE))
+
+    async def inference_stream(self, prompt, tokens: int = 0, images: list = []):
+        """Yield the response to the prompt as it is generated"""
+        client = self.get_client()
+        if self.AZURE_API_KEY == "" or self.AZURE_API_KEY == "YOUR_API_KEY":
+            if self.AZURE_OPENAI_ENDPOINT == "https://your-endpoint.openai.azure.com":
+                yield "Please go to the Agent Management page to set your Azure OpenAI API key."
+                return
+        messages = get_chat_messages(prompt=prompt, images=images)
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
-                model=self.AI_MODEL,
-                messages=messages,
-                temperature=float(self.AI_TEMPERATURE),
-                max_tokens=4096,
-                top_p=float(self.AI_TOP_P),
-                n=1,
-                stream=False,
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.warning(f"Azure OpenAI API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                return "Azure OpenAI API Error: Too many failures."
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        async for token in stream_chat_completion(
+            client=client,
+            fallback=lambda: self.inference(
+                prompt=prompt, tokens=tokens, images=images
+            ),
+            model=self.AI_MODEL,
+            messages=messages,
+            temperature=float(self.AI_TEMPERATURE),
+            max_tokens=4096,
+            top_p=float(self.AI_TOP_P),
+            n=1,
+        ):
+            yield token
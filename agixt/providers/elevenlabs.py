@@ -1,4 +1,4 @@
-import requests
+from ProviderClients import get_http_client
 
 
 class ElevenlabsProvider:
@@ -27,7 +27,7 @@ class ElevenlabsProvider:
             "xi-api-key": self.ELEVENLABS_VOICE,
         }
         try:
-            response = requests.post(
+            response = await get_http_client().post(
                 f"https://api.elevenlabs.io/v1/text-to-speech/{self.ELEVENLABS_VOICE}",
                 headers=headers,
                 json={"text": text},
@@ -35,7 +35,7 @@ class ElevenlabsProvider:
             response.raise_for_status()
         except:
             self.ELEVENLABS_VOICE = "ErXwobaYiN019PkySvjV"
-            response = requests.post(
+            response = await get_http_client().post(
                 f"https://api.elevenlabs.io/v1/text-to-speech/{self.ELEVENLABS_VOICE}",
                 headers=headers,
                 json={"text": text},
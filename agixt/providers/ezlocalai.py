@@ -1,9 +1,15 @@
+import asyncio
 import logging
 import random
 import re
 import numpy as np
-import requests
 from Globals import getenv
+from ProviderHealth import provider_error
+from ProviderClients import (
+    get_http_client,
+    get_openai_client,
+    get_sync_openai_client,
+)
 import uuid
 
 try:
@@ -57,7 +63,6 @@ class EzlocalaiProvider:
             EZLOCALAI_TRANSCRIPTION_MODEL if EZLOCALAI_TRANSCRIPTION_MODEL else "base"
         )
         self.FAILURES = []
-        self.failure_count = 0
         self.chunk_size = 1024
 
     @staticmethod
@@ -78,14 +83,14 @@ class EzlocalaiProvider:
         for uri in uri_list:
             if uri not in self.FAILURES:
                 self.API_URI = uri
-                openai.base_url = self.API_URI
                 break
 
+    def get_client(self):
+        return get_openai_client(api_key=self.EZLOCALAI_API_KEY, base_url=self.API_URI)
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
         if not self.API_URI.endswith("/"):
             self.API_URI += "/"
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
         max_tokens = (
             int(self.MAX_TOKENS) - int(tokens) if tokens > 0 else self.MAX_TOKENS
         )
@@ -118,70 +123,68 @@ class EzlocalaiProvider:
                     )
         else:
             messages.append({"role": "user", "content": prompt})
-        try:
-            response = openai.chat.completions.create(
-                model=self.AI_MODEL,
-                messages=messages,
-                max_tokens=int(max_tokens),
-                temperature=float(self.AI_TEMPERATURE),
-                top_p=float(self.AI_TOP_P),
-                n=1,
-                stream=False,
-            )
-            response = response.choices[0].message.content
-            if "User:" in response:
-                response = response.split("User:")[0]
-            response = response.lstrip()
-            response.replace("<s>", "").replace("</s>", "")
-            if "http://localhost:8091/outputs/" in response:
-                response = response.replace(
-                    "http://localhost:8091/outputs/", self.OUTPUT_URL
+        failure_count = 0
+        while True:
+            try:
+                response = await self.get_client().chat.completions.create(
+                    model=self.AI_MODEL,
+                    messages=messages,
+                    max_tokens=int(max_tokens),
+                    temperature=float(self.AI_TEMPERATURE),
+                    top_p=float(self.AI_TOP_P),
+                    n=1,
+                    stream=False,
                 )
-            if self.OUTPUT_URL in response:
-                urls = re.findall(f"{re.escape(self.OUTPUT_URL)}[^\"' ]+", response)
-                urls = urls[0].split("\n\n")
-                for url in urls:
-                    file_type = url.split(".")[-1]
-                    if file_type == "wav":
-                        response = response.replace(
-                            url,
-                            f'<audio controls><source src="{url}" type="audio/wav"></audio>',
-                        )
-                    else:
-                        response = response.replace(url, f"![{file_type}]({url})")
-            return response
-        except Exception as e:
-            self.failure_count += 1
-            logging.info(f"ezLocalai API Error: {e}")
-            if "," in self.API_URI:
-                self.rotate_uri()
-            if self.failure_count >= 3:
-                logging.info("ezLocalai failed 3 times, unable to proceed.")
-                return "ezLocalai failed 3 times, unable to proceed."
-            return await self.inference(prompt=prompt, tokens=tokens, images=images)
+                response = response.choices[0].message.content
+                if "User:" in response:
+                    response = response.split("User:")[0]
+                response = response.lstrip()
+                response.replace("<s>", "").replace("</s>", "")
+                if "http://localhost:8091/outputs/" in response:
+                    response = response.replace(
+                        "http://localhost:8091/outputs/", self.OUTPUT_URL
+                    )
+                if self.OUTPUT_URL in response:
+                    urls = re.findall(f"{re.escape(self.OUTPUT_URL)}[^\"' ]+", response)
+                    urls = urls[0].split("\n\n")
+                    for url in urls:
+                        file_type = url.split(".")[-1]
+                        if file_type == "wav":
+                            response = response.replace(
+                                url,
+                                f'<audio controls><source src="{url}" type="audio/wav"></audio>',
+                            )
+                        else:
+                            response = response.replace(url, f"![{file_type}]({url})")
+                return response
+            except Exception as e:
+                failure_count += 1
+                logging.info(f"ezLocalai API Error: {e}")
+                if "," in self.API_URI:
+                    self.rotate_uri()
+                if failure_count >= 3:
+                    logging.info("ezLocalai failed 3 times, unable to proceed.")
+                    return provider_error(
+                        "ezLocalai failed 3 times, unable to proceed."
+                    )
+                await asyncio.sleep(failure_count)
 
     async def transcribe_audio(self, audio_path: str):
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
         with open(audio_path, "rb") as audio_file:
-            transcription = openai.audio.transcriptions.create(
+            transcription = await self.get_client().audio.transcriptions.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return transcription.text
 
     async def translate_audio(self, audio_path: str):
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
         with open(audio_path, "rb") as audio_file:
-            translation = openai.audio.translations.create(
+            translation = await self.get_client().audio.translations.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return translation.text
 
     async def text_to_speech(self, text: str):
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        tts_response = openai.audio.speech.create(
+        tts_response = await self.get_client().audio.speech.create(
             model="tts-1",
             voice=self.VOICE,
             input=text,
@@ -192,9 +195,7 @@ class EzlocalaiProvider:
     async def generate_image(self, prompt: str) -> str:
         filename = f"{uuid.uuid4()}.png"
         image_path = f"./WORKSPACE/{filename}"
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        response = openai.images.generate(
+        response = await self.get_client().images.generate(
             prompt=prompt,
             model="stabilityai/sdxl-turbo",
             n=1,
@@ -203,15 +204,17 @@ class EzlocalaiProvider:
         )
         logging.info(f"Image Generated for prompt:{prompt}")
         url = response.data[0].url
+        image = await get_http_client().get(url)
         with open(image_path, "wb") as f:
-            f.write(requests.get(url).content)
+            f.write(image.content)
         agixt_uri = getenv("AGIXT_URI")
         return f"{agixt_uri}/outputs/{filename}"
 
     def embeddings(self, input) -> np.ndarray:
-        openai.base_url = self.API_URI
-        openai.api_key = self.EZLOCALAI_API_KEY
-        response = openai.embeddings.create(
+        client = get_sync_openai_client(
+            api_key=self.EZLOCALAI_API_KEY, base_url=self.API_URI
+        )
+        response = client.embeddings.create(
             input=input,
             model="bge-m3",
         )
@@ -2,6 +2,7 @@ import asyncio
 import os
 from pathlib import Path
 from Globals import getenv
+from ProviderHealth import provider_error
 
 try:
     import google.generativeai as genai  # Primary import attempt
@@ -87,7 +88,7 @@ class GoogleProvider:
                 )
             return generated_text
         except Exception as e:
-            return f"Gemini Error: {e}"
+            return provider_error(f"Gemini Error: {e}")
 
     async def text_to_speech(self, text: str):
         tts = ts.gTTS(text)
@@ -1,9 +1,16 @@
-import time
+import asyncio
 import logging
 import random
-import requests
 import uuid
 from Globals import getenv
+from ProviderHealth import provider_error
+from ProviderClients import (
+    get_http_client,
+    get_openai_client,
+    get_sync_openai_client,
+    get_chat_messages,
+    stream_chat_completion,
+)
 import numpy as np
 
 try:
@@ -55,7 +62,6 @@ class OpenaiProvider:
             OPENAI_TRANSCRIPTION_MODEL if OPENAI_TRANSCRIPTION_MODEL else "whisper-1"
         )
         self.FAILURES = []
-        self.failures = 0
         self.chunk_size = 1024
 
     @staticmethod
@@ -76,99 +82,101 @@ class OpenaiProvider:
         for uri in uri_list:
             if uri not in self.FAILURES:
                 self.API_URI = uri
-                openai.base_url = self.API_URI
                 break
 
+    def get_client(self):
+        return get_openai_client(
+            api_key=self.OPENAI_API_KEY,
+            base_url=self.API_URI if self.API_URI else "https://api.openai.com/v1/",
+        )
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
+        model = self.AI_MODEL
         if images != []:
-            if "vision" not in self.AI_MODEL and self.AI_MODEL != "gpt-4o":
-                self.AI_MODEL = "gpt-4o"
+            if "vision" not in model and model != "gpt-4o":
+                # Only for this call, the instance is shared between requests
+                model = "gpt-4o"
         if not self.API_URI.endswith("/"):
             self.API_URI += "/"
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
         if self.OPENAI_API_KEY == "" or self.OPENAI_API_KEY == "YOUR_OPENAI_API_KEY":
             if self.API_URI == "https://api.openai.com/v1/":
                 return (
                     "Please go to the Agent Management page to set your OpenAI API key."
                 )
-        messages = []
-        if len(images) > 0:
-            messages.append(
-                {"role": "user", "content": [{"type": "text", "text": prompt}]}
-            )
-            for image in images:
-                if image.startswith("http"):
-                    messages[0]["content"].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image,
-                            },
-                        }
-                    )
-                else:
-                    file_type = image.split(".")[-1]
-                    with open(image, "rb") as f:
-                        image_base64 = f.read()
-                    messages[0]["content"].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{file_type};base64,{image_base64}"
-                            },
-                        }
-                    )
-        else:
-            messages.append({"role": "user", "content": prompt})
+        messages = get_chat_messages(prompt=prompt, images=images)
 
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
-                model=self.AI_MODEL,
-                messages=messages,
-                temperature=float(self.AI_TEMPERATURE),
-                max_tokens=4096,
-                top_p=float(self.AI_TOP_P),
-                n=1,
-                stream=False,
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.info(f"OpenAI API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                return "OpenAI API Error: Too many failures."
-            if "," in self.API_URI:
-                self.rotate_uri()
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        failures = 0
+        while True:
+            try:
+                response = await self.get_client().chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=float(self.AI_TEMPERATURE),
+                    max_tokens=4096,
+                    top_p=float(self.AI_TOP_P),
+                    n=1,
+                    stream=False,
+                )
+                return response.choices[0].message.content
+            except Exception as e:
+                logging.info(f"OpenAI API Error: {e}")
+                failures += 1
+                if failures > 3:
+                    return provider_error("OpenAI API Error: Too many failures.")
+                if "," in self.API_URI:
+                    self.rotate_uri()
+                if int(self.WAIT_AFTER_FAILURE) <= 0:
+                    return provider_error(f"OpenAI API Error: {e}")
+                await asyncio.sleep(int(self.WAIT_AFTER_FAILURE))
+
+    async def inference_stream(self, prompt, tokens: int = 0, images: list = []):
+        """Yield the response to the prompt as it is generated"""
+        model = self.AI_MODEL
+        if images != []:
+            if "vision" not in model and model != "gpt-4o":
+                # Only for this call, the instance is shared between requests
+                model = "gpt-4o"
+        if not self.API_URI.endswith("/"):
+            self.API_URI += "/"
+        if self.OPENAI_API_KEY == "" or self.OPENAI_API_KEY == "YOUR_OPENAI_API_KEY":
+            if self.API_URI == "https://api.openai.com/v1/":
+                yield "Please go to the Agent Management page to set your OpenAI API key."
+                return
+        messages = get_chat_messages(prompt=prompt, images=images)
+        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        async for token in stream_chat_completion(
+            client=self.get_client(),
+            fallback=lambda: self.inference(
+                prompt=prompt, tokens=tokens, images=images
+            ),
+            model=model,
+            messages=messages,
+            temperature=float(self.AI_TEMPERATURE),
+            max_tokens=4096,
+            top_p=float(self.AI_TOP_P),
+            n=1,
+        ):
+            yield token
 
     async def transcribe_audio(self, audio_path: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
         with open(audio_path, "rb") as audio_file:
-            transcription = openai.audio.transcriptions.create(
+            transcription = await self.get_client().audio.transcriptions.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return transcription.text
 
     async def translate_audio(self, audio_path: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
         with open(audio_path, "rb") as audio_file:
-            translation = openai.audio.translations.create(
+            translation = await self.get_client().audio.translations.create(
                 model=self.TRANSCRIPTION_MODEL, file=audio_file
             )
         return translation.text
 
     async def text_to_speech(self, text: str):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        tts_response = openai.audio.speech.create(
+        tts_response = await self.get_client().audio.speech.create(
             model="tts-1",
             voice=self.VOICE,
             input=text,
@@ -178,9 +186,7 @@ class OpenaiProvider:
     async def generate_image(self, prompt: str) -> str:
         filename = f"{uuid.uuid4()}.png"
         image_path = f"./WORKSPACE/{filename}"
-        openai.base_url = self.API_URI if self.API_URI else "https://api.openai.com/v1/"
-        openai.api_key = self.OPENAI_API_KEY
-        response = openai.images.generate(
+        response = await self.get_client().images.generate(
             prompt=prompt,
             model="dall-e-3",
             n=1,
@@ -189,15 +195,17 @@ class OpenaiProvider:
         )
         logging.info(f"Image Generated for prompt:{prompt}")
         url = response.data[0].url
+        image = await get_http_client().get(url)
         with open(image_path, "wb") as f:
-            f.write(requests.get(url).content)
+            f.write(image.content)
         agixt_uri = getenv("AGIXT_URI")
         return f"{agixt_uri}/outputs/{filename}"
 
     def embeddings(self, input) -> np.ndarray:
-        openai.base_url = self.API_URI
-        openai.api_key = self.OPENAI_API_KEY
-        response = openai.embeddings.create(
+        client = get_sync_openai_client(
+            api_key=self.OPENAI_API_KEY, base_url=self.API_URI
+        )
+        response = client.embeddings.create(
             input=input,
             model="text-embedding-3-small",
         )
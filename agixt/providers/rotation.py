@@ -1,48 +1,113 @@
+import time
+import random
+import asyncio
 import logging
+import threading
+from Globals import getenv
 from Providers import get_providers, Providers
+from ProviderHealth import provider_health, current_attempt, ProviderAttempt
 from typing import List, Dict, Any
 
+ROTATION_POLICIES = ("cheapest", "fastest", "smartest")
+
+
+class ProviderFailed(Exception):
+    pass
+
+
+class ProviderInstancePool:
+    """
+    Provider instances shared by every rotation in this worker.
+
+    Keyed like provider health, so agents using the same provider settings reuse
+    one instance (and its HTTP client) instead of building it per request.
+    """
+
+    def __init__(self):
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def get(self, provider: str, settings: dict) -> Providers:
+        key = provider_health.get_key(provider, settings)
+        with self.lock:
+            instance = self.instances.get(key)
+        if instance is not None:
+            return instance
+        # Shared instances must not hold on to one request's ApiClient
+        instance = Providers(
+            name=provider,
+            **{name: value for name, value in settings.items() if name != "ApiClient"},
+        )
+        with self.lock:
+            return self.instances.setdefault(key, instance)
+
+
+provider_instances = ProviderInstancePool()
+
 
 class RotationProvider:
     """
-    The AGiXT provider rotates between available providers to handle requested based on token limits.
+    The AGiXT provider rotates between available providers to handle requests based on token limits, health and latency.
+
+    ROTATION_POLICY picks the order providers are tried in: "cheapest" prefers the smallest context that fits the request, "fastest" spreads requests by observed latency and "smartest" follows SMARTEST_PROVIDER. Providers that keep failing or are rate limited are skipped until they recover.
+
+    With ROTATION_HEDGING enabled, a request that the first provider has not answered within its p90 latency is also sent to the next provider, the first answer wins and the other request is cancelled.
     """
 
     def __init__(
         self,
         SMARTEST_PROVIDER: str = "anthropic",  # Can be a comma-separated list
+        ROTATION_POLICY: str = "cheapest",
+        ROTATION_HEDGING: bool = False,
         **kwargs,
     ):
         self.friendly_name = "AGiXT"
         self.requirements = []
-        self.providers = get_providers()
         self.AGENT_SETTINGS = kwargs
-        if "," in SMARTEST_PROVIDER:
-            self.intelligence_tiers = SMARTEST_PROVIDER.split(",")
-        else:
-            self.intelligence_tiers = [SMARTEST_PROVIDER]
-        self.failed_providers = set()
-        self.smartest_provider = self.intelligence_tiers[0]
+        self.intelligence_tiers = [
+            provider.strip()
+            for provider in str(SMARTEST_PROVIDER).split(",")
+            if provider.strip()
+        ]
+        self.smartest_provider = (
+            self.intelligence_tiers[0] if self.intelligence_tiers else None
+        )
+        self.policy = str(ROTATION_POLICY).lower()
+        if self.policy not in ROTATION_POLICIES:
+            logging.warning(
+                f"Unknown ROTATION_POLICY {ROTATION_POLICY}, using cheapest"
+            )
+            self.policy = "cheapest"
+        self.hedging = str(ROTATION_HEDGING).lower() == "true"
         self.agent_name = kwargs.get("agent_name", "AGiXT")
         self.user = kwargs.get("user", None)
         self.ApiClient = kwargs.get("ApiClient", None)
+        self.providers = self._get_configured_providers()
+        self.provider_max_tokens = self._get_provider_token_limits()
+
+    def _get_configured_providers(self) -> List[str]:
+        """Providers that have an API key set, excluding the meta providers."""
+        excluded_providers = {"agixt", "rotation", "gpt4free", "default"}
+        return [
+            provider
+            for provider in get_providers()
+            if provider not in excluded_providers
+            and self.AGENT_SETTINGS.get(f"{provider.upper()}_API_KEY", "") != ""
+        ]
 
     def _get_provider_token_limits(self) -> Dict[str, int]:
         """Get token limits for all available providers."""
         provider_max_tokens = {}
         for provider in self.providers:
             setting_key = f"{provider.upper()}_MAX_TOKENS"
-            try:
-                if setting_key in self.AGENT_SETTINGS:
-                    provider_max_tokens[provider] = int(
-                        self.AGENT_SETTINGS[setting_key]
-                    )
-                    logging.info(
-                        f"Provider {provider} has max token limit: {provider_max_tokens[provider]}"
-                    )
-            except:
-                self.providers.remove(provider)
+            if setting_key not in self.AGENT_SETTINGS:
                 continue
+            try:
+                provider_max_tokens[provider] = int(self.AGENT_SETTINGS[setting_key])
+            except (TypeError, ValueError):
+                logging.warning(
+                    f"Ignoring provider {provider}, invalid {setting_key}: {self.AGENT_SETTINGS[setting_key]}"
+                )
         return provider_max_tokens
 
     def _filter_suitable_providers(
@@ -59,12 +124,203 @@ class RotationProvider:
         )
         return suitable
 
+    def get_health(self, provider: str):
+        return provider_health.get(provider, self.AGENT_SETTINGS)
+
+    def get_instance(self, provider: str) -> Providers:
+        return provider_instances.get(provider, self.AGENT_SETTINGS)
+
+    def _order_by_policy(self, suitable: Dict[str, int], policy: str) -> List[str]:
+        by_limit = sorted(suitable, key=lambda provider: suitable[provider])
+        if policy == "smartest":
+            tiers = [p for p in self.intelligence_tiers if p in suitable]
+            return tiers + [p for p in by_limit if p not in tiers]
+        if policy == "fastest":
+            latencies = {p: self.get_health(p).percentile(50) for p in by_limit}
+            known = [latency for latency in latencies.values() if latency is not None]
+            # Providers without samples yet are assumed as fast as the best one
+            # so they get explored
+            fallback = min(known) if known else 1.0
+            keys = {}
+            for provider in by_limit:
+                latency = latencies[provider]
+                weight = 1 / max(latency if latency is not None else fallback, 0.05)
+                # Weighted random order, faster providers usually come first
+                # without sending every request to the same one
+                keys[provider] = random.random() ** (1 / weight)
+            return sorted(by_limit, key=lambda provider: keys[provider], reverse=True)
+        return by_limit
+
+    def select_providers(self, tokens: int = 0, use_smartest: bool = False):
+        """
+        Order the providers to try for a request.
+
+        Returns:
+            (provider names, None) or ([], error message) when none can serve it
+        """
+        if not self.providers:
+            logging.error("No providers available for inference")
+            return [], "Unable to process request. No providers available."
+        if tokens > 0:
+            suitable_providers = self._filter_suitable_providers(
+                self.provider_max_tokens, tokens
+            )
+            if not suitable_providers:
+                logging.error(f"No providers can handle input size of {tokens} tokens")
+                return [], (
+                    f"Unable to process request. Input size ({tokens} tokens) exceeds "
+                    "all provider limits. Please reduce input size."
+                )
+        else:
+            suitable_providers = self.provider_max_tokens
+        if not suitable_providers:
+            logging.error("No providers with a max token limit available for inference")
+            return [], "Unable to process request. No providers available."
+        policy = "smartest" if use_smartest else self.policy
+        ordered = self._order_by_policy(suitable_providers, policy)
+        health = {provider: self.get_health(provider) for provider in ordered}
+        ready = [provider for provider in ordered if health[provider].ready(tokens)]
+        if not ready:
+            # Everything is open or rate limited, probe whichever recovers first
+            soonest = min(ordered, key=lambda provider: health[provider].retry_at())
+            logging.warning(f"No healthy providers, probing {soonest}")
+            return [soonest], None
+        # Providers failing most of their recent requests go last
+        healthy = [p for p in ready if health[p].error_rate() < 0.5]
+        return healthy + [p for p in ready if p not in healthy], None
+
+    def select_provider(self, tokens: int = 0, use_smartest: bool = False):
+        """
+        Pick the provider for a request.
+
+        Returns:
+            (provider name, None) or (None, error message) when none can serve it
+        """
+        providers, error = self.select_providers(
+            tokens=tokens, use_smartest=use_smartest
+        )
+        if error:
+            return None, error
+        return providers[0], None
+
+    def _record_decision(self, tokens, use_smartest, candidates, attempts, provider):
+        provider_health.record_decision(
+            agent_name=self.agent_name,
+            policy="smartest" if use_smartest else self.policy,
+            tokens=tokens,
+            candidates=candidates,
+            attempts=attempts,
+            provider=provider,
+        )
+
+    async def _attempt(self, provider: str, call):
+        """
+        Await call() against provider, recording its latency and outcome.
+
+        Raises ProviderFailed when the provider raised or only got HTTP errors
+        back (providers return those as text).
+        """
+        health = self.get_health(provider)
+        health.begin()
+        attempt = ProviderAttempt(health)
+        context = current_attempt.set(attempt)
+        start = time.monotonic()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            # The other request of a hedge won, this one tells nothing
+            health.release()
+            raise
+        except Exception as e:
+            health.record_failure(time.monotonic() - start, e)
+            raise ProviderFailed(str(e)) from e
+        finally:
+            current_attempt.reset(context)
+        latency = time.monotonic() - start
+        if attempt.failed:
+            health.record_failure(
+                latency, f"HTTP {attempt.statuses[-1]}: {str(result)[:200]}"
+            )
+            raise ProviderFailed(str(result))
+        health.record_success(latency)
+        return result, latency
+
+    def get_hedge_delay(self, provider: str):
+        """Seconds to wait for provider before hedging, None until it has enough samples"""
+        health = self.get_health(provider)
+        if len(health.samples) < int(getenv("ROTATION_HEDGE_MIN_SAMPLES")):
+            return None
+        return health.percentile(90)
+
+    async def _hedge(self, primary: str, backup: str, call, delay: float, attempts):
+        """
+        Race primary against backup once primary is slower than delay, or has
+        failed before that. The loser is cancelled.
+
+        Returns:
+            (winning provider, result, providers tried), provider is None if all failed
+        """
+        tasks = {asyncio.ensure_future(self._attempt(primary, call(primary))): primary}
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        hedged = not done
+        if done and next(iter(done)).exception() is None:
+            result, latency = next(iter(done)).result()
+            attempts.append(
+                {"provider": primary, "ok": True, "latency_ms": round(latency * 1000)}
+            )
+            self._record_hedge(requests=1, primary_wins=1)
+            return primary, result, [primary]
+        tasks[asyncio.ensure_future(self._attempt(backup, call(backup)))] = backup
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    provider = tasks[task]
+                    try:
+                        result, latency = task.result()
+                    except ProviderFailed as e:
+                        logging.error(f"Provider {provider} failed with error: {e}")
+                        attempts.append(
+                            {"provider": provider, "ok": False, "hedged": hedged}
+                        )
+                        continue
+                    attempts.append(
+                        {
+                            "provider": provider,
+                            "ok": True,
+                            "latency_ms": round(latency * 1000),
+                            "hedged": hedged,
+                        }
+                    )
+                    self._record_hedge(
+                        requests=1,
+                        hedged=int(hedged),
+                        primary_wins=int(provider == primary),
+                        backup_wins=int(provider == backup),
+                        cancelled=len(pending),
+                    )
+                    return provider, result, [primary, backup]
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+        self._record_hedge(requests=1, hedged=int(hedged), failed=1)
+        return None, None, [primary, backup]
+
+    def _record_hedge(self, **counts):
+        provider_health.record_hedge(self.user, self.agent_name, **counts)
+
     async def inference(
         self,
         prompt: str,
         tokens: int = 0,
         images: List[Any] = None,
         use_smartest: bool = False,
+        hedge: bool = None,
     ) -> str:
         """
         Attempt inference using providers with sufficient token limits.
@@ -74,90 +330,120 @@ class RotationProvider:
             tokens: Required token count (0 if unknown)
             images: List of images for vision tasks
             use_smartest: Whether to try the smartest provider first
+            hedge: Hedge slow requests on a second provider, defaults to ROTATION_HEDGING
 
         Returns:
-            Response from successful provider or error message
+            Response from successful provider or error message. Only the answer
+            returned is charged for, a cancelled hedge request never reaches
+            token accounting.
         """
         images = images or []
+        hedge = self.hedging if hedge is None else hedge
+        candidates, error = self.select_providers(
+            tokens=tokens, use_smartest=use_smartest
+        )
+        if error:
+            return error
 
-        # Remove providers that shouldn't be part of rotation
-        excluded_providers = {"agixt", "rotation", "gpt4free", "default"}
-        self.providers = [p for p in self.providers if p not in excluded_providers]
-        for provider in self.providers:
-            if provider.upper() + "_API_KEY" not in self.AGENT_SETTINGS:
-                self.providers.remove(provider)
-                continue
-            if self.AGENT_SETTINGS[provider.upper() + "_API_KEY"] == "":
-                self.providers.remove(provider)
-        logging.info(f"Available providers after exclusions: {self.providers}")
-
-        if not self.providers:
-            logging.error("No providers available for inference")
-            return "Unable to process request. No providers available."
-
-        # Get provider token limits
-        provider_max_tokens = self._get_provider_token_limits()
-
-        # Filter providers that can handle the token count
-        if tokens > 0:
-            suitable_providers = self._filter_suitable_providers(
-                provider_max_tokens, tokens
-            )
-            if not suitable_providers:
-                logging.error(f"No providers can handle input size of {tokens} tokens")
-                return (
-                    f"Unable to process request. Input size ({tokens} tokens) exceeds "
-                    "all provider limits. Please reduce input size."
-                )
-        else:
-            suitable_providers = provider_max_tokens
-            logging.info("Token count not specified, all providers considered suitable")
-
-        try:
-            # If use_smartest is True and smartest provider is available, try it first
-            if (
-                use_smartest
-                and self.smartest_provider in suitable_providers
-                and self.smartest_provider not in self.failed_providers
-            ):
-                provider = self.smartest_provider
-            else:
-                # Select provider with lowest token limit that can handle the request
-                available_providers = {
-                    k: v
-                    for k, v in suitable_providers.items()
-                    if k not in self.failed_providers
-                }
-                if not available_providers:
-                    self.failed_providers.clear()  # Reset failed providers if all have failed
-                    available_providers = suitable_providers
-                provider = min(available_providers, key=available_providers.get)
-
-            logging.info(
-                f"Selected provider {provider} for inference (limit: {suitable_providers[provider]} tokens)"
+        def call(provider):
+            return lambda: self.get_instance(provider).inference(
+                prompt=prompt, tokens=tokens, images=images
             )
 
-            # Try inference
-            provider_instance = Providers(
-                name=provider,
-                **self.AGENT_SETTINGS,
-            )
-            result = await provider_instance.inference(
-                prompt=prompt, tokens=tokens, images=images
+        attempts = []
+        last_error = None
+        remaining = list(candidates)
+        while remaining:
+            provider = remaining.pop(0)
+            delay = self.get_hedge_delay(provider) if hedge and remaining else None
+            if delay is not None:
+                winner, result, tried = await self._hedge(
+                    provider, remaining[0], call, delay, attempts
+                )
+                remaining = [p for p in remaining if p not in tried]
+                if winner is not None:
+                    self._record_decision(
+                        tokens, use_smartest, candidates, attempts, winner
+                    )
+                    return result
+                last_error = "Hedged providers failed."
+                continue
+            try:
+                result, latency = await self._attempt(provider, call(provider))
+            except ProviderFailed as e:
+                logging.error(f"Provider {provider} failed with error: {str(e)}")
+                attempts.append({"provider": provider, "ok": False})
+                last_error = e
+                continue
+            attempts.append(
+                {"provider": provider, "ok": True, "latency_ms": round(latency * 1000)}
             )
-            self.failed_providers.discard(
-                provider
-            )  # Remove from failed providers if successful
+            self._record_decision(tokens, use_smartest, candidates, attempts, provider)
             return result
+        self._record_decision(tokens, use_smartest, candidates, attempts, None)
+        return f"Unable to process request. All providers failed. {last_error}"
 
-        except Exception as e:
-            logging.error(f"Provider {provider} failed with error: {str(e)}")
-            self.failed_providers.add(provider)  # Add to failed providers set
-            if provider in self.providers:
-                self.providers.remove(provider)
-                logging.info(
-                    f"Removed failed provider {provider}. Remaining providers: {self.providers}"
+    async def inference_stream(
+        self,
+        prompt: str,
+        tokens: int = 0,
+        images: List[Any] = None,
+        use_smartest: bool = False,
+    ):
+        """
+        Stream from the selected provider, rotating like inference when it fails
+        before producing anything. Latency is the time to the first token.
+        """
+        images = images or []
+        candidates, error = self.select_providers(
+            tokens=tokens, use_smartest=use_smartest
+        )
+        if error:
+            yield error
+            return
+        attempts = []
+        last_error = None
+        for provider in candidates:
+            instance = self.get_instance(provider)
+            if hasattr(instance.instance, "inference_stream"):
+                stream = instance.inference_stream(
+                    prompt=prompt, tokens=tokens, images=images
                 )
-            return await self.inference(
-                prompt=prompt, tokens=tokens, images=images, use_smartest=use_smartest
+            else:
+                stream = None
+
+            async def first_token():
+                if stream is None:
+                    return await instance.inference(
+                        prompt=prompt, tokens=tokens, images=images
+                    )
+                async for token in stream:
+                    return token
+                return ""
+
+            try:
+                token, latency = await self._attempt(provider, first_token)
+            except ProviderFailed as e:
+                logging.error(f"Provider {provider} failed with error: {str(e)}")
+                attempts.append({"provider": provider, "ok": False})
+                last_error = e
+                if stream is not None:
+                    await stream.aclose()
+                continue
+            attempts.append(
+                {"provider": provider, "ok": True, "latency_ms": round(latency * 1000)}
             )
+            self._record_decision(tokens, use_smartest, candidates, attempts, provider)
+            yield token
+            if stream is None:
+                return
+            try:
+                async for token in stream:
+                    yield token
+            except Exception as e:
+                # Too late to switch providers once the answer has started
+                self.get_health(provider).record_failure(0.0, e)
+                raise
+            return
+        self._record_decision(tokens, use_smartest, candidates, attempts, None)
+        yield f"Unable to process request. All providers failed. {last_error}"
@@ -1,5 +1,11 @@
-import time
+import asyncio
 import logging
+from ProviderHealth import provider_error
+from ProviderClients import (
+    get_openai_client,
+    get_chat_messages,
+    stream_chat_completion,
+)
 
 try:
     import openai
@@ -46,7 +52,6 @@ class XaiProvider:
         )
         self.XAI_API_KEY = XAI_API_KEY
         self.FAILURES = []
-        self.failures = 0
 
     @staticmethod
     def services():
@@ -55,58 +60,54 @@ class XaiProvider:
             "vision",
         ]
 
+    def get_client(self):
+        return get_openai_client(
+            api_key=self.XAI_API_KEY,
+            base_url=self.API_URI if self.API_URI else "https://api.x.ai/v1/",
+        )
+
     async def inference(self, prompt, tokens: int = 0, images: list = []):
-        openai.base_url = self.API_URI if self.API_URI else "https://api.x.ai/v1/"
-        openai.api_key = f"Bearer {self.XAI_API_KEY}"
-        messages = []
-        if len(images) > 0:
-            messages.append(
-                {"role": "user", "content": [{"type": "text", "text": prompt}]}
-            )
-            for image in images:
-                if image.startswith("http"):
-                    messages[0]["content"].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image,
-                            },
-                        }
-                    )
-                else:
-                    file_type = image.split(".")[-1]
-                    with open(image, "rb") as f:
-                        image_base64 = f.read()
-                    messages[0]["content"].append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/{file_type};base64,{image_base64}"
-                            },
-                        }
-                    )
-        else:
-            messages.append({"role": "user", "content": prompt})
+        messages = get_chat_messages(prompt=prompt, images=images)
+
+        if int(self.WAIT_BETWEEN_REQUESTS) > 0:
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        failures = 0
+        while True:
+            try:
+                response = await self.get_client().chat.completions.create(
+                    model=self.AI_MODEL,
+                    messages=messages,
+                    temperature=float(self.AI_TEMPERATURE),
+                    max_tokens=4096,
+                    top_p=float(self.AI_TOP_P),
+                    n=1,
+                    stream=False,
+                )
+                return response.choices[0].message.content
+            except Exception as e:
+                logging.info(f"xAI API Error: {e}")
+                failures += 1
+                if failures > 3:
+                    return provider_error("xAI API Error: Too many failures.")
+                if int(self.WAIT_AFTER_FAILURE) <= 0:
+                    return provider_error(f"xAI API Error: {e}")
+                await asyncio.sleep(int(self.WAIT_AFTER_FAILURE))
 
+    async def inference_stream(self, prompt, tokens: int = 0, images: list = []):
+        """Yield the response to the prompt as it is generated"""
+        messages = get_chat_messages(prompt=prompt, images=images)
         if int(self.WAIT_BETWEEN_REQUESTS) > 0:
-            time.sleep(int(self.WAIT_BETWEEN_REQUESTS))
-        try:
-            response = openai.chat.completions.create(
-                model=self.AI_MODEL,
-                messages=messages,
-                temperature=float(self.AI_TEMPERATURE),
-                max_tokens=4096,
-                top_p=float(self.AI_TOP_P),
-                n=1,
-                stream=False,
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            logging.info(f"xAI API Error: {e}")
-            self.failures += 1
-            if self.failures > 3:
-                return "xAI API Error: Too many failures."
-            if int(self.WAIT_AFTER_FAILURE) > 0:
-                time.sleep(int(self.WAIT_AFTER_FAILURE))
-                return await self.inference(prompt=prompt, tokens=tokens)
-            return str(response)
+            await asyncio.sleep(int(self.WAIT_BETWEEN_REQUESTS))
+        async for token in stream_chat_completion(
+            client=self.get_client(),
+            fallback=lambda: self.inference(
+                prompt=prompt, tokens=tokens, images=images
+            ),
+            model=self.AI_MODEL,
+            messages=messages,
+            temperature=float(self.AI_TEMPERATURE),
+            max_tokens=4096,
+            top_p=float(self.AI_TOP_P),
+            n=1,
+        ):
+            yield token